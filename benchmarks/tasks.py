@@ -0,0 +1,18 @@
+"""Tasks used by the benchmark suite."""
+
+import time
+
+from dstm.tasks.task import task
+
+#: Seconds from submission to start of execution for each record_latency task run
+latencies: list[float] = []
+
+
+@task(queue="bench")
+def noop():
+    pass
+
+
+@task(queue="bench")
+def record_latency(sent_at: float):
+    latencies.append(time.time() - sent_at)
@@ -0,0 +1,40 @@
+import time
+
+from dstm.message import Message
+
+
+class AckBuffer:
+    """Holds acknowledgements so they can be sent to the broker in batches.
+
+    A flush is due once `max_size` acks are pending, or the oldest pending ack has
+    waited for `max_delay` seconds. Connections are responsible for actually flushing,
+    including before requeueing a message or disconnecting."""
+
+    def __init__(self, max_size: int, max_delay: float):
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.messages: list[Message] = []
+        self.oldest: float | None = None
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def add(self, message: Message) -> bool:
+        """Buffer an ack; returns True if the buffer should now be flushed."""
+        if not self.messages:
+            self.oldest = time.monotonic()
+        self.messages.append(message)
+        return self.due()
+
+    def due(self) -> bool:
+        if not self.messages:
+            return False
+        return (
+            len(self.messages) >= self.max_size
+            or time.monotonic() - self.oldest >= self.max_delay  # type: ignore
+        )
+
+    def drain(self) -> list[Message]:
+        messages, self.messages = self.messages, []
+        self.oldest = None
+        return messages
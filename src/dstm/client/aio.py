@@ -0,0 +1,206 @@
+"""Adapter for using a blocking MessageClient from asyncio code."""
+
+import asyncio
+import logging
+import queue
+import threading
+from contextlib import asynccontextmanager, closing
+from typing import AsyncGenerator, Iterable
+
+from dstm.client.base import (
+    AsyncMessageConnection,
+    MessageClient,
+    MessageConnection,
+)
+from dstm.client.pool import PooledClient
+from dstm.exceptions import ConnectionError, ConsumeError
+from dstm.message import Message
+
+logger = logging.getLogger(__name__)
+
+# Max seconds the listener thread waits for a free slot before checking for commands
+_SLOT_WAIT = 0.05
+
+_END = object()
+
+
+def connect_async(
+    client: MessageClient, max_unsettled: int = 100
+) -> AsyncMessageConnection:
+    """Get an asyncio connection from `client`, using its own connect_async() if it has
+    one, or else running its blocking connection on a background thread."""
+    if connect := getattr(client, "connect_async", None):
+        return connect()
+    return ThreadedAsyncConnection(client, max_unsettled=max_unsettled)
+
+
+class ThreadedAsyncConnection(AsyncMessageConnection):
+    """Runs a blocking MessageClient's listen() loop on a dedicated thread that owns
+    its connection, handing messages to the event loop and sending acks/requeues back
+    to that thread (blocking connections generally aren't thread-safe). Publishing uses
+    pooled connections on the default executor.
+
+    At most `max_unsettled` received messages may be waiting to be acked or requeued;
+    the listener thread won't fetch more until some have been settled. Nor does it
+    fetch one before it's asked for, so when listening stops, messages the client has
+    buffered are handed back by its own listen() rather than left unsettled (which
+    would count as a delivery)."""
+
+    def __init__(self, client: MessageClient, max_unsettled: int = 100):
+        self.client = client
+        self.publisher = PooledClient(client)
+        self._slots = threading.Semaphore(max_unsettled)
+        # Released each time listen() wants another message
+        self._wanted = threading.Semaphore(0)
+        # (method name, args, future) tuples for the listener thread to run; None
+        # tells it to close its connection and exit.
+        self._commands: queue.Queue = queue.Queue()
+        self._stop = threading.Event()
+        self._listener: threading.Thread | None = None
+        # The listener thread's connection, while it's open
+        self._conn: MessageConnection | None = None
+
+    def __repr__(self):
+        return f"ThreadedAsyncConnection({self.client!r})"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type_, value, tb):
+        await self.close()
+
+    async def close(self) -> None:
+        self._stop.set()
+        if self._listener is not None:
+            self._commands.put(None)
+            await asyncio.to_thread(self._listener.join)
+        self.publisher.close()
+
+    async def publish(self, message: Message) -> None:
+        await asyncio.to_thread(self._publish, message)
+
+    def _publish(self, message: Message) -> None:
+        with self.publisher.connect() as conn:
+            conn.publish(message)
+
+    async def listen(
+        self, queues: Iterable[str] | str, time_limit: float | None = None
+    ) -> AsyncGenerator[Message]:
+        if self._listener is not None:
+            raise ConsumeError("ThreadedAsyncConnection can only listen once")
+        loop = asyncio.get_running_loop()
+        received: asyncio.Queue = asyncio.Queue()
+        self._listener = threading.Thread(
+            target=self._listen,
+            args=(queues, time_limit, loop, received),
+            name="dstm-listener",
+            daemon=True,
+        )
+        self._listener.start()
+        try:
+            while True:
+                self._wanted.release()
+                if (item := await received.get()) is _END:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            self._stop.set()
+
+    async def ack(self, message: Message) -> None:
+        await self._command("ack", message)
+
+    async def requeue(self, message: Message, delay: float = 0) -> None:
+        await self._command("requeue", message, delay)
+
+    @asynccontextmanager
+    async def heartbeat(self, message: Message) -> AsyncGenerator[None]:
+        # Heartbeats are safe to use from any thread, so needn't go via the listener
+        if (conn := self._conn) is None:
+            raise ConnectionError("Not connected: listen() must be running")
+        with conn.heartbeat(message):
+            yield
+
+    async def _command(self, method: str, *args) -> None:
+        if self._listener is None or not self._listener.is_alive():
+            raise ConnectionError("Not connected: listen() must be running")
+        future = asyncio.get_running_loop().create_future()
+        self._commands.put((method, args, future))
+        await future
+
+    def _listen(self, queues, time_limit, loop, received: asyncio.Queue) -> None:
+        """Body of the listener thread."""
+
+        def deliver(item):
+            loop.call_soon_threadsafe(received.put_nowait, item)
+
+        closed = False
+
+        def run_commands(conn: MessageConnection, block: bool = False) -> bool:
+            """Run queued commands; returns True once asked to close."""
+            nonlocal closed
+            while not closed:
+                try:
+                    command = self._commands.get(block=block)
+                except queue.Empty:
+                    break
+                if command is None:
+                    closed = True
+                    break
+                method, args, future = command
+                try:
+                    getattr(conn, method)(*args)
+                except Exception as e:
+                    loop.call_soon_threadsafe(_resolve, future, e)
+                else:
+                    loop.call_soon_threadsafe(_resolve, future, None)
+                finally:
+                    self._slots.release()
+            return closed
+
+        def on_idle() -> bool:
+            run_commands(conn)
+            return self._stop.is_set()
+
+        def wait_for(semaphore: threading.Semaphore) -> bool:
+            while not semaphore.acquire(timeout=_SLOT_WAIT):
+                if on_idle():
+                    return False
+            return True
+
+        try:
+            with self.client.connect() as conn:
+                self._conn = conn
+                try:
+                    with closing(
+                        conn.listen(queues, time_limit, on_idle=on_idle)
+                    ) as messages:
+                        # Only take a message once one is wanted, and there's a slot
+                        while wait_for(self._wanted) and wait_for(self._slots):
+                            if (message := next(messages, None)) is None:
+                                break
+                            deliver(message)
+                            if on_idle():
+                                break
+                except Exception as e:
+                    deliver(e)
+                else:
+                    deliver(_END)
+                # Keep serving acks/requeues for messages we've handed out until the
+                # connection is closed
+                while not run_commands(conn, block=True):
+                    pass
+                self._conn = None
+        except Exception as e:
+            logger.exception(f"Listener thread failed: {e}")
+            deliver(e)
+
+
+def _resolve(future: asyncio.Future, error: Exception | None) -> None:
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
@@ -1,25 +1,71 @@
-import json
 import logging
+import math
 import time
-from dataclasses import dataclass
-from typing import Generator, Iterable
+from collections import deque
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Generator, Iterable
 
 import pika
 import pika.connection
 from pika.adapters.blocking_connection import BlockingChannel, BlockingConnection
 
+from dstm.client.acks import AckBuffer
 from dstm.client.base import MessageClient, MessageConnection
-from dstm.exceptions import PublishError
-from dstm.message import Message
+from dstm.client.scheduling import QueueScheduler
+from dstm.exceptions import BatchPublishError, PublishError
+from dstm.message import PRIORITY_HEADER, Message, eta_delay
+from dstm.serialization import Codec, Payload
 
 logger = logging.getLogger(__name__)
 
+# Header recording how many times a message had been delivered before it was requeued
+# or redelivered (RabbitMQ only counts deliveries itself for quorum queues)
+DELIVERY_COUNT_HEADER = "dstm-delivery-count"
+# Header in which quorum queues count a message's previous deliveries
+BROKER_DELIVERY_COUNT_HEADER = "x-delivery-count"
+
+# Seconds a time-limited listen() carries on for after republishing a redelivered
+# message, so the copy can come back to it
+REDELIVERY_GRACE = 1.0
+
+# Milliseconds after the messages in a delay queue are due that it's deleted if unused
+DELAY_QUEUE_EXPIRY = 60_000
+# Seconds after declaring a delay queue that it's declared again when next used, to
+# keep it from expiring. Until then, publishing to it needs no round trip.
+DELAY_QUEUE_REDECLARE = DELAY_QUEUE_EXPIRY / 1000 / 2
+
+# Delay queues' TTLs are at most 2 ** this milliseconds (about 25 days), well within
+# RabbitMQ's limit; messages with an ETA further off are delayed again by the worker
+# that receives them
+MAX_DELAY_EXPONENT = 31
+
+# Max seconds between calls to listen()'s on_idle callback while waiting for messages
+ON_IDLE_INTERVAL = 0.05
+
 
 class AMQPConnection(MessageConnection):
     connection: BlockingConnection
     channel: BlockingChannel
 
-    def __init__(self, parameters: pika.connection.Parameters):
+    def __init__(
+        self,
+        parameters: pika.connection.Parameters,
+        ack_batch_size: int = 1,
+        ack_max_delay: float = 1.0,
+        prefetch_count: int | None = None,
+        codec: Codec | None = None,
+        max_priority: int | None = None,
+    ):
+        self.prefetch_count = prefetch_count
+        self.max_priority = max_priority
+        self.codec = codec or Codec()
+        self._acks = AckBuffer(ack_batch_size, ack_max_delay)
+        # Delivery tags received on our channel and not yet acked/nacked
+        self._outstanding: set[int] = set()
+        # Delay queues declared on our channel -> time.monotonic() when last declared
+        self._delay_queues: dict[str, float] = {}
         try:
             self.connection = BlockingConnection(parameters)
             self.channel = self.connection.channel()
@@ -29,6 +75,10 @@ class AMQPConnection(MessageConnection):
 
     def disconnect(self) -> None:
         if self.connection and not self.connection.is_closed:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.warning(f"Failed to flush acks before disconnecting: {e}")
             self.connection.close()
             logger.debug("Disconnected from AMQP broker {self.parameters}")
 
@@ -38,54 +88,105 @@ class AMQPConnection(MessageConnection):
     def __exit__(self, type_, value, tb):
         self.disconnect()
 
+    def is_connected(self) -> bool:
+        return bool(
+            self.connection
+            and self.connection.is_open
+            and self.channel
+            and self.channel.is_open
+        )
+
     def _assert_connected(self) -> tuple[BlockingConnection, BlockingChannel]:
-        if (
-            not self.connection
-            or self.connection.is_closed
-            or not self.channel
-            or self.channel.is_closed
-        ):
+        if not self.is_connected():
             raise ConnectionError("Not connected to AMQP broker")
         return self.connection, self.channel
 
     def create_queue(self, queue: str) -> None:
         connection, channel = self._assert_connected()
-        channel.queue_declare(queue=queue, durable=True)
+        arguments = None
+        if self.max_priority is not None:
+            arguments = {"x-max-priority": self.max_priority}
+        channel.queue_declare(queue=queue, durable=True, arguments=arguments)
 
     def destroy_queue(self, queue: str) -> None:
         connection, channel = self._assert_connected()
         channel.queue_delete(queue=queue)
 
+    def _publish(
+        self, channel: BlockingChannel, message: Message, routing_key: str | None = None
+    ) -> None:
+        payload = message.payload or self.codec.encode(message.body)
+        if routing_key is None:
+            routing_key = message.queue
+            if (delay := eta_delay(message)) > 0:
+                # Rounded down, so it isn't delivered late: a worker that receives it
+                # early publishes it again for the rest of the delay
+                routing_key = self._delay_queue(
+                    channel, message.queue, delay, round_down=True
+                )
+        properties = pika.BasicProperties(
+            headers=message.headers,
+            content_type=payload.content_type,
+            content_encoding=payload.content_encoding,
+            delivery_mode=2,  # Make message persistent
+            priority=(
+                int(priority)
+                if (priority := message.headers.get(PRIORITY_HEADER)) is not None
+                else None
+            ),
+        )
+        channel.basic_publish(
+            exchange="",
+            routing_key=routing_key,
+            body=payload.data,
+            properties=properties,
+        )
+
     def publish(self, message: Message) -> None:
         connection, channel = self._assert_connected()
 
         try:
-            body = json.dumps(message.body)
-            properties = pika.BasicProperties(
-                headers=message.headers,
-                delivery_mode=2,  # Make message persistent
-            )
-
-            channel.basic_publish(
-                exchange="", routing_key=message.queue, body=body, properties=properties
-            )
-
+            self._publish(channel, message)
             logger.debug(f"Published message to queue: {message.queue}")
         except Exception as e:
             raise PublishError(f"Failed to publish message: {e}") from e
 
+    def publish_batch(self, messages: Iterable[Message]) -> None:
+        connection, channel = self._assert_connected()
+
+        # Without publisher confirms basic_publish doesn't wait for the broker, so the
+        # whole batch is pipelined onto the channel without per-message round trips
+        # (delayed messages only wait for their delay queue's first declaration).
+        count = 0
+        messages = iter(messages)
+        for message in messages:
+            try:
+                self._publish(channel, message)
+            except Exception as e:
+                # The channel is usually closed by then, so the rest aren't tried
+                unsent = [
+                    (rest, "Not sent after an earlier failure") for rest in messages
+                ]
+                raise BatchPublishError(
+                    f"Failed to publish message {count} of batch ({len(unsent)} more "
+                    f"not sent): {e}",
+                    failures=[(message, str(e)), *unsent],
+                ) from e
+            count += 1
+        logger.debug(f"Published batch of {count} messages")
+
     def listen(
         self,
         queues: Iterable[str] | str,
         time_limit: float | None = None,
+        on_idle: Callable[[], bool | None] | None = None,
     ) -> Generator[Message]:
         connection, channel = self._assert_connected()
 
         if not queues:
             return
 
-        if isinstance(queues, str):
-            queues = [queues]
+        scheduler = QueueScheduler(queues)
 
         if time_limit is not None:
             end_time = time.monotonic() + time_limit
@@ -93,53 +194,228 @@ class AMQPConnection(MessageConnection):
             end_time = None
 
         # the basic_consume API is a bit awkward - we have to receive results via a
-        # callback - so we set up this list to use as a temporary storage location
-        responses: list[tuple] = []
-
-        def store_response(ch, method, props, body):
-            responses.append((queue, method, props, body))
-
-        for queue in queues:
-            channel.basic_consume(queue, store_response)
-
-        first = True
-        while True:
-            if end_time is not None:
-                delta = end_time - time.monotonic()
-                if delta <= 0:
-                    if first:
-                        delta = 0
-                    else:
-                        break
-            else:
-                delta = None
-            first = False
-
-            connection.process_data_events(time_limit=delta)  # type: ignore
-
-            for queue, method_frame, properties, body in responses:
-                if method_frame is None:  # hit time limit
-                    return
-                try:
-                    message = Message(
-                        queue=queue,
-                        body=json.loads(body.decode("utf-8")),
-                        headers=properties.headers,
+        # callback - so we set up these deques (one per queue) to use as a temporary
+        # storage location. With prefetch_count set, the broker won't deliver more than
+        # that many unacked messages per consumer, which bounds their size.
+        responses: dict[str, deque[tuple]] = {q: deque() for q in scheduler.names}
+
+        def store_response(queue, ch, method, props, body):
+            self._outstanding.add(method.delivery_tag)
+            responses[queue].append((method, props, body))
+
+        if self.prefetch_count is not None:
+            channel.basic_qos(prefetch_count=self.prefetch_count)
+        consumer_tags = [
+            channel.basic_consume(queue, partial(store_response, queue))
+            for queue in scheduler.names
+        ]
+
+        try:
+            first = True
+            while True:
+                if end_time is not None:
+                    delta = end_time - time.monotonic()
+                    if delta <= 0:
+                        if first:
+                            delta = 0
+                        else:
+                            break
+                else:
+                    delta = None
+                first = False
+
+                if on_idle is not None:
+                    if on_idle():
+                        return
+                    # Wake up regularly so on_idle keeps getting called
+                    if delta is None or delta > ON_IDLE_INTERVAL:
+                        delta = ON_IDLE_INTERVAL
+
+                if self._acks:
+                    # Keep batching acks while messages are flowing, but send them
+                    # before we sit idle waiting for more.
+                    connection.process_data_events(time_limit=0)
+                    if not any(responses.values()):
+                        self.flush()
+                        connection.process_data_events(time_limit=delta)  # type: ignore
+                else:
+                    connection.process_data_events(time_limit=delta)  # type: ignore
+
+                while (
+                    queue := scheduler.choose([q for q, r in responses.items() if r])
+                ) is not None:
+                    method_frame, properties, body = responses[queue].popleft()
+                    headers = dict(properties.headers or {})
+                    counted_by_broker = BROKER_DELIVERY_COUNT_HEADER in headers
+                    delivered = _previous_deliveries(headers)
+                    # The body is decoded when (and if) it's first accessed
+                    message = Message.from_payload(
+                        queue,
+                        Payload(
+                            body, properties.content_type, properties.content_encoding
+                        ),
+                        self.codec.decode,
+                        headers=headers,
                         _id=method_frame.delivery_tag,
                     )
-                except Exception as e:
-                    logger.exception(f"Error parsing AMQP message: {e}")
-                else:
+                    if method_frame.redelivered and not counted_by_broker:
+                        # Returned unsettled, e.g. because its consumer crashed, by a
+                        # classic queue, which doesn't count how often. Republish it
+                        # counting that delivery, so repeated crashes add up.
+                        message.delivery_count = delivered + 1
+                        self._republish(channel, message, queue)
+                        if end_time is not None:
+                            end_time = max(
+                                end_time, time.monotonic() + REDELIVERY_GRACE
+                            )
+                        continue
+                    message.delivery_count = delivered + 1
                     yield message
-            responses.clear()
+                    if len(scheduler.names) > 1:
+                        # Pick up anything that's arrived meanwhile before choosing
+                        # the next queue, in case it's a more important one
+                        connection.process_data_events(time_limit=0)
+        finally:
+            if self.is_connected():
+                # Stop deliveries to this generator and hand back anything it was
+                # holding but never yielded, so other consumers can pick it up.
+                # Deliveries pika hasn't passed to us yet are rejected by
+                # basic_cancel, so take those first.
+                connection.process_data_events(time_limit=0)
+                for tag in consumer_tags:
+                    channel.basic_cancel(tag)
+                for queue, buffered in responses.items():
+                    for delivery in buffered:
+                        self._hand_back(channel, queue, *delivery)
 
     def ack(self, message: Message) -> None:
         connection, channel = self._assert_connected()
-        channel.basic_ack(delivery_tag=message._id)
+        if self._acks.max_size > 1:
+            if self._acks.add(message):
+                self.flush()
+        else:
+            channel.basic_ack(delivery_tag=message._id)
+            self._outstanding.discard(message._id)
 
-    def requeue(self, message: Message) -> None:
+    def flush(self) -> None:
+        if not self._acks:
+            return
+        connection, channel = self._assert_connected()
+        tags = sorted(message._id for message in self._acks.drain())
+
+        # basic_ack(multiple=True) acks *every* outstanding delivery up to the given
+        # tag, so it can only cover tags below the first delivery we're not acking
+        # (e.g. one still being processed).
+        barrier = min(self._outstanding.difference(tags), default=None)
+        below = [tag for tag in tags if barrier is None or tag < barrier]
+        if below:
+            channel.basic_ack(delivery_tag=below[-1], multiple=True)
+        for tag in tags[len(below) :]:
+            channel.basic_ack(delivery_tag=tag)
+        self._outstanding.difference_update(tags)
+        logger.debug(f"Flushed {len(tags)} acks")
+
+    def requeue(self, message: Message, delay: float = 0) -> None:
+        self.flush()
         connection, channel = self._assert_connected()
-        channel.basic_nack(delivery_tag=message._id, requeue=True)
+        if delay > 0:
+            queue = self._delay_queue(channel, message.queue, delay)
+        else:
+            queue = message.queue
+        self._republish(channel, message, queue)
+
+    def _republish(self, channel: BlockingChannel, message: Message, queue: str):
+        """Replace a received message with a copy published to `queue` (its own, or a
+        delay queue), counting its delivery so far. Unlike basic_nack, this keeps
+        count on classic queues."""
+        copy = message.copy(
+            message.queue,
+            {**message.headers, DELIVERY_COUNT_HEADER: message.delivery_count or 1},
+        )
+        self._publish(channel, copy, queue)
+        channel.basic_ack(delivery_tag=message._id)
+        self._outstanding.discard(message._id)
+
+    def _hand_back(
+        self,
+        channel: BlockingChannel,
+        queue: str,
+        method_frame,
+        properties,
+        body: bytes,
+    ) -> None:
+        """Return a delivery that was never yielded to its queue. It's republished
+        rather than nacked, which would mark it as redelivered (and count as an attempt
+        at its task, or towards x-delivery-count on quorum queues), keeping the count of
+        its previous deliveries."""
+        headers = dict(properties.headers or {})
+        counted_by_broker = BROKER_DELIVERY_COUNT_HEADER in headers
+        delivered = _previous_deliveries(headers)
+        if method_frame.redelivered and not counted_by_broker:
+            # This delivery was returned by a consumer that crashed
+            delivered += 1
+        if delivered:
+            headers[DELIVERY_COUNT_HEADER] = delivered
+        message = Message.from_payload(
+            queue,
+            Payload(body, properties.content_type, properties.content_encoding),
+            self.codec.decode,
+            headers=headers,
+        )
+        try:
+            self._publish(channel, message)
+        except Exception as e:
+            logger.warning(f"Failed to hand back message to {queue}, nacking it: {e}")
+            channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
+        else:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        self._outstanding.discard(method_frame.delivery_tag)
+
+    def _delay_queue(
+        self,
+        channel: BlockingChannel,
+        queue: str,
+        delay: float,
+        round_down: bool = False,
+    ) -> str:
+        """Declare a queue where messages wait for about `delay` seconds, then are
+        dead-lettered back to `queue`. Delays are rounded to a power of two
+        milliseconds (down, if `round_down`), so each queue only needs a few of
+        these."""
+        exponent = math.log2(max(delay * 1000, 1))
+        ttl = 2 ** min(
+            math.floor(exponent) if round_down else round(exponent),
+            MAX_DELAY_EXPONENT,
+        )
+        name = f"{queue}.delay-{ttl}ms"
+        # Declared again every so often, since the queue is deleted once it hasn't been
+        # declared for a while longer than messages stay in it
+        now = time.monotonic()
+        if now - self._delay_queues.get(name, -math.inf) < DELAY_QUEUE_REDECLARE:
+            return name
+        channel.queue_declare(
+            queue=name,
+            durable=True,
+            arguments={
+                "x-message-ttl": ttl,
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue,
+                "x-expires": ttl + DELAY_QUEUE_EXPIRY,
+            },
+        )
+        self._delay_queues[name] = now
+        return name
+
+    def heartbeat(self, message: Message) -> nullcontext[None]:
+        # Unacked deliveries stay with us for as long as the channel is open
+        return nullcontext()
+
+
+def _previous_deliveries(headers: dict) -> int:
+    """Remove the headers counting a message's previous deliveries, returning their
+    total."""
+    delivered = int(headers.pop(DELIVERY_COUNT_HEADER, 0))
+    return delivered + int(headers.pop(BROKER_DELIVERY_COUNT_HEADER, 0))
 
 
 @dataclass
@@ -147,9 +423,27 @@ class AMQPClient(MessageClient):
     """AMQP client using pika."""
 
     parameters: pika.connection.Parameters
+    ack_batch_size: int = 1
+    ack_max_delay: float = 1.0
+    # Max unacked messages the broker will push to each consumer (i.e. per queue being
+    # listened to); None means unlimited.
+    prefetch_count: int | None = 10
+    # If set, queues are created supporting message priorities from 0 to this (at most
+    # 255; RabbitMQ recommends 10 or less), set by the dstm-priority header. Existing
+    # queues must be deleted and recreated to change this.
+    max_priority: int | None = None
+    # How message bodies are serialized (and optionally compressed) when publishing
+    codec: Codec = field(default_factory=Codec)
 
     def __repr__(self):
         return f"AMQPClient({self.parameters.host})"
 
     def connect(self) -> AMQPConnection:
-        return AMQPConnection(self.parameters)
+        return AMQPConnection(
+            self.parameters,
+            ack_batch_size=self.ack_batch_size,
+            ack_max_delay=self.ack_max_delay,
+            prefetch_count=self.prefetch_count,
+            codec=self.codec,
+            max_priority=self.max_priority,
+        )
@@ -1,31 +1,65 @@
-from typing import Generator, Iterable, Protocol, TypeVar
+from contextlib import AbstractAsyncContextManager, AbstractContextManager
+from typing import AsyncGenerator, Callable, Generator, Iterable, Protocol, TypeVar
 
 from dstm.message import Message
 
 TConn = TypeVar("TConn", bound="MessageConnection")
+TAsyncConn = TypeVar("TAsyncConn", bound="AsyncMessageConnection")
 
 
 class MessageConnection(Protocol):
     def __enter__(self: TConn) -> TConn: ...
     def __exit__(self, type_, value, tb): ...
 
+    def disconnect(self) -> None:
+        """Close the connection."""
+        ...
+
+    def is_connected(self) -> bool:
+        """Whether the connection is still usable."""
+        ...
+
     def publish(self, message: Message) -> None:
         """Publish a message to a queue."""
         ...
 
+    def publish_batch(self, messages: Iterable[Message]) -> None:
+        """Publish many messages, possibly to different queues, using as few round
+        trips as the broker allows. Raises BatchPublishError listing the messages that
+        failed if some (but not necessarily all) could not be published."""
+        ...
+
     def listen(
-        self, queues: Iterable[str] | str, time_limit: int | None = None
+        self,
+        queues: Iterable[str] | str,
+        time_limit: int | None = None,
+        on_idle: Callable[[], bool | None] | None = None,
     ) -> Generator[Message]:
         """Listen for messages on one or more queues. Blocks while listening, then
-        yields message contents and repeats."""
+        yields message contents and repeats.
+
+        If given, `on_idle` is called periodically from the listening thread while
+        waiting for messages, e.g. so the caller can ack messages handled elsewhere.
+        Listening stops if it returns True."""
         ...
 
     def ack(self, message: Message) -> None:
         """Acknowledge that a message has been handled successfully."""
         ...
 
-    def requeue(self, message: Message) -> None:
-        """Tell the broker that a message should be requeued."""
+    def requeue(self, message: Message, delay: float = 0) -> None:
+        """Tell the broker that a message should be requeued, to be delivered again
+        after `delay` seconds (roughly: brokers may round it)."""
+        ...
+
+    def flush(self) -> None:
+        """Send any acknowledgements that are being buffered to be sent in a batch."""
+        ...
+
+    def heartbeat(self, message: Message) -> AbstractContextManager[None]:
+        """Keep a received message from being redelivered to another consumer while
+        the block runs, e.g. by periodically extending its visibility timeout. Unlike
+        the other methods, this may be used from any thread."""
         ...
 
     def create_queue(self, queue: str) -> None:
@@ -41,3 +75,40 @@ class MessageClient(Protocol):
     def connect(self) -> MessageConnection:
         """Establish connection to the messaging system."""
         ...
+
+
+class AsyncMessageConnection(Protocol):
+    """asyncio equivalent of MessageConnection."""
+
+    async def __aenter__(self: TAsyncConn) -> TAsyncConn: ...
+    async def __aexit__(self, type_, value, tb): ...
+
+    async def publish(self, message: Message) -> None:
+        """Publish a message to a queue."""
+        ...
+
+    def listen(
+        self, queues: Iterable[str] | str, time_limit: float | None = None
+    ) -> AsyncGenerator[Message]:
+        """Listen for messages on one or more queues, yielding them as they arrive."""
+        ...
+
+    async def ack(self, message: Message) -> None:
+        """Acknowledge that a message has been handled successfully."""
+        ...
+
+    async def requeue(self, message: Message, delay: float = 0) -> None:
+        """Tell the broker that a message should be requeued, to be delivered again
+        after `delay` seconds."""
+        ...
+
+    def heartbeat(self, message: Message) -> AbstractAsyncContextManager[None]:
+        """Keep a received message from being redelivered to another consumer while
+        the block runs."""
+        ...
+
+
+class AsyncMessageClient(Protocol):
+    def connect_async(self) -> AsyncMessageConnection:
+        """Establish an asyncio connection to the messaging system."""
+        ...
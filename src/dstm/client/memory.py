@@ -0,0 +1,312 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Generator, Iterable
+
+from dstm.client.base import MessageClient, MessageConnection
+from dstm.client.scheduling import QueueScheduler
+from dstm.exceptions import BatchPublishError, ConnectionError, PublishError
+from dstm.message import Message, eta_delay
+from dstm.serialization import Codec, Payload
+
+logger = logging.getLogger(__name__)
+
+# Max seconds between calls to listen()'s on_idle callback while waiting for messages
+ON_IDLE_INTERVAL = 0.05
+
+
+@dataclass
+class _Entry:
+    """A message sitting in a MemoryBroker queue."""
+
+    payload: Payload
+    headers: dict[str, Any]
+    receive_count: int = 0
+
+
+@dataclass
+class _Delivery:
+    """A message that has been received but not yet acked or requeued."""
+
+    queue: str
+    entry: _Entry
+    connection: "MemoryConnection"
+    deadline: float | None
+
+
+class MemoryBroker:
+    """In-process message store shared by the connections of one or more MemoryClients.
+
+    Bodies are stored encoded, just like on a real broker, so tasks that work here will
+    also survive the trip through AMQP or SQS."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.queues: dict[str, deque[_Entry]] = {}
+        self.unacked: dict[int, _Delivery] = {}
+        self.delivery_ids = itertools.count()
+        # Heap of (due time, id, queue, entry) for messages requeued with a delay
+        self.delayed: list[tuple[float, int, str, _Entry]] = []
+
+    def _requeue_expired(self) -> float | None:
+        """Return deliveries whose visibility timeout has passed, and delayed messages
+        that are due, to their queues. Returns the time until the next one expires, if
+        any. Call with cond held."""
+        now = time.monotonic()
+        next_expiry = None
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, queue_name, entry = heapq.heappop(self.delayed)
+            if (queue := self.queues.get(queue_name)) is not None:
+                queue.append(entry)
+        if self.delayed:
+            next_expiry = self.delayed[0][0] - now
+        for delivery_id, delivery in list(self.unacked.items()):
+            if delivery.deadline is None:
+                continue
+            if delivery.deadline <= now:
+                del self.unacked[delivery_id]
+                self._return(delivery)
+            elif next_expiry is None or delivery.deadline - now < next_expiry:
+                next_expiry = delivery.deadline - now
+        return next_expiry
+
+    def _enqueue(self, queue: str, entry: _Entry, delay: float = 0) -> None:
+        """Add a message to a queue, after `delay` seconds if that's positive. Call
+        with cond held."""
+        messages = self.queues.setdefault(queue, deque())
+        if delay > 0:
+            due = time.monotonic() + delay
+            heapq.heappush(self.delayed, (due, next(self.delivery_ids), queue, entry))
+        else:
+            messages.append(entry)
+
+    def _return(self, delivery: _Delivery) -> None:
+        """Put an unacked message back at the front of its queue. Call with cond
+        held."""
+        if (queue := self.queues.get(delivery.queue)) is not None:
+            queue.appendleft(delivery.entry)
+            self.cond.notify_all()
+
+
+# Brokers for memory:// URIs, by name, so clients made from the same URI share messages
+_named_brokers: dict[str, MemoryBroker] = {}
+_named_brokers_lock = threading.Lock()
+
+
+def named_broker(name: str) -> MemoryBroker:
+    with _named_brokers_lock:
+        return _named_brokers.setdefault(name, MemoryBroker())
+
+
+@dataclass
+class MemoryClient(MessageClient):
+    """Client for an in-process MemoryBroker, for running tasks locally and testing.
+
+    Unacked messages are returned to their queue when the connection that received them
+    is closed (as with AMQP), or after `visibility_timeout` seconds if that is set (as
+    with SQS)."""
+
+    broker: MemoryBroker = field(default_factory=MemoryBroker)
+    visibility_timeout: float | None = None
+    # How message bodies are serialized (and optionally compressed) when publishing
+    codec: Codec = field(default_factory=Codec)
+
+    def __repr__(self):
+        return "MemoryClient()"
+
+    def connect(self) -> "MemoryConnection":
+        return MemoryConnection(self)
+
+
+class MemoryConnection(MessageConnection):
+    def __init__(self, client: MemoryClient):
+        self.client = client
+        self.broker = client.broker
+        self.open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.disconnect()
+
+    def disconnect(self) -> None:
+        if not self.open:
+            return
+        self.open = False
+        with self.broker.cond:
+            for delivery_id, delivery in list(self.broker.unacked.items()):
+                if delivery.connection is self:
+                    del self.broker.unacked[delivery_id]
+                    self.broker._return(delivery)
+
+    def is_connected(self) -> bool:
+        return self.open
+
+    def _assert_connected(self) -> None:
+        if not self.open:
+            raise ConnectionError("Memory connection has been closed")
+
+    def create_queue(self, queue: str) -> None:
+        self._assert_connected()
+        with self.broker.cond:
+            self.broker.queues.setdefault(queue, deque())
+
+    def destroy_queue(self, queue: str) -> None:
+        self._assert_connected()
+        with self.broker.cond:
+            self.broker.queues.pop(queue, None)
+
+    def _entry(self, message: Message) -> _Entry:
+        payload = message.payload or self.client.codec.encode(message.body)
+        return _Entry(payload, dict(message.headers))
+
+    def publish(self, message: Message) -> None:
+        self._assert_connected()
+        try:
+            entry = self._entry(message)
+        except Exception as e:
+            raise PublishError(f"Failed to publish message: {e}") from e
+        with self.broker.cond:
+            self.broker._enqueue(message.queue, entry, eta_delay(message))
+            self.broker.cond.notify_all()
+
+    def publish_batch(self, messages: Iterable[Message]) -> None:
+        self._assert_connected()
+        entries = []
+        failures = []
+        for message in messages:
+            try:
+                entries.append(
+                    (message.queue, self._entry(message), eta_delay(message))
+                )
+            except Exception as e:
+                failures.append((message, str(e)))
+        with self.broker.cond:
+            for queue, entry, delay in entries:
+                self.broker._enqueue(queue, entry, delay)
+            self.broker.cond.notify_all()
+        if failures:
+            raise BatchPublishError(
+                f"Failed to publish {len(failures)} messages: {failures[0][1]}",
+                failures=failures,
+            )
+
+    def _receive(self, scheduler: QueueScheduler) -> Message | None:
+        """Take a message from whichever queue the scheduler picks out of those with
+        any available. Call with cond held."""
+        queue = scheduler.choose(
+            [queue for queue in scheduler.names if self.broker.queues.get(queue)]
+        )
+        if queue is None:
+            return None
+        entry = self.broker.queues[queue].popleft()
+        entry.receive_count += 1
+        timeout = self.client.visibility_timeout
+        delivery_id = next(self.broker.delivery_ids)
+        self.broker.unacked[delivery_id] = _Delivery(
+            queue,
+            entry,
+            self,
+            None if timeout is None else time.monotonic() + timeout,
+        )
+        message = Message.from_payload(
+            queue,
+            entry.payload,
+            self.client.codec.decode,
+            headers=dict(entry.headers),
+            _id=delivery_id,
+        )
+        message.delivery_count = entry.receive_count
+        return message
+
+    def listen(
+        self,
+        queues: Iterable[str] | str,
+        time_limit: float | None = None,
+        on_idle: Callable[[], bool | None] | None = None,
+    ) -> Generator[Message]:
+        self._assert_connected()
+
+        if not queues:
+            return
+
+        scheduler = QueueScheduler(queues)
+
+        if time_limit is not None:
+            end_time = time.monotonic() + time_limit
+        else:
+            end_time = None
+
+        first = True
+        while self.open:
+            with self.broker.cond:
+                next_expiry = self.broker._requeue_expired()
+                message = self._receive(scheduler)
+                if message is None:
+                    if end_time is not None:
+                        delta = end_time - time.monotonic()
+                        if delta <= 0 and not first:
+                            break
+                    else:
+                        delta = None
+                    waits = [
+                        w
+                        for w in (
+                            delta,
+                            next_expiry,
+                            ON_IDLE_INTERVAL if on_idle is not None else None,
+                        )
+                        if w is not None
+                    ]
+                    if not first:
+                        self.broker.cond.wait(min(waits) if waits else None)
+            first = False
+            if message is not None:
+                yield message
+                # Don't let a backlog keep us listening past the time limit (though
+                # with a limit of 0, take whatever's available without waiting)
+                if time_limit and end_time is not None and time.monotonic() >= end_time:
+                    break
+            elif on_idle is not None and on_idle():
+                return
+
+    def ack(self, message: Message) -> None:
+        with self.broker.cond:
+            self.broker.unacked.pop(message._id, None)
+
+    def requeue(self, message: Message, delay: float = 0) -> None:
+        with self.broker.cond:
+            if (delivery := self.broker.unacked.pop(message._id, None)) is None:
+                return
+            if delay > 0:
+                self.broker._enqueue(delivery.queue, delivery.entry, delay)
+                # Wake listeners so they wait until it's due
+                self.broker.cond.notify_all()
+            else:
+                self.broker._return(delivery)
+
+    def flush(self) -> None:
+        pass  # Acks aren't buffered
+
+    @contextmanager
+    def heartbeat(self, message: Message) -> Generator[None]:
+        """Suspend the message's visibility timeout while the block runs, restarting
+        it afterwards."""
+        with self.broker.cond:
+            if (delivery := self.broker.unacked.get(message._id)) is not None:
+                delivery.deadline = None
+        try:
+            yield
+        finally:
+            timeout = self.client.visibility_timeout
+            with self.broker.cond:
+                if (delivery := self.broker.unacked.get(message._id)) is not None:
+                    delivery.deadline = (
+                        None if timeout is None else time.monotonic() + timeout
+                    )
@@ -0,0 +1,146 @@
+import logging
+import threading
+import time
+from contextlib import AbstractContextManager
+from dataclasses import dataclass, field
+from typing import Callable, Generator, Iterable
+
+from dstm.client.base import MessageClient, MessageConnection
+from dstm.exceptions import ConnectionError
+from dstm.message import Message
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PooledClient(MessageClient):
+    """Wraps another MessageClient, keeping a pool of long-lived connections that are
+    reused between calls to connect() instead of being opened and closed each time.
+
+    Each connection is only ever used by one thread at a time; if more threads need a
+    connection than there are idle ones, extra connections are opened, and at most
+    `max_size` of them are kept around once released. Idle connections older than
+    `idle_timeout` seconds are closed rather than reused (pika's BlockingConnection
+    can't service heartbeats while idle, so the broker may have dropped them), and
+    dead connections are discarded and replaced lazily on the next connect()."""
+
+    client: MessageClient
+    max_size: int = 4
+    idle_timeout: float | None = 30
+
+    _idle: list[tuple[MessageConnection, float]] = field(
+        default_factory=list, init=False, repr=False
+    )
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __repr__(self):
+        return f"PooledClient({self.client!r})"
+
+    def connect(self) -> "PooledConnection":
+        return PooledConnection(self, self._acquire())
+
+    def _acquire(self) -> MessageConnection:
+        stale = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, released_at = self._idle.pop()
+                if (
+                    self.idle_timeout is not None
+                    and time.monotonic() - released_at > self.idle_timeout
+                ) or not candidate.is_connected():
+                    stale.append(candidate)
+                else:
+                    conn = candidate
+                    break
+        for candidate in stale:
+            _disconnect_quietly(candidate)
+        if conn is None:
+            conn = self.client.connect()
+            logger.debug(f"{self!r} opened a new connection")
+        return conn
+
+    def _release(self, conn: MessageConnection) -> None:
+        if conn.is_connected():
+            with self._lock:
+                if len(self._idle) < self.max_size:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        _disconnect_quietly(conn)
+
+    def close(self) -> None:
+        """Close all idle connections. Connections currently in use are closed when
+        they are released."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            _disconnect_quietly(conn)
+
+
+class PooledConnection:
+    """A connection borrowed from a PooledClient; returned to the pool on exit."""
+
+    def __init__(self, pool: PooledClient, conn: MessageConnection):
+        self.pool = pool
+        self.conn: MessageConnection | None = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.disconnect()
+
+    def _borrowed(self) -> MessageConnection:
+        if self.conn is None:
+            raise ConnectionError("Pooled connection has already been released")
+        return self.conn
+
+    def is_connected(self) -> bool:
+        return self.conn is not None and self.conn.is_connected()
+
+    def disconnect(self) -> None:
+        # "Disconnecting" a borrowed connection just hands it back to the pool
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            self.pool._release(conn)
+
+    def publish(self, message: Message) -> None:
+        self._borrowed().publish(message)
+
+    def publish_batch(self, messages: Iterable[Message]) -> None:
+        self._borrowed().publish_batch(messages)
+
+    def listen(
+        self,
+        queues: Iterable[str] | str,
+        time_limit: int | None = None,
+        on_idle: Callable[[], bool | None] | None = None,
+    ) -> Generator[Message]:
+        return self._borrowed().listen(queues, time_limit=time_limit, on_idle=on_idle)
+
+    def ack(self, message: Message) -> None:
+        self._borrowed().ack(message)
+
+    def requeue(self, message: Message, delay: float = 0) -> None:
+        self._borrowed().requeue(message, delay)
+
+    def flush(self) -> None:
+        self._borrowed().flush()
+
+    def heartbeat(self, message: Message) -> AbstractContextManager[None]:
+        return self._borrowed().heartbeat(message)
+
+    def create_queue(self, queue: str) -> None:
+        self._borrowed().create_queue(queue)
+
+    def destroy_queue(self, queue: str) -> None:
+        self._borrowed().destroy_queue(queue)
+
+
+def _disconnect_quietly(conn: MessageConnection) -> None:
+    try:
+        conn.disconnect()
+    except Exception as e:
+        logger.debug(f"Ignoring error while closing pooled connection: {e}")
@@ -0,0 +1,56 @@
+"""Choosing which queue to take the next message from, when listening to several.
+
+listen() accepts a mapping of queue names to weights instead of a list of names. While
+several queues have messages waiting, each is then taken from in proportion to its
+weight, e.g. with {"high": 10, "default": 3, "bulk": 1} a backlog on "bulk" only gets
+one turn in fourteen. With QueuePriorities the weights are instead strict priorities:
+messages are only taken from a queue while no queue of higher priority has any."""
+
+from collections.abc import Collection, Iterable, Mapping
+
+
+class QueuePriorities(dict[str, int]):
+    """Queue names mapped to strict priorities (higher first), for listen()."""
+
+
+class QueueScheduler:
+    """Chooses between the queues given to listen() using smooth weighted round-robin,
+    so a queue's turns are spread out rather than bunched together. Queues given as a
+    plain list all have weight 1, i.e. are taken from in turn."""
+
+    def __init__(self, queues: Iterable[str] | str):
+        if isinstance(queues, str):
+            queues = [queues]
+        if isinstance(queues, Mapping):
+            self.weights = dict(queues)
+        else:
+            self.weights = dict.fromkeys(queues, 1)
+        self.strict = isinstance(queues, QueuePriorities)
+        for queue, weight in self.weights.items():
+            if weight < 1 and not self.strict:
+                raise ValueError(f"Queue {queue!r} must have a weight of at least 1")
+        #: The queue names, in the order given
+        self.names = list(self.weights)
+        self._credit = dict.fromkeys(self.names, 0)
+
+    def choose(self, ready: Collection[str]) -> str | None:
+        """Pick which of the `ready` queues (those with messages available) to take
+        a message from next, or None if there are none."""
+        candidates = [queue for queue in self.names if queue in ready]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        if self.strict:
+            top = max(self.weights[queue] for queue in candidates)
+            candidates = [queue for queue in candidates if self.weights[queue] == top]
+        best = candidates[0]
+        total = 0
+        for queue in candidates:
+            # Queues tied on priority are left with the same weight, which may be
+            # zero or negative, so take from them in turn instead
+            weight = 1 if self.strict else self.weights[queue]
+            self._credit[queue] += weight
+            total += weight
+            if self._credit[queue] > self._credit[best]:
+                best = queue
+        self._credit[best] -= total
+        return best
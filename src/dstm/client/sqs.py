@@ -1,19 +1,126 @@
-import json
+import base64
+import binascii
+import itertools
 import logging
+import math
+import threading
 import time
+import warnings
+from collections import deque
+from contextlib import AbstractContextManager, contextmanager, nullcontext
 from dataclasses import dataclass, field
-from typing import TYPE_CHECKING, Generator, Iterable
+from functools import partial
+from queue import Empty, Queue
+from typing import TYPE_CHECKING, Any, Callable, Generator, Iterable, TypeVar
 
+from dstm.client.acks import AckBuffer
 from dstm.client.base import MessageClient, MessageConnection
-from dstm.exceptions import PublishError
-from dstm.message import Message
+from dstm.client.scheduling import QueueScheduler
+from dstm.exceptions import BatchPublishError, PublishError
+from dstm.message import Message, eta_delay
+from dstm.serialization import JSON, Codec, Payload
 
 if TYPE_CHECKING:
     import mypy_boto3_sqs.client
-    from mypy_boto3_sqs.type_defs import MessageAttributeValueTypeDef
+    from mypy_boto3_sqs.type_defs import (
+        MessageAttributeValueTypeDef,
+        SendMessageBatchRequestEntryTypeDef,
+    )
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# A message to send, with the body and attributes it's encoded as
+_Encoded = tuple[Message, str, dict[str, "MessageAttributeValueTypeDef"]]
+
+# Maximum number of entries in a single SendMessageBatch/DeleteMessageBatch request
+SQS_BATCH_SIZE = 10
+# Maximum total size in bytes of the messages (bodies and attributes) sent by a single
+# SendMessageBatch request. SQS allows up to 1 MiB, but only 256 KiB on queues created
+# before that limit was raised, unless their MaximumMessageSize has been increased.
+MAX_BATCH_BYTES = 256 * 1024
+
+# Message attributes recording how a message body was encoded, when it isn't plain JSON.
+# SQS bodies must be text, so such bodies are also base64-encoded.
+CONTENT_TYPE_ATTRIBUTE = "dstm-content-type"
+CONTENT_ENCODING_ATTRIBUTE = "dstm-content-encoding"
+# Message attribute counting deliveries of a message before it was handed back (see
+# SQSConnection._hand_back), which its ApproximateReceiveCount no longer includes
+DELIVERY_COUNT_ATTRIBUTE = "dstm-delivery-count"
+
+# The longest SQS allows a message to be kept invisible, in seconds
+MAX_VISIBILITY_TIMEOUT = 12 * 60 * 60
+
+# The longest SQS allows a message's delivery to be delayed, in seconds. Messages with
+# an ETA further off than this are delayed again by the worker that receives them.
+MAX_DELAY_SECONDS = 15 * 60
+
+# Seconds of visibility timeout unhandled messages must have left for listen() to hand
+# them back by republishing them, rather than just making them visible again
+HAND_BACK_MARGIN = 1.0
+
+# Max seconds between calls to listen()'s on_idle callback while waiting for messages
+ON_IDLE_INTERVAL = 0.05
+
+
+@dataclass
+class _Batch:
+    """Messages received by one ReceiveMessage call, waiting to be yielded."""
+
+    queue: str
+    queue_url: str
+    messages: list
+    # Number of messages originally received
+    count: int = field(init=False)
+    # When the messages still in the batch become visible to other consumers again
+    visible_until: float
+    # Guards `messages`, which the poller extends/releases while listen() yields them
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    started: threading.Event = field(default_factory=threading.Event)
+    handled: threading.Event = field(default_factory=threading.Event)
+    started_at: float = 0.0
+
+    def __post_init__(self):
+        self.count = len(self.messages)
+
+    def take(self) -> dict | None:
+        with self.lock:
+            return self.messages.pop(0) if self.messages else None
+
+
+@dataclass
+class _BatchSizer:
+    """Chooses how many messages to ask for in each ReceiveMessage call.
+
+    Starts at one message and grows while receives come back full (i.e. there's a
+    backlog), shrinking again when they don't. The size is also capped so a batch can
+    normally be worked through within half the visibility timeout, based on how long
+    recent batches took per message."""
+
+    maximum: int
+    visibility_timeout: float
+    size: int = 1
+    seconds_per_message: float | None = None
+
+    def received(self, count: int) -> None:
+        if count >= self.size:
+            self.size = min(self.size * 2, self.maximum)
+        else:
+            self.size = max(count, 1)
+        if self.seconds_per_message and self.visibility_timeout > 0:
+            fit = int(self.visibility_timeout / 2 / self.seconds_per_message)
+            self.size = max(1, min(self.size, fit))
+
+    def handled(self, count: int, seconds: float) -> None:
+        per_message = seconds / max(count, 1)
+        if self.seconds_per_message is None:
+            self.seconds_per_message = per_message
+        else:
+            self.seconds_per_message = (
+                0.7 * self.seconds_per_message + 0.3 * per_message
+            )
+
 
 def _client():
     import boto3
@@ -27,9 +134,45 @@ class SQSClient(MessageClient):
 
     client: "mypy_boto3_sqs.client.SQSClient" = field(default_factory=_client)
     long_poll_time: int = 5
-    max_messages_per_request: int = 1
+    # Messages per ReceiveMessage call (SQS allows at most 10). With adaptive_batching,
+    # the number requested varies between 1 and this (by default 10) depending on the
+    # backlog and how quickly messages are handled; without it, this many (by default
+    # 1) are always requested.
+    max_messages_per_request: int | None = None
+    adaptive_batching: bool = True
+    # Batches each queue's poller receives ahead of those listen() has started on, so
+    # they're ready when it needs them; 0 to only receive another once it's finished
+    # the last. Messages received but not yet yielded when listen() stops are handed
+    # back by republishing them (so that receipt isn't counted as a delivery), giving
+    # them new message IDs, or otherwise (e.g. if their visibility timeout has nearly
+    # run out) by making them visible again (so it is).
+    prefetch_batches: int = 1
     visibility_timeout: int = 30
-    short_poll_sleep_seconds: float = 1
+    # Deprecated and ignored: multiple queues are now long-polled concurrently
+    short_poll_sleep_seconds: float | None = None
+    cache_queue_urls: bool = True
+    ack_batch_size: int = 1
+    ack_max_delay: float = 1.0
+    # Seconds between extensions of the visibility timeout of messages being worked on
+    # (see SQSConnection.heartbeat); a third of visibility_timeout if not set, and 0
+    # disables them. This lets visibility_timeout be kept short, so messages held by a
+    # crashed worker are retried promptly, without long tasks being redelivered while
+    # they're still running.
+    heartbeat_interval: float | None = None
+    # How message bodies are serialized (and optionally compressed) when publishing
+    codec: Codec = field(default_factory=Codec)
+
+    # Queue name -> URL, shared by all connections made from this client
+    _queue_urls: dict[str, str] = field(default_factory=dict, init=False, repr=False)
+
+    def __post_init__(self):
+        if self.short_poll_sleep_seconds is not None:
+            warnings.warn(
+                "SQSClient.short_poll_sleep_seconds is deprecated and ignored, since "
+                "queues are now long-polled concurrently",
+                DeprecationWarning,
+                stacklevel=3,
+            )
 
     def connect(self):
         return SQSConnection(self)
@@ -38,6 +181,14 @@ class SQSClient(MessageClient):
 @dataclass
 class SQSConnection(MessageConnection):
     client: SQSClient
+    _acks: AckBuffer = field(init=False, repr=False)
+    _heartbeats: "_Heartbeats | None" = field(default=None, init=False, repr=False)
+    _heartbeats_lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False
+    )
+
+    def __post_init__(self):
+        self._acks = AckBuffer(self.client.ack_batch_size, self.client.ack_max_delay)
 
     @property
     def botoc(self):
@@ -47,20 +198,76 @@ class SQSConnection(MessageConnection):
         return "SQSClient"
 
     def disconnect(self) -> None:
-        pass  # No persistent connection required
+        # No persistent connection, but we may have some acks to send
+        self.flush()
+        if self._heartbeats is not None:
+            self._heartbeats.close()
+            self._heartbeats = None
+
+    def is_connected(self) -> bool:
+        return True
 
     def __enter__(self):
         return self
 
     def __exit__(self, type_, value, tb):
-        pass
+        self.disconnect()
 
     def _get_queue_url(self, queue_name: str) -> str:
+        if url := self.client._queue_urls.get(queue_name):
+            return url
         try:
             response = self.botoc.get_queue_url(QueueName=queue_name)
         except self.botoc.exceptions.QueueDoesNotExist:
             response = self.botoc.create_queue(QueueName=queue_name)
-        return response["QueueUrl"]
+        return self._remember_queue_url(queue_name, response["QueueUrl"])
+
+    def _remember_queue_url(self, queue_name: str, url: str) -> str:
+        if self.client.cache_queue_urls:
+            self.client._queue_urls[queue_name] = url
+        return url
+
+    def _forget_queue_url(self, queue_name: str) -> None:
+        self.client._queue_urls.pop(queue_name, None)
+
+    def _with_queue_url(self, queue_name: str, func: Callable[[str], T]) -> T:
+        """Call func with the URL of the named queue. If the queue turns out not to
+        exist (e.g. the cached URL is stale because it was deleted), drop the cached URL
+        and retry once with a freshly resolved one."""
+        try:
+            return func(self._get_queue_url(queue_name))
+        except self.botoc.exceptions.QueueDoesNotExist:
+            if queue_name not in self.client._queue_urls:
+                raise
+            logger.debug(f"Cached URL for SQS queue {queue_name} is stale, refreshing")
+            self._forget_queue_url(queue_name)
+            return func(self._get_queue_url(queue_name))
+
+    def _encode(
+        self, message: Message
+    ) -> tuple[str, dict[str, "MessageAttributeValueTypeDef"]]:
+        """Get the body and attributes to send to SQS for a message."""
+        attributes: dict[str, "MessageAttributeValueTypeDef"] = {
+            key: {
+                "StringValue": str(value),
+                "DataType": "String",
+            }
+            for key, value in message.headers.items()
+        }
+        payload = message.payload or self.client.codec.encode(message.body)
+        if payload.content_type == JSON and payload.content_encoding is None:
+            # Sent as is, so older consumers can still read it
+            return payload.data.decode("utf-8"), attributes
+        attributes[CONTENT_TYPE_ATTRIBUTE] = {
+            "StringValue": payload.content_type,
+            "DataType": "String",
+        }
+        if payload.content_encoding is not None:
+            attributes[CONTENT_ENCODING_ATTRIBUTE] = {
+                "StringValue": payload.content_encoding,
+                "DataType": "String",
+            }
+        return base64.b64encode(payload.data).decode("ascii"), attributes
 
     def publish(self, message: Message) -> None:
         """Publish message to SQS queue."""
@@ -68,126 +275,593 @@ class SQSConnection(MessageConnection):
             raise ConnectionError("Not connected to SQS")
 
         try:
-            queue_url = self._get_queue_url(message.queue)
-
-            # Prepare message
-            message_body = json.dumps(message.body)
-            message_attributes: dict[str, "MessageAttributeValueTypeDef"] = {
-                key: {
-                    "StringValue": str(value),
-                    "DataType": "String",
-                }
-                for key, value in message.headers.items()
-            }
+            message_body, message_attributes = self._encode(message)
 
             # Send message
-            self.botoc.send_message(
-                QueueUrl=queue_url,
-                MessageBody=message_body,
-                MessageAttributes=message_attributes,
+            self._with_queue_url(
+                message.queue,
+                lambda queue_url: self.botoc.send_message(
+                    QueueUrl=queue_url,
+                    MessageBody=message_body,
+                    MessageAttributes=message_attributes,
+                    DelaySeconds=_delay_seconds(message),
+                ),
             )
 
             logger.debug(f"Published message to SQS queue: {message.queue}")
         except Exception as e:
             raise PublishError(f"Failed to publish message: {e}") from e
 
+    def publish_batch(self, messages: Iterable[Message]) -> None:
+        """Publish messages using SendMessageBatch, in chunks of up to 10 per queue
+        (fewer if they'd exceed MAX_BATCH_BYTES)."""
+        if not self.botoc:
+            raise ConnectionError("Not connected to SQS")
+
+        # Queue -> encoded messages waiting to be sent, and their total size
+        pending: dict[str, tuple[list[_Encoded], int]] = {}
+        failures: list[tuple[Message, str]] = []
+        for message in messages:
+            try:
+                body, attributes = self._encode(message)
+            except Exception as e:
+                failures.append((message, str(e)))
+                continue
+            size = _entry_size(body, attributes)
+            chunk, total = pending.pop(message.queue, ([], 0))
+            if chunk and total + size > MAX_BATCH_BYTES:
+                failures.extend(self._send_batch(message.queue, chunk))
+                chunk, total = [], 0
+            chunk.append((message, body, attributes))
+            if len(chunk) == SQS_BATCH_SIZE:
+                failures.extend(self._send_batch(message.queue, chunk))
+            else:
+                pending[message.queue] = (chunk, total + size)
+        for queue, (chunk, _) in pending.items():
+            failures.extend(self._send_batch(queue, chunk))
+
+        if failures:
+            raise BatchPublishError(
+                f"Failed to publish {len(failures)} messages: {failures[0][1]}",
+                failures=failures,
+            )
+
+    def _send_batch(
+        self, queue: str, chunk: list[_Encoded]
+    ) -> list[tuple[Message, str]]:
+        entries: list["SendMessageBatchRequestEntryTypeDef"] = [
+            {
+                "Id": str(i),
+                "MessageBody": body,
+                "MessageAttributes": attributes,
+                "DelaySeconds": _delay_seconds(message),
+            }
+            for i, (message, body, attributes) in enumerate(chunk)
+        ]
+        try:
+            response = self._with_queue_url(
+                queue,
+                lambda queue_url: self.botoc.send_message_batch(
+                    QueueUrl=queue_url, Entries=entries
+                ),
+            )
+        except Exception as e:
+            return [(message, str(e)) for message, _, _ in chunk]
+
+        logger.debug(f"Published batch of {len(chunk)} messages to SQS queue: {queue}")
+        return [
+            (chunk[int(entry["Id"])][0], f"{entry['Code']}: {entry.get('Message', '')}")
+            for entry in response.get("Failed", [])
+        ]
+
     def create_queue(self, queue: str) -> None:
-        self.botoc.create_queue(QueueName=queue)
+        response = self.botoc.create_queue(QueueName=queue)
+        # Pre-resolve the URL so publishing/listening doesn't need to look it up
+        queue_url = self._remember_queue_url(queue, response["QueueUrl"])
         logger.debug(f"Setting VisibilityTimeout={self.client.visibility_timeout}")
         self.botoc.set_queue_attributes(
-            QueueUrl=self._get_queue_url(queue),
+            QueueUrl=queue_url,
             Attributes={"VisibilityTimeout": str(self.client.visibility_timeout)},
         )
 
     def destroy_queue(self, queue: str) -> None:
-        self.botoc.delete_queue(QueueUrl=self._get_queue_url(queue))
+        try:
+            self.botoc.delete_queue(QueueUrl=self._get_queue_url(queue))
+        finally:
+            self._forget_queue_url(queue)
 
     def listen(
-        self, queues: Iterable[str] | str, time_limit: int | None = None
+        self,
+        queues: Iterable[str] | str,
+        time_limit: int | None = None,
+        on_idle: Callable[[], bool | None] | None = None,
     ) -> Generator[Message]:
         if not queues:
             return
 
-        if isinstance(queues, str):
-            queues = [queues]
-        else:
-            queues = list(queues)
-
-        # Don't use long polling if we have multiple queues to check
-        wait_time = self.client.long_poll_time if len(queues) == 1 else 0
+        scheduler = QueueScheduler(queues)
 
         if time_limit is not None:
             end_time = time.monotonic() + time_limit
         else:
             end_time = None
 
-        first = True
-        while True:
-            if end_time is not None:
-                delta = end_time - time.monotonic()
-                if delta <= 0:
-                    if first:
-                        logger.debug(
-                            f"{queues=}, {time_limit=}; {delta=} but this is "
-                            "the first loop, setting delta = 0"
+        # Each queue is long-polled on its own thread, and the batches they receive are
+        # merged here, taking messages from whichever queue the scheduler picks. A
+        # poller fetches its next batch as soon as we start on its last one (with the
+        # default prefetch_batches), so the next batch is usually waiting by the time
+        # we need it; it keeps the visibility of batches it has buffered like this
+        # extended until they're handled.
+        stop = threading.Event()
+        # Held while handing over a batch, so one can't arrive after we've stopped
+        # and released those left over
+        handover = threading.Lock()
+        batches: Queue[_Batch | Exception | None] = Queue()
+        for name in scheduler.names:
+            threading.Thread(
+                target=self._poll,
+                args=(name, end_time, stop, handover, batches),
+                name=f"dstm-sqs-poll-{name}",
+                daemon=True,
+            ).start()
+
+        running = len(scheduler.names)
+        # Batches received from each queue that we haven't finished yielding
+        ready: dict[str, deque[_Batch]] = {name: deque() for name in scheduler.names}
+
+        def collect(item: _Batch | Exception | None) -> None:
+            nonlocal running
+            if item is None:  # a poller has finished
+                running -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                ready[item.queue].append(item)
+
+        try:
+            while True:
+                while True:
+                    try:
+                        collect(batches.get_nowait())
+                    except Empty:
+                        break
+                queue = scheduler.choose([q for q, b in ready.items() if b])
+                if queue is None:
+                    if not running:
+                        break
+                    # Don't hold on to acks while we wait for more messages
+                    self.flush()
+                    try:
+                        collect(
+                            batches.get(
+                                timeout=ON_IDLE_INTERVAL
+                                if on_idle is not None
+                                else None
+                            )
                         )
-                        delta = 0
+                    except Empty:
+                        if on_idle is not None and on_idle():
+                            return
+                    continue
+                batch = ready[queue][0]
+                if not batch.started.is_set():
+                    batch.started_at = time.monotonic()
+                    batch.started.set()
+                sqs_message = batch.take()
+                finished = not batch.messages
+                if finished:
+                    ready[queue].popleft()
+                if sqs_message is not None:
+                    yield self._parse(batch.queue, batch.queue_url, sqs_message)
+                if finished:
+                    batch.handled.set()
+                    if on_idle is not None and on_idle():
+                        return
+        finally:
+            with handover:
+                stop.set()
+            # Make anything we received but didn't yield visible to other consumers
+            for queued in ready.values():
+                for batch in queued:
+                    self._release(batch)
+            while True:
+                try:
+                    item = batches.get_nowait()
+                except Empty:
+                    break
+                if isinstance(item, _Batch):
+                    self._release(item)
+
+    def _poll(
+        self,
+        queue_name: str,
+        end_time: float | None,
+        stop: threading.Event,
+        handover: threading.Lock,
+        batches: "Queue[_Batch | Exception | None]",
+    ) -> None:
+        """Body of the thread that long-polls a single queue for listen()."""
+        visibility_timeout = self.client.visibility_timeout
+        max_messages = self.client.max_messages_per_request
+        if self.client.adaptive_batching:
+            sizer = _BatchSizer(max_messages or SQS_BATCH_SIZE, visibility_timeout)
+        else:
+            sizer = None
+        prefetch = self.client.prefetch_batches
+        # Batches we've received that listen() hasn't finished with
+        outstanding: list[_Batch] = []
+        try:
+            first = True
+            while not stop.is_set():
+                # Keep at most `prefetch` batches waiting for listen() to start on
+                # them, or with none, wait until it's finished with the last
+                while True:
+                    for batch in outstanding:
+                        if batch.handled.is_set() and sizer is not None:
+                            sizer.handled(
+                                batch.count, time.monotonic() - batch.started_at
+                            )
+                    outstanding = [b for b in outstanding if not b.handled.is_set()]
+                    if prefetch > 0:
+                        waiting = [b for b in outstanding if not b.started.is_set()]
                     else:
-                        logger.debug(f"{queues=}, {time_limit=}; {delta=}, breaking")
+                        waiting = outstanding
+                    if len(waiting) < max(prefetch, 1):
                         break
-                else:
-                    logger.debug(f"{queues=}, {time_limit=}; {delta=}")
-                if wait_time > delta:
-                    wait_time = delta
-            logger.debug(f"{queues=}, {time_limit=}; continuing with {int(wait_time)=}")
-            first = False
-
-            for queue in queues:
-                queue_url = self._get_queue_url(queue)
-                response = self.botoc.receive_message(
-                    QueueUrl=queue_url,
-                    MaxNumberOfMessages=self.client.max_messages_per_request,
-                    WaitTimeSeconds=int(wait_time),
-                    MessageAttributeNames=["All"],
+                    event = waiting[0].started if prefetch > 0 else waiting[0].handled
+                    if not event.wait(ON_IDLE_INTERVAL):
+                        if stop.is_set():
+                            return  # listen() releases whatever it didn't yield
+                        self._extend_visibility(outstanding)
+
+                # Batches can sit part-way through while other queues are served first
+                self._extend_visibility(outstanding)
+                wait_time = self.client.long_poll_time
+                if end_time is not None:
+                    delta = end_time - time.monotonic()
+                    if delta <= 0 and not first:
+                        break
+                    # Rounded up, so the last second isn't spent polling without
+                    # waiting
+                    wait_time = max(0, min(wait_time, math.ceil(delta)))
+                first = False
+
+                size = sizer.size if sizer else max_messages or 1
+                received_at = time.monotonic()
+                queue_url, response = self._with_queue_url(
+                    queue_name,
+                    lambda queue_url: (
+                        queue_url,
+                        self.botoc.receive_message(
+                            QueueUrl=queue_url,
+                            MaxNumberOfMessages=size,
+                            WaitTimeSeconds=wait_time,
+                            MessageAttributeNames=["All"],
+                            MessageSystemAttributeNames=["ApproximateReceiveCount"],
+                        ),
+                    ),
                 )
-
                 messages = response.get("Messages", [])
-                response["ResponseMetadata"]
+                if sizer is not None:
+                    sizer.received(len(messages))
+                if not messages:
+                    continue
+                batch = _Batch(
+                    queue_name,
+                    queue_url,
+                    messages,
+                    visible_until=received_at + visibility_timeout,
+                )
+                with handover:
+                    if stop.is_set():
+                        # listen() finished while we were polling
+                        self._release(batch)
+                        return
+                    outstanding.append(batch)
+                    batches.put(batch)
+        except Exception as e:
+            if not stop.is_set():
+                batches.put(e)
+        finally:
+            batches.put(None)
+
+    def _parse(self, queue: str, queue_url: str, sqs_message) -> Message:
+        attrs = sqs_message.get("MessageAttributes", {})
+        assert "Body" in sqs_message
+        assert "ReceiptHandle" in sqs_message
+        headers = {k: v["StringValue"] for k, v in attrs.items() if "StringValue" in v}
+        handed_back = int(headers.pop(DELIVERY_COUNT_ATTRIBUTE, 0))
+        content_type = headers.pop(CONTENT_TYPE_ATTRIBUTE, None)
+        content_encoding = headers.pop(CONTENT_ENCODING_ATTRIBUTE, None)
+        decode: Callable = self.client.codec.decode
+        if content_type is None:
+            data = sqs_message["Body"].encode("utf-8")
+        else:
+            try:
+                data = base64.b64decode(sqs_message["Body"])
+            except binascii.Error as e:
+                # Still yielded, so a worker can dead-letter it (failing when it
+                # decodes the body) rather than it coming back forever. The body and
+                # attributes are kept as they are, to be published as they were.
+                logger.warning(f"Undecodable body in message from SQS queue {queue}")
+                headers[CONTENT_TYPE_ATTRIBUTE] = content_type
+                if content_encoding is not None:
+                    headers[CONTENT_ENCODING_ATTRIBUTE] = content_encoding
+                data = sqs_message["Body"].encode("utf-8")
+                content_type = content_encoding = None
+                decode = partial(_undecodable, e)
+        message = Message.from_payload(
+            queue,
+            Payload(data, content_type or JSON, content_encoding),
+            decode,
+            headers=headers,
+            _id=(queue_url, sqs_message["ReceiptHandle"]),
+        )
+        if count := sqs_message.get("Attributes", {}).get("ApproximateReceiveCount"):
+            message.delivery_count = handed_back + int(count)
+        return message
+
+    def _extend_visibility(self, batches: list[_Batch]) -> None:
+        """Keep the messages left in buffered batches from becoming visible to other
+        consumers while they wait to be yielded: once half the visibility timeout has
+        passed, reset it."""
+        timeout = self.client.visibility_timeout
+        if timeout <= 0:
+            return
+        now = time.monotonic()
+        for batch in batches:
+            if batch.visible_until - now > timeout / 2:
+                continue
+            with batch.lock:
+                if not batch.messages:
+                    continue
+                logger.debug(
+                    f"Extending visibility of {len(batch.messages)} buffered messages "
+                    f"from SQS queue {batch.queue}"
+                )
+                self._change_visibility(batch.queue_url, batch.messages, timeout)
+                batch.visible_until = now + timeout
+
+    def _release(self, batch: _Batch) -> None:
+        """Hand back received-but-unhandled messages straight away."""
+        with batch.lock:
+            messages, batch.messages = batch.messages, []
+        batch.handled.set()
+        if not messages:
+            return
+        if batch.visible_until - time.monotonic() > HAND_BACK_MARGIN:
+            self._hand_back(batch.queue_url, messages)
+        else:
+            # Others may have received them meanwhile, so copies might duplicate them
+            self._change_visibility(batch.queue_url, messages, 0)
+
+    def _hand_back(self, queue_url: str, sqs_messages: list) -> None:
+        """Return messages that were received but never yielded to their queue, for
+        other consumers to pick up. Making them visible again would leave this receipt
+        counted in their ApproximateReceiveCount, as if it were an attempt at their
+        tasks, so instead they're republished, with the count of their previous
+        deliveries in an attribute, and the originals deleted. Any that can't be
+        republished are made visible again."""
+        chunks: list[list[tuple[dict, "SendMessageBatchRequestEntryTypeDef"]]] = []
+        total = 0
+        for sqs_message in sqs_messages:
+            attributes: dict[str, "MessageAttributeValueTypeDef"] = {
+                name: {
+                    "StringValue": value["StringValue"],
+                    "DataType": value["DataType"],
+                }
+                for name, value in sqs_message.get("MessageAttributes", {}).items()
+                if "StringValue" in value
+            }
+            count = attributes.pop(DELIVERY_COUNT_ATTRIBUTE, {}).get("StringValue", 0)
+            receipts = sqs_message.get("Attributes", {}).get("ApproximateReceiveCount")
+            previous = int(count) + int(receipts or 1) - 1
+            if previous > 0:
+                attributes[DELIVERY_COUNT_ATTRIBUTE] = {
+                    "StringValue": str(previous),
+                    "DataType": "Number",
+                }
+            size = _entry_size(sqs_message["Body"], attributes)
+            if (
+                not chunks
+                or len(chunks[-1]) == SQS_BATCH_SIZE
+                or total + size > MAX_BATCH_BYTES
+            ):
+                chunks.append([])
+                total = 0
+            total += size
+            entry: "SendMessageBatchRequestEntryTypeDef" = {
+                "Id": str(len(chunks[-1])),
+                "MessageBody": sqs_message["Body"],
+                "MessageAttributes": attributes,
+            }
+            chunks[-1].append((sqs_message, entry))
 
-                for sqs_message in messages:
-                    try:
-                        attrs = sqs_message.get("MessageAttributes", {})
-                        assert "Body" in sqs_message
-                        assert "ReceiptHandle" in sqs_message
-                        message = Message(
-                            queue=queue,
-                            body=json.loads(sqs_message["Body"]),
-                            headers={
-                                k: v["StringValue"]
-                                for k, v in attrs.items()
-                                if "StringValue" in v
-                            },
-                            _id=(queue_url, sqs_message["ReceiptHandle"]),
-                        )
-                    except Exception as e:
-                        logger.exception(f"Error parsing SQS message: {e}")
-                    else:
-                        yield message
+        for chunk in chunks:
+            try:
+                response = self.botoc.send_message_batch(
+                    QueueUrl=queue_url, Entries=[entry for _, entry in chunk]
+                )
+                failed = {entry["Id"] for entry in response.get("Failed", [])}
+            except Exception as e:
+                logger.warning(f"Failed to hand back SQS messages: {e}")
+                failed = {entry["Id"] for _, entry in chunk}
+            try:
+                self._delete(
+                    queue_url,
+                    [m["ReceiptHandle"] for m, e in chunk if e["Id"] not in failed],
+                )
+            except Exception as e:
+                # They'll be received again (as well as the copies) once their
+                # visibility times out
+                logger.warning(f"Failed to delete handed back SQS messages: {e}")
+            self._change_visibility(
+                queue_url, [m for m, e in chunk if e["Id"] in failed], 0
+            )
 
-            if len(queues) > 1:
-                # When watching multiple queues we don't use long-polling, so we need to
-                # manually sleep to avoid hammering the API
-                time.sleep(self.client.short_poll_sleep_seconds)
+    def _change_visibility(
+        self, queue_url: str, sqs_messages: list, timeout: int
+    ) -> None:
+        for start in range(0, len(sqs_messages), SQS_BATCH_SIZE):
+            chunk = sqs_messages[start : start + SQS_BATCH_SIZE]
+            try:
+                self.botoc.change_message_visibility_batch(
+                    QueueUrl=queue_url,
+                    Entries=[
+                        {
+                            "Id": str(i),
+                            "ReceiptHandle": sqs_message["ReceiptHandle"],
+                            "VisibilityTimeout": timeout,
+                        }
+                        for i, sqs_message in enumerate(chunk)
+                    ],
+                )
+            except Exception as e:
+                # They'll become visible again when their visibility timeout expires
+                logger.warning(f"Failed to change visibility of SQS messages: {e}")
 
     def ack(self, message: Message):
-        self.botoc.delete_message(
-            QueueUrl=message._id[0],
-            ReceiptHandle=message._id[1],
-        )
+        if self._acks.max_size > 1:
+            if self._acks.add(message):
+                self.flush()
+        else:
+            self.botoc.delete_message(
+                QueueUrl=message._id[0],
+                ReceiptHandle=message._id[1],
+            )
+
+    def flush(self) -> None:
+        """Delete buffered acked messages using DeleteMessageBatch."""
+        by_queue: dict[str, list[str]] = {}
+        for message in self._acks.drain():
+            queue_url, receipt_handle = message._id
+            by_queue.setdefault(queue_url, []).append(receipt_handle)
+
+        for queue_url, handles in by_queue.items():
+            self._delete(queue_url, handles)
+
+    def _delete(self, queue_url: str, receipt_handles: list[str]) -> None:
+        for start in range(0, len(receipt_handles), SQS_BATCH_SIZE):
+            chunk = receipt_handles[start : start + SQS_BATCH_SIZE]
+            response = self.botoc.delete_message_batch(
+                QueueUrl=queue_url,
+                Entries=[
+                    {"Id": str(i), "ReceiptHandle": handle}
+                    for i, handle in enumerate(chunk)
+                ],
+            )
+            for entry in response.get("Failed", []):
+                # The message will be redelivered once its visibility times out
+                logger.warning(
+                    f"Failed to delete SQS message: {entry['Code']} "
+                    f"{entry.get('Message', '')}"
+                )
 
-    def requeue(self, message: Message) -> None:
+    def requeue(self, message: Message, delay: float = 0) -> None:
+        self.flush()
         self.botoc.change_message_visibility(
             QueueUrl=message._id[0],
             ReceiptHandle=message._id[1],
-            VisibilityTimeout=0,
+            # The message stays where it is, just invisible until the delay is up
+            VisibilityTimeout=min(math.ceil(delay), MAX_VISIBILITY_TIMEOUT),
         )
+
+    def heartbeat(self, message: Message) -> AbstractContextManager[None]:
+        """Periodically extend the message's visibility timeout while the block runs,
+        from a background thread shared by all of this connection's heartbeats."""
+        interval = self.client.heartbeat_interval
+        if interval is None:
+            interval = self.client.visibility_timeout / 3
+        if interval <= 0 or self.client.visibility_timeout <= 0:
+            return nullcontext()
+        with self._heartbeats_lock:
+            if self._heartbeats is None:
+                self._heartbeats = _Heartbeats(self, interval)
+            return self._heartbeats.keep_alive(message)
+
+
+class _Heartbeats:
+    """Background thread that extends the visibility timeout of messages that are
+    still being worked on."""
+
+    def __init__(self, conn: SQSConnection, interval: float):
+        self.conn = conn
+        self.interval = interval
+        self.cond = threading.Condition()
+        # Key -> [message, when its visibility should next be extended]
+        self.active: dict[int, list] = {}
+        self.keys = itertools.count()
+        self.closed = False
+        self.thread = threading.Thread(
+            target=self._run, name="dstm-sqs-heartbeat", daemon=True
+        )
+        self.thread.start()
+
+    @contextmanager
+    def keep_alive(self, message: Message) -> Generator[None]:
+        with self.cond:
+            key = next(self.keys)
+            self.active[key] = [message, time.monotonic() + self.interval]
+            self.cond.notify()
+        try:
+            yield
+        finally:
+            with self.cond:
+                del self.active[key]
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join(timeout=5)
+
+    def _run(self) -> None:
+        timeout = self.conn.client.visibility_timeout
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                now = time.monotonic()
+                due: dict[str, list] = {}
+                for entry in self.active.values():
+                    message, at = entry
+                    if at <= now:
+                        queue_url, receipt_handle = message._id
+                        due.setdefault(queue_url, []).append(
+                            {"ReceiptHandle": receipt_handle}
+                        )
+                        entry[1] = now + self.interval
+                if not due:
+                    next_at = min((at for _, at in self.active.values()), default=None)
+                    self.cond.wait(None if next_at is None else next_at - now)
+                    continue
+            for queue_url, sqs_messages in due.items():
+                logger.debug(
+                    f"Extending visibility of {len(sqs_messages)} in-progress messages "
+                    f"by {timeout}s"
+                )
+                self.conn._change_visibility(queue_url, sqs_messages, timeout)
+
+
+def _entry_size(
+    body: str, attributes: dict[str, "MessageAttributeValueTypeDef"]
+) -> int:
+    """The size of a message as SQS counts it towards the limits on message and batch
+    size: its body, plus the names, types and values of its attributes."""
+    return len(body.encode("utf-8")) + sum(
+        len(name.encode("utf-8"))
+        + len(value["DataType"].encode("utf-8"))
+        + len(value.get("StringValue", "").encode("utf-8"))
+        for name, value in attributes.items()
+    )
+
+
+def _delay_seconds(message: Message) -> int:
+    """How long to have SQS delay a message, rounding up so it's never delivered before
+    its ETA."""
+    return min(math.ceil(eta_delay(message)), MAX_DELAY_SECONDS)
+
+
+def _undecodable(error: Exception, *payload) -> Any:
+    """Stands in for Codec.decode for a message whose body couldn't be decoded."""
+    raise ValueError(f"Undecodable message body: {error}") from error
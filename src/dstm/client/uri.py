@@ -18,4 +18,9 @@ def client_from_uri(uri: str) -> MessageClient:
         return SQSClient(
             boto3.client("sqs", endpoint_url=os.environ.get("AWS_ENDPOINT_URL"))
         )
+    if uri.startswith("memory://"):
+        from dstm.client.memory import MemoryClient, named_broker
+
+        # Clients made from the same URI (within one process) share a broker
+        return MemoryClient(named_broker(uri.removeprefix("memory://")))
     raise ValueError(f"Unrecognized URI {uri}")
@@ -10,9 +10,32 @@ class PublishError(Error):
     """Exception raised when message publishing fails."""
 
 
+class BatchPublishError(PublishError):
+    """Exception raised when some messages in a batch could not be published."""
+
+    def __init__(self, message: str, failures: list):
+        super().__init__(message)
+        #: (message, reason) pairs for each message that failed to publish
+        self.failures = failures
+
+
 class ConsumeError(Error):
     """Exception raised when message consumption fails."""
 
 
+class MissingPayloadError(ConsumeError):
+    """Exception raised when a message's offloaded task arguments can't be found,
+    usually because the task already succeeded and this is a duplicate delivery."""
+
+
+class DeliveryLimitError(ConsumeError):
+    """Exception raised when a message has been delivered more times than its queue
+    allows, e.g. because workers keep crashing while running its task."""
+
+
+class TaskTimeoutError(Error):
+    """Exception raised in a task that has run for longer than its timeout."""
+
+
 class WiringError(Error):
     """Incorrect wiring of task names <-> task implementations"""
@@ -1,12 +1,106 @@
-from dataclasses import dataclass, field
-from typing import Any, Generic, TypeVar
+import time
+from typing import Any, Callable, Generic, TypeVar
+
+from dstm.serialization import Payload
 
 T = TypeVar("T")
 
+_UNDECODED: Any = object()
+
+# Header giving a message's priority (an integer), for brokers that support them
+PRIORITY_HEADER = "dstm-priority"
+# Header giving the time (as a Unix timestamp) before which a message shouldn't be
+# delivered. Clients delay publishing it until then, or as near as their broker allows.
+ETA_HEADER = "dstm-eta"
+
 
-@dataclass
 class Message(Generic[T]):
-    queue: str
-    body: T
-    headers: dict[str, Any] = field(default_factory=dict)
-    _id: Any = None
+    """A message on (or bound for) a queue.
+
+    A message may be made from an already-encoded Payload with from_payload(), as
+    clients do for the messages they receive. Its body is then only decoded when first
+    accessed, so headers can be inspected without decoding it, and the payload is
+    published as it is rather than being encoded again."""
+
+    __slots__ = (
+        "_body",
+        "_decode",
+        "_id",
+        "delivery_count",
+        "headers",
+        "payload",
+        "queue",
+    )
+
+    def __init__(
+        self,
+        queue: str,
+        body: T,
+        headers: dict[str, Any] | None = None,
+        _id: Any = None,
+    ):
+        self.queue = queue
+        self._body = body
+        self.headers = {} if headers is None else headers
+        self._id = _id
+        #: The encoded body, if known
+        self.payload: Payload | None = None
+        #: For a received message, how many times (including this one) it has been
+        #: delivered, if the broker keeps track
+        self.delivery_count: int | None = None
+        self._decode: Callable[..., T] | None = None
+
+    @classmethod
+    def from_payload(
+        cls,
+        queue: str,
+        payload: Payload,
+        decode: Callable[..., T],
+        headers: dict[str, Any] | None = None,
+        _id: Any = None,
+    ) -> "Message[T]":
+        """Make a message whose body will be decoded from `payload` by calling
+        decode(*payload) when first needed."""
+        message = cls(queue, _UNDECODED, headers, _id)
+        message.payload = payload
+        message._decode = decode
+        return message
+
+    def copy(self, queue: str, headers: dict[str, Any]) -> "Message[T]":
+        """A copy of this message bound for `queue` with `headers`, which reuses its
+        payload (without decoding it) if it has one."""
+        if self.payload is None:
+            return Message(queue, self.body, headers)
+        assert self._decode is not None
+        return Message.from_payload(queue, self.payload, self._decode, headers)
+
+    @property
+    def body(self) -> T:
+        if self._body is _UNDECODED:
+            assert self._decode is not None and self.payload is not None
+            self._body = self._decode(*self.payload)
+        return self._body
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Message):
+            return NotImplemented
+        return (self.queue, self.body, self.headers, self._id) == (
+            other.queue,
+            other.body,
+            other.headers,
+            other._id,
+        )
+
+    def __repr__(self) -> str:
+        body = "<undecoded>" if self._body is _UNDECODED else repr(self._body)
+        return (
+            f"Message(queue={self.queue!r}, body={body}, headers={self.headers!r}, "
+            f"_id={self._id!r})"
+        )
+
+
+def eta_delay(message: Message) -> float:
+    """Seconds until a message's ETA, or 0 if it has none or it has passed."""
+    if (eta := message.headers.get(ETA_HEADER)) is None:
+        return 0.0
+    return max(0.0, float(eta) - time.time())
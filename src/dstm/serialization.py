@@ -0,0 +1,323 @@
+"""Encoding of message bodies to and from bytes on the wire.
+
+Each message records how its body was encoded (a MIME content type, plus a content
+encoding if it was compressed), so consumers can decode messages from publishers
+configured differently - e.g. while switching serializer during a rollout. Messages
+without this information are assumed to be uncompressed JSON, which is all older
+versions of dstm sent."""
+
+import json
+import struct
+import sys
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Callable, NamedTuple, Protocol
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+BINARY_JSON = "application/x-dstm-binary+json"
+BINARY_MSGPACK = "application/x-dstm-binary+msgpack"
+
+#: What message bodies are decoded from: memoryviews let them be read straight from
+#: e.g. a memory-mapped file, or a slice of a larger body, without copying
+Buffer = bytes | memoryview
+
+
+class Serializer(Protocol):
+    #: MIME type identifying the serialization format, e.g. "application/json"
+    content_type: str
+
+    def dumps(self, obj: Any) -> bytes:
+        """Serialize a message body."""
+        ...
+
+    def loads(self, data: Buffer) -> Any:
+        """Deserialize a message body, from bytes or any other bytes-like object."""
+        ...
+
+
+class Compressor(Protocol):
+    #: Name identifying the compression algorithm, e.g. "zlib"
+    content_encoding: str
+
+    def compress(self, data: bytes) -> bytes: ...
+    def decompress(self, data: Buffer) -> bytes: ...
+
+
+@dataclass
+class JSONSerializer(Serializer):
+    """JSON using the standard library."""
+
+    content_type = JSON
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(self, data: Buffer) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+@dataclass
+class OrjsonSerializer(Serializer):
+    """JSON using orjson, which is several times faster than the standard library.
+    Requires the orjson package."""
+
+    content_type = JSON
+
+    def __post_init__(self):
+        import orjson
+
+        self._orjson = orjson
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._orjson.dumps(obj)
+
+    def loads(self, data: Buffer) -> Any:
+        return self._orjson.loads(data)
+
+
+@dataclass
+class MsgpackSerializer(Serializer):
+    """MessagePack: a compact binary format that can also hold bytes. Requires the
+    msgpack package."""
+
+    content_type = MSGPACK
+
+    def __post_init__(self):
+        import msgpack
+
+        self._msgpack = msgpack
+
+    def dumps(self, obj: Any) -> bytes:
+        data = self._msgpack.packb(obj, use_bin_type=True)
+        assert data is not None  # packb always returns bytes, though typed Optional
+        return data
+
+    def loads(self, data: Buffer) -> Any:
+        return self._msgpack.unpackb(data, raw=False)
+
+
+@dataclass
+class BinarySerializer(Serializer):
+    """Wraps another serializer so that bytes, bytearrays, memoryviews and NumPy arrays
+    anywhere in the body are sent as raw buffers instead of having to be converted to
+    something it can handle.
+
+    The encoded body is a small header, then the rest of the body serialized by `inner`
+    with a placeholder in place of each buffer, then the buffers themselves. When
+    decoding, memoryviews and NumPy arrays are rebuilt as views onto the received data
+    rather than copies (so NumPy arrays are read-only), and bytes/bytearrays as
+    copies."""
+
+    inner: Serializer = field(default_factory=JSONSerializer)
+
+    @property
+    def content_type(self) -> str:  # type: ignore[override]
+        return _BINARY_TYPES[self.inner.content_type]
+
+    def dumps(self, obj: Any) -> bytes:
+        buffers: list[memoryview] = []
+        meta = self.inner.dumps(
+            {
+                "body": _extract_buffers(obj, buffers),
+                "sizes": [b.nbytes for b in buffers],
+            }
+        )
+        parts: list[Any] = [_BINARY_MAGIC, struct.pack("<I", len(meta)), meta]
+        offset = _BINARY_HEADER_SIZE + len(meta)
+        for buffer in buffers:
+            if padding := -offset % _BINARY_ALIGNMENT:
+                parts.append(bytes(padding))
+                offset += padding
+            parts.append(buffer)
+            offset += buffer.nbytes
+        return b"".join(parts)
+
+    def loads(self, data: Buffer) -> Any:
+        view = memoryview(data)
+        if view[: len(_BINARY_MAGIC)] != _BINARY_MAGIC:
+            raise ValueError("Not a dstm binary envelope")
+        (meta_size,) = struct.unpack_from("<I", view, len(_BINARY_MAGIC))
+        offset = _BINARY_HEADER_SIZE + meta_size
+        meta = self.inner.loads(view[_BINARY_HEADER_SIZE:offset])
+        buffers = []
+        for size in meta["sizes"]:
+            offset += -offset % _BINARY_ALIGNMENT
+            buffers.append(view[offset : offset + size])
+            offset += size
+        return _restore_buffers(meta["body"], buffers)
+
+
+_BINARY_MAGIC = b"DSTB"
+_BINARY_HEADER_SIZE = len(_BINARY_MAGIC) + 4
+# Buffers start at multiples of this offset into the body, so that (as long as the body
+# itself is suitably aligned) NumPy arrays made from them are aligned too
+_BINARY_ALIGNMENT = 16
+_BINARY_TYPES = {JSON: BINARY_JSON, MSGPACK: BINARY_MSGPACK}
+# Marks a placeholder for a buffer in BinarySerializer's structure
+_BUFFER_KEY = "__dstm_buffer__"
+
+
+def _extract_buffers(obj: Any, buffers: list[memoryview]) -> Any:
+    """Copy of obj with buffers replaced by placeholders, adding them to `buffers`."""
+    if isinstance(obj, dict):
+        return {k: _extract_buffers(v, buffers) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_extract_buffers(v, buffers) for v in obj]
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        placeholder = {_BUFFER_KEY: len(buffers), "type": type(obj).__name__}
+        view = memoryview(obj)
+        if not view.c_contiguous:
+            view = memoryview(view.tobytes())
+        buffers.append(view.cast("B"))
+        return placeholder
+    # If numpy hasn't been imported, obj can't be an array
+    if (numpy := sys.modules.get("numpy")) and isinstance(obj, numpy.ndarray):
+        if obj.dtype.hasobject:
+            raise TypeError("NumPy arrays of Python objects can't be sent as buffers")
+        array = numpy.ascontiguousarray(obj)
+        placeholder = {
+            _BUFFER_KEY: len(buffers),
+            "type": "ndarray",
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+        }
+        buffers.append(memoryview(array.reshape(-1).view(numpy.uint8)))
+        return placeholder
+    return obj
+
+
+def _restore_buffers(obj: Any, buffers: list[memoryview]) -> Any:
+    if isinstance(obj, list):
+        return [_restore_buffers(v, buffers) for v in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if _BUFFER_KEY not in obj:
+        return {k: _restore_buffers(v, buffers) for k, v in obj.items()}
+    buffer = buffers[obj[_BUFFER_KEY]]
+    match obj["type"]:
+        case "bytes":
+            return buffer.tobytes()
+        case "bytearray":
+            return bytearray(buffer)
+        case "memoryview":
+            return buffer
+        case "ndarray":
+            import numpy
+
+            array = numpy.frombuffer(buffer, dtype=numpy.dtype(obj["dtype"]))
+            return array.reshape(obj["shape"])
+    raise ValueError(f"Unknown buffer type {obj['type']!r}")
+
+
+@dataclass
+class ZlibCompressor(Compressor):
+    level: int = 6
+
+    content_encoding = "zlib"
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: Buffer) -> bytes:
+        return zlib.decompress(data)
+
+
+@dataclass
+class ZstdCompressor(Compressor):
+    """Zstandard compression; faster than zlib at a similar ratio. Requires the
+    zstandard package."""
+
+    level: int = 3
+
+    content_encoding = "zstd"
+
+    def __post_init__(self):
+        import zstandard
+
+        self._compressor = zstandard.ZstdCompressor(level=self.level)
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def decompress(self, data: Buffer) -> bytes:
+        return self._decompressor.decompress(data)
+
+
+class Payload(NamedTuple):
+    data: bytes
+    content_type: str
+    content_encoding: str | None
+
+
+# Used to decode messages in formats other than the codec's own, created on first use
+_serializer_types: dict[str, Callable[[], Serializer]] = {
+    JSON: JSONSerializer,
+    MSGPACK: MsgpackSerializer,
+    BINARY_JSON: BinarySerializer,
+    BINARY_MSGPACK: lambda: BinarySerializer(MsgpackSerializer()),
+}
+_compressor_types: dict[str, Callable[[], Compressor]] = {
+    "zlib": ZlibCompressor,
+    "zstd": ZstdCompressor,
+}
+_defaults: dict[str, Any] = {}
+
+
+def _default(name: str, factories: dict[str, Callable[[], Any]]) -> Any:
+    if name not in _defaults:
+        _defaults[name] = factories[name]()
+    return _defaults[name]
+
+
+@dataclass
+class Codec:
+    """How a client encodes the bodies of the messages it publishes: serialized with
+    `serializer`, then compressed with `compressor` if that's set and the serialized
+    body is at least `compress_threshold` bytes.
+
+    Any supported format can be decoded, whatever the codec's own settings."""
+
+    serializer: Serializer = field(default_factory=JSONSerializer)
+    compressor: Compressor | None = None
+    compress_threshold: int = 1024
+
+    def encode(self, body: Any) -> Payload:
+        data = self.serializer.dumps(body)
+        if self.compressor is not None and len(data) >= self.compress_threshold:
+            return Payload(
+                self.compressor.compress(data),
+                self.serializer.content_type,
+                self.compressor.content_encoding,
+            )
+        return Payload(data, self.serializer.content_type, None)
+
+    def decode(
+        self,
+        data: Buffer,
+        content_type: str | None = None,
+        content_encoding: str | None = None,
+    ) -> Any:
+        if content_encoding:
+            data = self._compressor(content_encoding).decompress(data)
+        return self._serializer(content_type or JSON).loads(data)
+
+    def _serializer(self, content_type: str) -> Serializer:
+        if content_type == self.serializer.content_type:
+            return self.serializer
+        if content_type not in _serializer_types:
+            raise ValueError(f"Unsupported content type {content_type!r}")
+        return _default(content_type, _serializer_types)
+
+    def _compressor(self, content_encoding: str) -> Compressor:
+        if (
+            self.compressor is not None
+            and content_encoding == self.compressor.content_encoding
+        ):
+            return self.compressor
+        if content_encoding not in _compressor_types:
+            raise ValueError(f"Unsupported content encoding {content_encoding!r}")
+        return _default(content_encoding, _compressor_types)
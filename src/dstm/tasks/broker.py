@@ -1,12 +1,21 @@
+import copy
+import dataclasses
 import logging
-from dataclasses import asdict
-from typing import Iterable, ParamSpec
+import threading
+from itertools import islice
+from typing import Any, Iterable, Mapping, ParamSpec, Sequence
 
 from dstm.client.base import MessageClient
+from dstm.client.pool import PooledClient
+from dstm.client.scheduling import QueuePriorities
 from dstm.message import Message
-from dstm.tasks.types import TaskFunc, TaskInstance
+from dstm.tasks.claimcheck import ClaimCheck
+from dstm.tasks.deadletter import dead_letter_queue, redrive_dead_letters
+from dstm.tasks.metrics import WorkerMetrics
+from dstm.tasks.profiling import TaskProfiler
+from dstm.tasks.types import RetryPolicy, SubmitOptions, TaskFunc, TaskInstance
 from dstm.tasks.wiring import AutoWiring, TaskWiring
-from dstm.tasks.worker import run_worker
+from dstm.tasks.worker import run_worker, run_worker_async
 
 logger = logging.getLogger(__name__)
 
@@ -19,11 +28,78 @@ def submit_task(
     *args,
     **kwargs,
 ) -> None:
+    publish_task(queue, TaskInstance(task_name, args=args, kwargs=kwargs), client)
+
+
+def publish_task(
+    queue: str,
+    instance: TaskInstance,
+    client: MessageClient,
+    claim_check: ClaimCheck | None = None,
+    options: SubmitOptions | None = None,
+) -> None:
+    """Publish a task instance, offloading its arguments with `claim_check` if they're
+    large."""
     with client.connect() as conn:
-        instance = TaskInstance(task_name, args=args, kwargs=kwargs)
-        msg = Message(queue, asdict(instance))
         logger.info(f"Submitting {instance} to {queue}")
-        conn.publish(msg)
+        conn.publish(_task_message(queue, instance, claim_check, options))
+
+
+def submit_tasks(
+    queue: str,
+    task_name: str,
+    client: MessageClient,
+    calls: Iterable[tuple[Sequence, Mapping]],
+    /,
+    batch_size: int = 500,
+    claim_check: ClaimCheck | None = None,
+    options: SubmitOptions | None = None,
+) -> int:
+    """Submit one task instance per (args, kwargs) pair in `calls`, publishing them in
+    batches over a single connection. Returns the number of instances submitted."""
+    count = 0
+    calls = iter(calls)
+    with client.connect() as conn:
+        while batch := list(islice(calls, batch_size)):
+            conn.publish_batch(
+                _task_message(
+                    queue,
+                    TaskInstance(task_name, tuple(args), dict(kwargs)),
+                    claim_check,
+                    options,
+                )
+                for args, kwargs in batch
+            )
+            count += len(batch)
+            logger.info(f"Submitted {len(batch)} instances of {task_name} to {queue}")
+    return count
+
+
+def _task_message(
+    queue: str,
+    instance: TaskInstance,
+    claim_check: ClaimCheck | None,
+    options: SubmitOptions | None = None,
+) -> Message:
+    headers = instance.headers()
+    if options is not None:
+        headers.update(options.headers())
+    if claim_check is None:
+        return Message(queue, instance.to_body(), headers)
+    return claim_check.check(queue, instance.to_body(), headers)
+
+
+def _call_arguments(item: Sequence | Mapping) -> tuple[Sequence, Mapping]:
+    """The (args, kwargs) for an item passed to TaskBroker.submit_many()."""
+    if isinstance(item, Mapping):
+        return (), item
+    if isinstance(item, (str, bytes)):
+        # Would otherwise be taken as one positional argument per character
+        raise TypeError(
+            f"Expected a sequence or mapping of task arguments, got {item!r}; wrap "
+            "a single argument in a tuple"
+        )
+    return item, {}
 
 
 P = ParamSpec("P")
@@ -31,8 +107,11 @@ P = ParamSpec("P")
 
 class TaskBroker:
     client: MessageClient
+    publisher: PooledClient
     wiring: TaskWiring
     queue_prefix: str
+    claim_check: ClaimCheck | None
+    options: SubmitOptions
 
     def __init__(
         self,
@@ -40,6 +119,9 @@ class TaskBroker:
         wiring: TaskWiring | None = None,
         queue_prefix: str = "",
         default_queue: str | None = None,
+        pool_size: int = 4,
+        pool_idle_timeout: float | None = 30,
+        claim_check: ClaimCheck | None = None,
     ) -> None:
         if wiring is None:
             self.wiring = AutoWiring(default_queue=default_queue)
@@ -48,7 +130,53 @@ class TaskBroker:
             if default_queue is not None:
                 raise ValueError("Cannot provide both `wiring` and `default_queue`")
         self.client = client
+        # Submitting tasks reuses connections from this pool rather than connecting
+        # afresh for every message
+        self.publisher = PooledClient(
+            client, max_size=pool_size, idle_timeout=pool_idle_timeout
+        )
         self.queue_prefix = queue_prefix
+        # Large task arguments are offloaded to this blob store, if given
+        self.claim_check = claim_check
+        self.options = SubmitOptions()
+
+    def with_options(self, **options: Any) -> "TaskBroker":
+        """A broker that submits tasks with the given SubmitOptions, e.g.
+        broker.with_options(priority=9).submit(task, ...) or
+        broker.with_options(delay=60).submit(task, ...). It shares this broker's
+        connections."""
+        broker = copy.copy(self)
+        broker.options = dataclasses.replace(self.options, **options)
+        return broker
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type_, value, tb):
+        self.close()
+
+    def close(self) -> None:
+        """Close any pooled publisher connections."""
+        self.publisher.close()
+
+    def _prefixed(self, queues: Iterable[str] | str) -> list[str] | dict[str, int]:
+        """Queue names with the prefix added, keeping any weights or priorities."""
+        if isinstance(queues, str):
+            queues = [queues]
+        if isinstance(queues, QueuePriorities):
+            return QueuePriorities(
+                (self.queue_prefix + q, p) for q, p in queues.items()
+            )
+        if isinstance(queues, Mapping):
+            return {self.queue_prefix + q: w for q, w in queues.items()}
+        return [self.queue_prefix + q for q in queues]
+
+    def _prefixed_limits(
+        self, max_attempts: int | Mapping[str, int] | None
+    ) -> int | dict[str, int] | None:
+        if isinstance(max_attempts, Mapping):
+            return {self.queue_prefix + q: n for q, n in max_attempts.items()}
+        return max_attempts
 
     def run_worker(
         self,
@@ -56,33 +184,117 @@ class TaskBroker:
         time_limit: int | None = None,
         task_limit: int | None = None,
         raise_errors: bool = False,
+        concurrency: int = 1,
+        shutdown: threading.Event | None = None,
+        metrics: WorkerMetrics | None = None,
+        profiler: TaskProfiler | None = None,
+        retry: RetryPolicy | None = None,
+        max_attempts: int | Mapping[str, int] | None = None,
+        timeout: float | None = None,
     ):
-        if isinstance(queues, str):
-            queues = [queues]
         run_worker(
             client=self.client,
-            queues=[self.queue_prefix + g for g in queues],
+            queues=self._prefixed(queues),
+            wiring=self.wiring,
+            time_limit=time_limit,
+            task_limit=task_limit,
+            raise_errors=raise_errors,
+            concurrency=concurrency,
+            shutdown=shutdown,
+            claim_check=self.claim_check,
+            metrics=metrics,
+            profiler=profiler,
+            retry=retry,
+            max_attempts=self._prefixed_limits(max_attempts),
+            timeout=timeout,
+        )
+
+    async def run_async_worker(
+        self,
+        queues: Iterable[str] | str,
+        time_limit: int | None = None,
+        task_limit: int | None = None,
+        raise_errors: bool = False,
+        concurrency: int = 100,
+        shutdown: threading.Event | None = None,
+        metrics: WorkerMetrics | None = None,
+        profiler: TaskProfiler | None = None,
+        retry: RetryPolicy | None = None,
+        max_attempts: int | Mapping[str, int] | None = None,
+        timeout: float | None = None,
+    ):
+        await run_worker_async(
+            client=self.client,
+            queues=self._prefixed(queues),
             wiring=self.wiring,
             time_limit=time_limit,
             task_limit=task_limit,
             raise_errors=raise_errors,
+            concurrency=concurrency,
+            shutdown=shutdown,
+            claim_check=self.claim_check,
+            metrics=metrics,
+            profiler=profiler,
+            retry=retry,
+            max_attempts=self._prefixed_limits(max_attempts),
+            timeout=timeout,
         )
 
     def create_queues(self, queues: Iterable[str] | str):
+        """Create queues, along with their dead-letter queues."""
         if isinstance(queues, str):
             queues = [queues]
         with self.client.connect() as conn:
             for g in queues:
                 conn.create_queue(self.queue_prefix + g)
+                conn.create_queue(dead_letter_queue(self.queue_prefix + g))
 
     def destroy_queues(self, queues: Iterable[str] | str):
+        """Delete queues, along with their dead-letter queues."""
         if isinstance(queues, str):
             queues = [queues]
         with self.client.connect() as conn:
             for g in queues:
                 conn.destroy_queue(self.queue_prefix + g)
+                conn.destroy_queue(dead_letter_queue(self.queue_prefix + g))
+
+    def redrive(
+        self, queue: str, limit: int | None = None, idle_timeout: float = 5.0
+    ) -> int:
+        """Move up to `limit` messages from a queue's dead-letter queue back onto it,
+        stopping once none have arrived for `idle_timeout` seconds. Returns the number
+        of messages moved."""
+        with self.client.connect() as conn:
+            return redrive_dead_letters(
+                conn, self.queue_prefix + queue, limit, idle_timeout
+            )
 
     def submit(self, task: TaskFunc[P], /, *args: P.args, **kwargs: P.kwargs):
         task_id = self.wiring.get_task_identity(task)
         queue = self.queue_prefix + task_id.queue
-        submit_task(queue, task_id.name, self.client, *args, **kwargs)
+        instance = TaskInstance(task_id.name, args=args, kwargs=kwargs)
+        publish_task(queue, instance, self.publisher, self.claim_check, self.options)
+
+    def submit_many(
+        self,
+        task: TaskFunc,
+        arguments: Iterable[Sequence | Mapping],
+        /,
+        batch_size: int = 500,
+    ) -> int:
+        """Submit one instance of `task` per item of `arguments`, using batched
+        publishes. Each item is either a sequence of positional arguments or a mapping
+        of keyword arguments; a single string argument must be wrapped in a tuple.
+        Returns the number of instances submitted."""
+        task_id = self.wiring.get_task_identity(task)
+        queue = self.queue_prefix + task_id.queue
+        calls = (_call_arguments(item) for item in arguments)
+        return submit_tasks(
+            queue,
+            task_id.name,
+            self.publisher,
+            calls,
+            batch_size=batch_size,
+            claim_check=self.claim_check,
+            options=self.options,
+        )
@@ -0,0 +1,154 @@
+"""Claim checks: keeping large task arguments out of the message broker.
+
+When a task's arguments are too big to send comfortably through the broker (SQS has a
+256KB limit, and large messages eat into RabbitMQ's memory), the encoded task is
+written to a blob store shared by submitters and workers, and the message carries only
+a reference to it. The worker fetches it when it's about to run the task, and deletes it
+once the task has succeeded."""
+
+import logging
+import mmap
+import os
+import tempfile
+import uuid
+from collections.abc import Iterator
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Protocol
+
+from dstm.exceptions import ConsumeError, MissingPayloadError
+from dstm.message import Message
+from dstm.serialization import Codec
+from dstm.tasks.types import TaskInstance
+
+logger = logging.getLogger(__name__)
+
+# Message headers referring to offloaded arguments
+KEY_HEADER = "dstm-claim-check"
+CONTENT_TYPE_HEADER = "dstm-claim-check-content-type"
+CONTENT_ENCODING_HEADER = "dstm-claim-check-content-encoding"
+
+
+class BlobStore(Protocol):
+    def put(self, data: bytes) -> str:
+        """Store a blob, returning a key by which it can be retrieved."""
+        ...
+
+    def open(self, key: str) -> AbstractContextManager[memoryview]:
+        """Context manager giving access to the contents of a stored blob. Raises
+        FileNotFoundError if there's no such blob."""
+        ...
+
+    def delete(self, key: str) -> None:
+        """Delete a blob, if it exists."""
+        ...
+
+
+@dataclass
+class FilesystemBlobStore(BlobStore):
+    """Stores blobs as files in a directory, e.g. on a volume shared between the hosts
+    that submit tasks and those that run them. Blobs are memory-mapped when read, so
+    they needn't be copied into memory before being decoded."""
+
+    root: Path | str
+
+    def __post_init__(self):
+        self.root = Path(self.root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        if not key or os.sep in key or key.startswith("."):
+            raise ValueError(f"Invalid blob key {key!r}")
+        return Path(self.root) / key
+
+    def put(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        # Write to a temporary file and rename it into place, so a reader never sees a
+        # partially written blob
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return key
+
+    @contextmanager
+    def open(self, key: str) -> Iterator[memoryview]:
+        with open(self._path(key), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                mapped = b""
+            else:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The mapping isn't closed explicitly, but once nothing refers to it: decoded
+        # arguments may be views onto it (see BinarySerializer)
+        yield memoryview(mapped)
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+
+@dataclass
+class ClaimCheck:
+    """Offloads task instances to `store` when they're at least `threshold` bytes once
+    encoded with `codec` (which is also used for those that aren't offloaded)."""
+
+    store: BlobStore
+    threshold: int = 128 * 1024
+    codec: Codec = field(default_factory=Codec)
+
+    def check(
+        self, queue: str, body: dict[str, Any], headers: dict[str, Any]
+    ) -> Message:
+        """Make the message for a task instance body, offloading its arguments if
+        they're large. Either way the body is only encoded once."""
+        payload = self.codec.encode(body)
+        if len(payload.data) < self.threshold:
+            return Message.from_payload(queue, payload, self.codec.decode, headers)
+        key = self.store.put(payload.data)
+        logger.debug(f"Offloaded {len(payload.data)} byte task body to blob {key}")
+        headers = {
+            **headers,
+            KEY_HEADER: key,
+            CONTENT_TYPE_HEADER: payload.content_type,
+        }
+        if payload.content_encoding is not None:
+            headers[CONTENT_ENCODING_HEADER] = payload.content_encoding
+        return Message(queue, {**body, "args": [], "kwargs": {}}, headers)
+
+    def claim(self, message: Message) -> dict[str, Any]:
+        """Get the full task instance body of a message, fetching it from the store if
+        it was offloaded."""
+        if (key := message.headers.get(KEY_HEADER)) is None:
+            return message.body
+        try:
+            with self.store.open(key) as data:
+                offloaded = self.codec.decode(
+                    data,
+                    message.headers.get(CONTENT_TYPE_HEADER),
+                    message.headers.get(CONTENT_ENCODING_HEADER),
+                )
+        except FileNotFoundError as e:
+            raise MissingPayloadError(f"Offloaded task body {key} not found") from e
+        return {**message.body, **offloaded}
+
+    def release(self, message: Message) -> None:
+        """Delete a message's offloaded arguments, once it's been handled."""
+        if (key := message.headers.get(KEY_HEADER)) is not None:
+            self.store.delete(key)
+
+
+def claim_instance(message: Message, claim_check: ClaimCheck | None) -> TaskInstance:
+    """Get the task instance to run for a message received by a worker, fetching its
+    arguments if they were offloaded."""
+    if KEY_HEADER not in message.headers:
+        return TaskInstance.from_body(message.body)
+    if claim_check is None:
+        raise ConsumeError(
+            "Task arguments were offloaded to a blob store, but this worker has no "
+            "claim check configured"
+        )
+    return TaskInstance.from_body(claim_check.claim(message))
@@ -1,11 +1,25 @@
+import asyncio
 import json
 import logging
+import signal
+import threading
+from functools import partial
 from typing import Annotated
 
-from typer import Option, Typer
+from typer import Option, Typer, echo
 
+from dstm.client.scheduling import QueuePriorities
 from dstm.client.uri import client_from_uri
+from dstm.exceptions import WiringError
 from dstm.tasks.broker import TaskBroker
+from dstm.tasks.claimcheck import ClaimCheck, FilesystemBlobStore
+from dstm.tasks.metrics import WorkerMetrics, serve_metrics
+from dstm.tasks.prefork import install_shutdown_handler, run_prefork
+from dstm.tasks.profiling import TaskProfiler
+from dstm.tasks.types import TaskIdentity
+from dstm.tasks.wiring import AutoWiring
+
+logger = logging.getLogger(__name__)
 
 cli = Typer()
 
@@ -20,13 +34,230 @@ def setup(verbose: Annotated[bool, Option("-v")] = False):
 @cli.command()
 def worker(
     broker_uri: Annotated[str, Option(envvar="DSTM_BROKER_URI")],
-    queues: Annotated[str, Option(envvar="DSTM_WORKER_QUEUES")] = "dstm",
+    queues: Annotated[
+        str,
+        Option(
+            envvar="DSTM_WORKER_QUEUES",
+            help="Comma-separated queues, each optionally with a weight, "
+            "e.g. high:10,default:3,bulk:1",
+        ),
+    ] = "dstm",
+    strict_priority: Annotated[
+        bool,
+        Option(
+            envvar="DSTM_WORKER_STRICT_PRIORITY",
+            help="Treat queue weights as strict priorities",
+        ),
+    ] = False,
     queue_prefix: Annotated[str, Option(envvar="DSTM_QUEUE_PREFIX")] = "",
+    concurrency: Annotated[int, Option(envvar="DSTM_WORKER_CONCURRENCY")] = 1,
+    max_attempts: Annotated[
+        int | None,
+        Option(
+            envvar="DSTM_WORKER_MAX_ATTEMPTS",
+            help="Move messages to their queue's dead-letter queue after this many "
+            "deliveries",
+        ),
+    ] = None,
+    task_timeout: Annotated[
+        float | None,
+        Option(
+            envvar="DSTM_TASK_TIMEOUT",
+            help="Interrupt tasks (that don't set their own timeout) after this many "
+            "seconds",
+        ),
+    ] = None,
+    processes: Annotated[int, Option(envvar="DSTM_WORKER_PROCESSES")] = 1,
+    use_asyncio: Annotated[
+        bool, Option("--asyncio", envvar="DSTM_WORKER_ASYNCIO")
+    ] = False,
+    claim_check_dir: Annotated[
+        str | None, Option(envvar="DSTM_CLAIM_CHECK_DIR")
+    ] = None,
+    preload: Annotated[
+        str,
+        Option(
+            envvar="DSTM_WORKER_PRELOAD",
+            help="Comma-separated task modules to import before consuming",
+        ),
+    ] = "",
+    metrics_port: Annotated[
+        int | None,
+        Option(
+            envvar="DSTM_METRICS_PORT",
+            help="Serve Prometheus metrics on this port (plus the process index, "
+            "with several processes)",
+        ),
+    ] = None,
+    metrics_host: Annotated[
+        str,
+        Option(
+            envvar="DSTM_METRICS_HOST",
+            help="Address to serve metrics on; 0.0.0.0 for all interfaces",
+        ),
+    ] = "127.0.0.1",
+    profile_sample_rate: Annotated[
+        float,
+        Option(
+            envvar="DSTM_PROFILE_SAMPLE_RATE",
+            help="Fraction of tasks to run under cProfile",
+        ),
+    ] = 0.0,
+    profile_dir: Annotated[
+        str, Option(envvar="DSTM_PROFILE_DIR", help="Where to write task profiles")
+    ] = "dstm-profiles",
+    profile_interval: Annotated[
+        float,
+        Option(
+            envvar="DSTM_PROFILE_INTERVAL",
+            help="Seconds between writing out task profiles (also written on SIGUSR1)",
+        ),
+    ] = 60.0,
 ):
-    queuelist = queues.split(",")
-    broker = TaskBroker(queue_prefix=queue_prefix, client=client_from_uri(broker_uri))
+    queuelist = _parse_queues(queues, strict_priority)
+    preload_modules = [m for m in preload.split(",") if m]
+    broker = _broker(broker_uri, queue_prefix, claim_check_dir)
     broker.create_queues(queues=queuelist)
-    broker.run_worker(queues=queuelist)
+    if preload_modules:
+        # Import task modules up front (before forking any worker processes, so they
+        # share them) rather than when the first message for each task arrives
+        _report_tasks(_preload(broker, preload_modules))
+    run = partial(
+        _run_worker_process,
+        broker_uri,
+        queue_prefix,
+        claim_check_dir,
+        preload_modules,
+        metrics_port,
+        metrics_host,
+        (profile_sample_rate, profile_dir, profile_interval),
+        queuelist,
+        concurrency,
+        max_attempts,
+        task_timeout,
+        use_asyncio,
+    )
+    if processes > 1:
+        run_prefork(run, processes)
+    else:
+        run(0, install_shutdown_handler())
+
+
+def _parse_queues(spec: str, strict_priority: bool) -> list[str] | dict[str, int]:
+    """Parse "a,b" into a list of queue names, or "a:3,b:1" into their weights (or
+    priorities)."""
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition(":")
+        weights[name] = int(weight) if weight else 1
+    if strict_priority:
+        return QueuePriorities(weights)
+    if ":" not in spec:
+        return list(weights)
+    return weights
+
+
+def _broker(
+    broker_uri: str, queue_prefix: str, claim_check_dir: str | None
+) -> TaskBroker:
+    return TaskBroker(
+        queue_prefix=queue_prefix,
+        client=client_from_uri(broker_uri),
+        # Large task arguments are passed via files in this (shared) directory
+        claim_check=(
+            ClaimCheck(FilesystemBlobStore(claim_check_dir))
+            if claim_check_dir
+            else None
+        ),
+    )
+
+
+def _preload(broker: TaskBroker, modules: list[str]) -> dict[str, TaskIdentity]:
+    if not isinstance(broker.wiring, AutoWiring):
+        raise WiringError("Only autowired tasks can be preloaded")
+    return broker.wiring.preload(modules)
+
+
+def _report_tasks(tasks: dict[str, TaskIdentity]) -> None:
+    lines = "".join(
+        f"\n    {name} (queue {identity.queue})"
+        for name, identity in sorted(tasks.items())
+    )
+    logger.info(f"Preloaded {len(tasks)} tasks:{lines}")
+
+
+def _run_worker_process(
+    broker_uri: str,
+    queue_prefix: str,
+    claim_check_dir: str | None,
+    preload: list[str],
+    metrics_port: int | None,
+    metrics_host: str,
+    profile: tuple[float, str, float],
+    queues: list[str] | dict[str, int],
+    concurrency: int,
+    max_attempts: int | None,
+    task_timeout: float | None,
+    use_asyncio: bool,
+    index: int,
+    shutdown: threading.Event,
+):
+    # Each worker process makes its own client, so no connections are shared with the
+    # supervisor across a fork.
+    broker = _broker(broker_uri, queue_prefix, claim_check_dir)
+    if preload:
+        _preload(broker, preload)
+    metrics = None
+    server = None
+    if metrics_port is not None:
+        metrics = WorkerMetrics()
+        server = serve_metrics(metrics, metrics_port + index, host=metrics_host)
+    profiler = _profiler(*profile)
+    try:
+        if use_asyncio:
+            asyncio.run(
+                broker.run_async_worker(
+                    queues=queues,
+                    concurrency=concurrency,
+                    shutdown=shutdown,
+                    metrics=metrics,
+                    profiler=profiler,
+                    max_attempts=max_attempts,
+                    timeout=task_timeout,
+                )
+            )
+        else:
+            broker.run_worker(
+                queues=queues,
+                concurrency=concurrency,
+                shutdown=shutdown,
+                metrics=metrics,
+                profiler=profiler,
+                max_attempts=max_attempts,
+                timeout=task_timeout,
+            )
+    finally:
+        if profiler is not None:
+            profiler.dump()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+
+def _profiler(
+    sample_rate: float, output_dir: str, interval: float
+) -> TaskProfiler | None:
+    if sample_rate <= 0:
+        return None
+    profiler = TaskProfiler(sample_rate, output_dir, dump_interval=interval)
+    if hasattr(signal, "SIGUSR1"):
+        # Write profiles on demand, from a thread since a task may be being profiled
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: threading.Thread(target=profiler.dump).start(),
+        )
+    logger.info(f"Profiling {sample_rate:.1%} of tasks, writing to {output_dir}")
+    return profiler
 
 
 @cli.command()
@@ -36,11 +267,36 @@ def submit(
     queue_prefix: Annotated[str, Option(envvar="DSTM_QUEUE_PREFIX")] = "",
     args_json: Annotated[str, Option()] = "[]",
     kwargs_json: Annotated[str, Option()] = "{}",
+    claim_check_dir: Annotated[
+        str | None, Option(envvar="DSTM_CLAIM_CHECK_DIR")
+    ] = None,
+    delay: Annotated[
+        float | None, Option(help="Seconds to wait before running the task")
+    ] = None,
 ):
-    broker = TaskBroker(queue_prefix=queue_prefix, client=client_from_uri(broker_uri))
+    broker = _broker(broker_uri, queue_prefix, claim_check_dir)
     args = json.loads(args_json)
     kwargs = json.loads(kwargs_json)
-    broker.submit(broker.wiring.get_task_by_name(task), *args, **kwargs)
+    broker.with_options(delay=delay).submit(
+        broker.wiring.get_task_by_name(task), *args, **kwargs
+    )
+
+
+@cli.command()
+def redrive(
+    queue: str,
+    broker_uri: Annotated[str, Option(envvar="DSTM_BROKER_URI")],
+    queue_prefix: Annotated[str, Option(envvar="DSTM_QUEUE_PREFIX")] = "",
+    limit: Annotated[int | None, Option(help="Move at most this many messages")] = None,
+    idle_timeout: Annotated[
+        float,
+        Option(help="Stop once no message has arrived for this many seconds"),
+    ] = 5.0,
+):
+    """Move messages from a queue's dead-letter queue back onto it."""
+    broker = _broker(broker_uri, queue_prefix, None)
+    count = broker.redrive(queue, limit=limit, idle_timeout=idle_timeout)
+    echo(f"Moved {count} messages back to {queue}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+"""Dead-letter queues, where workers set aside messages whose tasks keep failing.
+
+A message is moved to its queue's dead-letter queue (named after it, plus "-dlq") once
+its task's retry policy gives up on it, or it has been delivered as many times as the
+worker allows for its queue. That way poison messages, such as those that can't be
+decoded, don't keep taking up workers or hide the real backlog. The last error and its
+traceback are added to the message's headers, and any offloaded arguments are kept, so
+the messages can be moved back with redrive_dead_letters() once the problem is fixed."""
+
+import logging
+import time
+import traceback
+
+from dstm.client.base import MessageConnection
+from dstm.message import Message
+from dstm.tasks.types import ENQUEUED_AT_HEADER
+
+logger = logging.getLogger(__name__)
+
+DLQ_SUFFIX = "-dlq"
+
+# Message headers describing why a message was dead-lettered
+ERROR_HEADER = "dstm-error"
+TRACEBACK_HEADER = "dstm-traceback"
+
+# Errors and tracebacks are truncated to this many characters (keeping the end of
+# tracebacks), to stay well within brokers' limits on message size
+MAX_ERROR_LENGTH = 1024
+MAX_TRACEBACK_LENGTH = 8 * 1024
+
+
+def dead_letter_queue(queue: str) -> str:
+    """The name of a queue's dead-letter queue."""
+    return queue + DLQ_SUFFIX
+
+
+def dead_letter(message: Message, error: BaseException) -> Message:
+    """The message to put on the dead-letter queue in place of `message`, whose task
+    failed with `error`."""
+    # The time it was enqueued is reset when it's redriven, and dropping it here leaves
+    # room for the error headers (SQS allows only 10 per message)
+    headers = {k: v for k, v in message.headers.items() if k != ENQUEUED_AT_HEADER}
+    headers[ERROR_HEADER] = f"{type(error).__name__}: {error}"[:MAX_ERROR_LENGTH]
+    headers[TRACEBACK_HEADER] = "".join(traceback.format_exception(error))[
+        -MAX_TRACEBACK_LENGTH:
+    ]
+    return message.copy(dead_letter_queue(message.queue), headers)
+
+
+def redrive_dead_letters(
+    conn: MessageConnection,
+    queue: str,
+    limit: int | None = None,
+    idle_timeout: float = 5.0,
+) -> int:
+    """Move up to `limit` messages from `queue`'s dead-letter queue back onto it, e.g.
+    once the bug that made their tasks fail has been fixed. Stops once no message has
+    arrived for `idle_timeout` seconds. Returns the number of messages moved."""
+    dlq = dead_letter_queue(queue)
+    count = 0
+    if limit is not None and limit <= 0:
+        return count
+    last_received = time.monotonic()
+    messages = conn.listen(
+        dlq, on_idle=lambda: time.monotonic() - last_received >= idle_timeout
+    )
+    for message in messages:
+        headers = {
+            k: v
+            for k, v in message.headers.items()
+            if k not in (ERROR_HEADER, TRACEBACK_HEADER)
+        }
+        headers[ENQUEUED_AT_HEADER] = str(time.time())
+        conn.publish(message.copy(queue, headers))
+        conn.ack(message)
+        count += 1
+        last_received = time.monotonic()
+        if limit is not None and count >= limit:
+            break
+    messages.close()
+    conn.flush()
+    logger.info(f"Moved {count} messages from {dlq} back to {queue}")
+    return count
@@ -0,0 +1,149 @@
+"""Worker metrics, served in the Prometheus text format.
+
+Kept dependency-free: the few metric types a worker needs are implemented here, and
+served by the standard library's HTTP server."""
+
+import bisect
+import logging
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import ClassVar
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, in seconds
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+    900.0,
+)
+
+# (task name, queue)
+Labels = tuple[str, str]
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.counts = [0] * (len(buckets) + 1)  # the last is for +Inf
+        self.sum = 0.0
+
+
+class WorkerMetrics:
+    """Counts of the tasks a worker has handled, and histograms of how long they took
+    to run and waited to be received, labelled by task name and queue. Safe to update
+    from multiple threads."""
+
+    COUNTERS: ClassVar[dict[str, str]] = {
+        "received": "Tasks received from the broker",
+        "succeeded": "Tasks that ran successfully",
+        "failed": "Tasks that raised an exception",
+        "timed_out": "Tasks interrupted for running longer than their timeout",
+        "requeued": "Tasks requeued to be run again",
+        "dead_lettered": "Tasks moved to a dead-letter queue",
+    }
+    HISTOGRAMS: ClassVar[dict[str, str]] = {
+        "duration": "Time spent running tasks, whether or not they succeeded",
+        "queue_wait": "Time from submission of tasks until a worker received them",
+    }
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[Labels, int]] = {
+            name: defaultdict(int) for name in self.COUNTERS
+        }
+        self._histograms: dict[str, dict[Labels, _Histogram]] = {
+            name: {} for name in self.HISTOGRAMS
+        }
+
+    def count(self, counter: str, task_name: str, queue: str) -> None:
+        with self._lock:
+            self._counters[counter][task_name, queue] += 1
+
+    def observe(
+        self, histogram: str, task_name: str, queue: str, seconds: float
+    ) -> None:
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            if (h := self._histograms[histogram].get((task_name, queue))) is None:
+                h = self._histograms[histogram][task_name, queue] = _Histogram(
+                    self.buckets
+                )
+            h.counts[index] += 1
+            h.sum += seconds
+
+    def render(self) -> str:
+        """The current values, in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name, help in self.COUNTERS.items():
+                metric = f"dstm_tasks_{name}_total"
+                lines += [f"# HELP {metric} {help}", f"# TYPE {metric} counter"]
+                for labels, value in sorted(self._counters[name].items()):
+                    lines.append(f"{metric}{{{_labels(labels)}}} {value}")
+            for name, help in self.HISTOGRAMS.items():
+                metric = f"dstm_task_{name}_seconds"
+                lines += [f"# HELP {metric} {help}", f"# TYPE {metric} histogram"]
+                for labels, h in sorted(self._histograms[name].items()):
+                    label_text = _labels(labels)
+                    cumulative = 0
+                    for bound, count in zip(
+                        [*self.buckets, "+Inf"], h.counts, strict=True
+                    ):
+                        cumulative += count
+                        lines.append(
+                            f'{metric}_bucket{{{label_text},le="{bound}"}} {cumulative}'
+                        )
+                    lines.append(f"{metric}_sum{{{label_text}}} {h.sum}")
+                    lines.append(f"{metric}_count{{{label_text}}} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels: Labels) -> str:
+    task_name, queue = labels
+    return f'task="{_escape(task_name)}",queue="{_escape(queue)}"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def serve_metrics(
+    metrics: WorkerMetrics, port: int, host: str = "127.0.0.1"
+) -> ThreadingHTTPServer:
+    """Serve `metrics` over HTTP from a background thread. To stop, call shutdown()
+    and then server_close() on the returned server."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Don't log every scrape
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(
+        target=server.serve_forever, name="dstm-metrics", daemon=True
+    ).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
@@ -0,0 +1,119 @@
+"""Run several worker processes under a supervisor that restarts them if they die."""
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import multiprocessing.context
+import multiprocessing.process
+import signal
+import threading
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+#: A worker process entry point, called with the process index (0 to processes - 1)
+#: and an event that is set when the worker should shut down.
+WorkerTarget = Callable[[int, threading.Event], None]
+
+
+def install_shutdown_handler() -> threading.Event:
+    """Make SIGTERM request a clean shutdown instead of killing the process outright.
+    Returns an event that is set when SIGTERM is received."""
+    shutdown = threading.Event()
+
+    def handle(signum, frame):
+        logger.info("Received SIGTERM, finishing current tasks before exiting.")
+        shutdown.set()
+
+    signal.signal(signal.SIGTERM, handle)
+    return shutdown
+
+
+def run_prefork(
+    target: WorkerTarget,
+    processes: int,
+    restart_delay: float = 1.0,
+    shutdown_timeout: float = 60.0,
+) -> None:
+    """Run `target` in `processes` child processes until SIGTERM or SIGINT is received.
+
+    Children are forked where possible, so anything imported before calling this (e.g.
+    task modules) is shared with them rather than imported again in each one. A child
+    that exits for any reason is replaced, waiting at least `restart_delay` seconds
+    between starts of the same slot so a crashing worker can't spin. On shutdown,
+    SIGTERM is passed on to the children so they can finish their current tasks; any
+    still running after `shutdown_timeout` seconds are killed."""
+    methods = multiprocessing.get_all_start_methods()
+    ctx: multiprocessing.context.ForkContext | multiprocessing.context.SpawnContext
+    if "fork" in methods:
+        ctx = multiprocessing.get_context("fork")
+    else:
+        ctx = multiprocessing.get_context("spawn")
+
+    stopping = threading.Event()
+
+    def handle(signum, frame):
+        if not stopping.is_set():
+            logger.info(f"Supervisor received signal {signum}, stopping workers.")
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, handle)
+    signal.signal(signal.SIGINT, handle)
+
+    children: dict[int, multiprocessing.process.BaseProcess] = {}
+    started: dict[int, float] = {}
+    restart_at: dict[int, float] = {}
+
+    def start(index: int):
+        child = ctx.Process(
+            target=_child_main, args=(target, index), name=f"dstm-worker-{index}"
+        )
+        child.start()
+        children[index] = child
+        started[index] = time.monotonic()
+        logger.info(f"Started worker process {index} (pid {child.pid})")
+
+    for index in range(processes):
+        start(index)
+
+    try:
+        while not stopping.is_set():
+            alive = [child.sentinel for child in children.values() if child.is_alive()]
+            multiprocessing.connection.wait(alive, timeout=restart_delay)
+            if stopping.is_set():
+                break
+            for index, child in children.items():
+                if child.exitcode is not None and index not in restart_at:
+                    logger.warning(
+                        f"Worker process {index} (pid {child.pid}) exited with code "
+                        f"{child.exitcode}, restarting."
+                    )
+                    restart_at[index] = started[index] + restart_delay
+            now = time.monotonic()
+            for index, due in list(restart_at.items()):
+                if now >= due:
+                    del restart_at[index]
+                    start(index)
+    finally:
+        _stop_children(list(children.values()), shutdown_timeout)
+
+
+def _child_main(target: WorkerTarget, index: int) -> None:
+    # Ctrl-C in a terminal signals the whole process group; leave it to the supervisor
+    # to decide how to shut children down.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    target(index, install_shutdown_handler())
+
+
+def _stop_children(children: list, timeout: float) -> None:
+    alive = [child for child in children if child.is_alive()]
+    for child in alive:
+        child.terminate()  # i.e. SIGTERM, which the child turns into a clean shutdown
+    deadline = time.monotonic() + timeout
+    for child in alive:
+        child.join(max(0, deadline - time.monotonic()))
+        if child.is_alive():
+            logger.warning(f"Worker process {child.pid} didn't stop in time, killing.")
+            child.kill()
+            child.join()
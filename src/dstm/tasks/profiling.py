@@ -0,0 +1,99 @@
+"""Profiling a sample of the tasks a worker runs, to find hot spots in task code under
+real traffic.
+
+Sampled tasks are run under cProfile, and their statistics are aggregated per task name
+and written out periodically as pstats files (one per task name and worker process),
+which can be inspected with `python -m pstats` or tools such as snakeviz."""
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+
+class TaskProfiler:
+    """Profiles roughly `sample_rate` (between 0 and 1) of the tasks it's asked to,
+    writing the aggregated statistics to `output_dir` at least every `dump_interval`
+    seconds while tasks are being run, and when dump() is called.
+
+    Only one task is profiled at a time (Python allows only one active profiler), so
+    with concurrent tasks fewer than `sample_rate` may be sampled. Since Python 3.12 a
+    profile also includes anything other threads run meanwhile, so sampled profiles are
+    clearest from workers running one task at a time."""
+
+    def __init__(
+        self,
+        sample_rate: float,
+        output_dir: Path | str,
+        dump_interval: float = 60.0,
+    ):
+        self.sample_rate = sample_rate
+        self.output_dir = Path(output_dir)
+        self.dump_interval = dump_interval
+        self._profiling = threading.Lock()
+        # Guards _stats and _dirty
+        self._lock = threading.Lock()
+        self._stats: dict[str, pstats.Stats] = {}
+        self._dirty: set[str] = set()
+        self._last_dump = time.monotonic()
+
+    @contextmanager
+    def profile(self, task_name: str) -> Iterator[None]:
+        """Run the body under the profiler, if this task is sampled. Either way, write
+        out the statistics afterwards if it's been `dump_interval` seconds since they
+        last were, so those of earlier samples don't wait for the next one."""
+        try:
+            if random.random() >= self.sample_rate or not self._profiling.acquire(
+                blocking=False
+            ):
+                yield
+            else:
+                with self._sampled(task_name):
+                    yield
+        finally:
+            if time.monotonic() - self._last_dump >= self.dump_interval:
+                self.dump()
+
+    @contextmanager
+    def _sampled(self, task_name: str) -> Iterator[None]:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+        finally:
+            self._profiling.release()
+        with self._lock:
+            if (stats := self._stats.get(task_name)) is None:
+                self._stats[task_name] = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+            self._dirty.add(task_name)
+
+    def dump(self) -> None:
+        """Write out the statistics for each task name sampled since the last dump."""
+        with self._lock:
+            self._last_dump = time.monotonic()
+            if not self._dirty:
+                return
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            for task_name in sorted(self._dirty):
+                path = self.output_dir / f"{_safe_name(task_name)}.{os.getpid()}.pstats"
+                self._stats[task_name].dump_stats(path)
+                logger.info(f"Wrote profile of {task_name} to {path}")
+            self._dirty.clear()
+
+
+def _safe_name(task_name: str) -> str:
+    return re.sub(r"[^\w.-]", "_", task_name)
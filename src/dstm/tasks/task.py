@@ -3,7 +3,7 @@ from dataclasses import dataclass
 from functools import update_wrapper
 from typing import TYPE_CHECKING, Callable, Generic, ParamSpec, TypeVar
 
-from dstm.tasks.types import TaskFunc
+from dstm.tasks.types import RetryPolicy, TaskFunc
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +23,11 @@ class TaskWrapper(Generic[P, R], TaskFunc[P]):
     func: Callable[P, R]
     queue: str
     __name__: str
+    # How to retry the task if it fails; the worker's default policy if not set
+    retry: RetryPolicy | None = None
+    # Seconds the task may run for before it's interrupted; the worker's default if not
+    # set
+    timeout: float | None = None
 
     def __call__(self, *args: P.args, **kwargs: P.kwargs) -> R:
         return self.func(*args, **kwargs)
@@ -32,9 +37,11 @@ class TaskWrapper(Generic[P, R], TaskFunc[P]):
         broker.submit(self, *args, **kwargs)
 
 
-def task(queue: str):
+def task(queue: str, retry: RetryPolicy | None = None, timeout: float | None = None):
     def decorator(func: Callable[P, R]) -> TaskWrapper[P, R]:
-        wrapper = TaskWrapper(func, queue, __name__=func.__name__)
+        wrapper = TaskWrapper(
+            func, queue, __name__=func.__name__, retry=retry, timeout=timeout
+        )
         update_wrapper(wrapper, func)
         return wrapper
 
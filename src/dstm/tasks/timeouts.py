@@ -0,0 +1,103 @@
+"""Time limits for tasks, so one that hangs (e.g. on a network call with no timeout of
+its own) can't hold on to a worker, and its message, forever.
+
+A task that runs for too long has TaskTimeoutError raised in it. On the main thread
+this is done with SIGALRM, which also interrupts blocking system calls. On other
+threads (those of a worker with concurrency > 1, or running plain function tasks for an
+async worker) it's done with PyThreadState_SetAsyncExc, which only takes effect once
+the thread next runs Python code: a call blocked in C code, such as a socket read
+without a timeout, isn't interrupted until it returns. Coroutine tasks are cancelled.
+
+Either way, a task that catches all exceptions may swallow the error and carry on."""
+
+import asyncio
+import ctypes
+import signal
+import threading
+from collections.abc import Awaitable, Iterator
+from contextlib import contextmanager
+from typing import TypeVar
+
+from dstm.exceptions import TaskTimeoutError
+
+T = TypeVar("T")
+
+
+@contextmanager
+def time_limit(seconds: float | None) -> Iterator[None]:
+    """Raise TaskTimeoutError in the body if it runs for longer than `seconds`."""
+    if seconds is None:
+        yield
+    elif (
+        hasattr(signal, "setitimer")
+        and threading.current_thread() is threading.main_thread()
+    ):
+        with _alarm(seconds):
+            yield
+    else:
+        with _async_exception(seconds):
+            yield
+
+
+@contextmanager
+def _alarm(seconds: float) -> Iterator[None]:
+    def expired(signum, frame):
+        raise TaskTimeoutError(f"Timed out after {seconds} seconds")
+
+    previous = signal.signal(signal.SIGALRM, expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+@contextmanager
+def _async_exception(seconds: float) -> Iterator[None]:
+    thread_id = threading.get_ident()
+    # Held while raising, so the exception can't be raised after the body has finished
+    lock = threading.Lock()
+    running = True
+
+    def expired():
+        with lock:
+            if running:
+                _set_async_exception(thread_id, TaskTimeoutError)
+
+    timer = threading.Timer(seconds, expired)
+    timer.daemon = True
+    timer.start()
+    try:
+        yield
+    finally:
+        timer.cancel()
+        with lock:
+            running = False
+            # The body finished after all: don't raise in whatever the thread runs next
+            _set_async_exception(thread_id, None)
+
+
+def _set_async_exception(thread_id: int, exception: type | None) -> None:
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread_id),
+        None if exception is None else ctypes.py_object(exception),
+    )
+
+
+async def wait_with_time_limit(awaitable: Awaitable[T], seconds: float | None) -> T:
+    """Await a coroutine task, cancelling it and raising TaskTimeoutError if it takes
+    longer than `seconds`. Unlike asyncio.wait_for(), TimeoutErrors raised by the task
+    itself aren't mistaken for it timing out."""
+    if seconds is None:
+        return await awaitable
+    task = asyncio.ensure_future(awaitable)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=seconds)
+    finally:
+        if not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+    if not done:
+        raise TaskTimeoutError(f"Timed out after {seconds} seconds")
+    return task.result()
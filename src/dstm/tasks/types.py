@@ -1,7 +1,12 @@
+import random
+import time
 import uuid
 from dataclasses import dataclass, field
+from datetime import datetime
 from typing import Any, Generic, ParamSpec, Protocol
 
+from dstm.message import ETA_HEADER, PRIORITY_HEADER
+
 P = ParamSpec("P")
 
 
@@ -20,7 +25,15 @@ class TaskIdentity:
     queue: str
 
 
-@dataclass
+# Message headers identifying the task instance, so it can be routed and logged
+# without decoding the message body
+TASK_NAME_HEADER = "dstm-task-name"
+TASK_ID_HEADER = "dstm-task-id"
+# When the task was submitted (as a Unix timestamp), to measure how long it queued
+ENQUEUED_AT_HEADER = "dstm-enqueued-at"
+
+
+@dataclass(slots=True)
 class TaskInstance:
     task_name: str
     args: list | tuple
@@ -28,4 +41,85 @@ class TaskInstance:
     task_instance_id: str = field(default_factory=lambda: str(uuid.uuid4()))
 
     def __str__(self):
-        return f"TaskInstance({self.task_name},{self.task_instance_id})"
+        return describe_task(self.task_name, self.task_instance_id)
+
+    def to_body(self) -> dict[str, Any]:
+        """The message body for this instance. Unlike dataclasses.asdict(), this
+        doesn't copy the arguments."""
+        return {
+            "task_name": self.task_name,
+            "args": self.args,
+            "kwargs": self.kwargs,
+            "task_instance_id": self.task_instance_id,
+        }
+
+    @classmethod
+    def from_body(cls, body: dict[str, Any]) -> "TaskInstance":
+        return cls(
+            body["task_name"], body["args"], body["kwargs"], body["task_instance_id"]
+        )
+
+    def headers(self) -> dict[str, str]:
+        return {
+            TASK_NAME_HEADER: self.task_name,
+            TASK_ID_HEADER: self.task_instance_id,
+            ENQUEUED_AT_HEADER: str(time.time()),
+        }
+
+
+@dataclass(frozen=True)
+class SubmitOptions:
+    """How task instances are submitted; see TaskBroker.with_options()."""
+
+    #: Message priority (higher first), on queues that support it: see
+    #: AMQPClient.max_priority
+    priority: int | None = None
+    #: Seconds after submission to wait before running the task
+    delay: float | None = None
+    #: When to run the task; naive datetimes are taken to be in local time
+    eta: datetime | None = None
+
+    def __post_init__(self):
+        if self.delay is not None and self.eta is not None:
+            raise ValueError("Cannot provide both `delay` and `eta`")
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if self.priority is not None:
+            headers[PRIORITY_HEADER] = str(self.priority)
+        if self.delay is not None:
+            headers[ETA_HEADER] = str(time.time() + self.delay)
+        elif self.eta is not None:
+            headers[ETA_HEADER] = str(self.eta.timestamp())
+        return headers
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """When to retry a task that fails: after an exponentially increasing delay,
+    `initial_delay` seconds after the first failure and `multiplier` times longer after
+    each one after that, up to `max_delay`. With `jitter`, each delay is randomly cut by
+    up to half, so tasks that failed together don't all retry together. After
+    `max_attempts` attempts (if set), the task is given up on."""
+
+    max_attempts: int | None = None
+    initial_delay: float = 1.0
+    max_delay: float = 600.0
+    multiplier: float = 2.0
+    jitter: bool = True
+
+    def delay(self, attempt: int) -> float | None:
+        """How many seconds to wait before retrying after attempt number `attempt`
+        (starting at 1) failed, or None to give up."""
+        if self.max_attempts is not None and attempt >= self.max_attempts:
+            return None
+        # Capping the exponent keeps huge attempt counts from overflowing
+        growth = self.multiplier ** min(attempt - 1, 64)
+        delay = min(self.initial_delay * growth, self.max_delay)
+        if self.jitter:
+            delay = random.uniform(delay / 2, delay)
+        return delay
+
+
+def describe_task(task_name: str, task_instance_id: str) -> str:
+    return f"TaskInstance({task_name},{task_instance_id})"
@@ -1,8 +1,9 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from importlib import import_module
-from typing import Generic, Protocol, TypeVar
+from typing import Generic, Iterable, Protocol, TypeVar
 
 from dstm.exceptions import WiringError
+from dstm.tasks.task import TaskWrapper
 from dstm.tasks.types import TaskFunc, TaskIdentity
 
 T = TypeVar("T", bound=TaskFunc)
@@ -15,7 +16,13 @@ class TaskWiring(Generic[T], Protocol):
 
 @dataclass
 class AutoWiring(TaskWiring[T]):
+    """Wiring where a task's name is "module:function", so that workers can import
+    tasks on demand. Looked-up tasks are cached, and task modules can be imported ahead
+    of time with preload()."""
+
     default_queue: str | None = None
+    # Task name -> implementation, for tasks looked up or preloaded so far
+    _tasks: dict[str, T] = field(default_factory=dict, init=False, repr=False)
 
     def get_task_identity(self, func: T) -> TaskIdentity:
         queue = getattr(func, "queue", self.default_queue)
@@ -27,8 +34,31 @@ class AutoWiring(TaskWiring[T]):
         return TaskIdentity(f"{func.__module__}:{func.__name__}", queue)
 
     def get_task_by_name(self, task_name: str) -> T:
-        module, name = task_name.split(":")
-        return getattr(import_module(module), name)
+        try:
+            return self._tasks[task_name]
+        except KeyError:
+            pass
+        module, _, name = task_name.partition(":")
+        try:
+            func = getattr(import_module(module), name)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise WiringError(f"Could not import task {task_name}: {e}") from e
+        self._tasks[task_name] = func
+        return func
+
+    def preload(self, modules: Iterable[str]) -> dict[str, TaskIdentity]:
+        """Import the given task modules, and cache the @task-decorated functions in
+        them so workers can look them up without importing anything. Returns the
+        identities of the tasks found, by name."""
+        found = {}
+        for module_name in modules:
+            module = import_module(module_name)
+            for value in vars(module).values():
+                if isinstance(value, TaskWrapper):
+                    identity = self.get_task_identity(value)  # type: ignore
+                    self._tasks[identity.name] = value  # type: ignore
+                    found[identity.name] = identity
+        return found
 
 
 class HardWiring(TaskWiring[T]):
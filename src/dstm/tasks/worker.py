@@ -1,45 +1,524 @@
 """Run an autowired dstm worker."""
 
+import asyncio
+import dataclasses
+import inspect
 import logging
+import queue
+import threading
 import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from dataclasses import dataclass
 
-from dstm.client.base import MessageClient
-from dstm.tasks.types import TaskInstance
+from dstm.client.aio import connect_async
+from dstm.client.base import AsyncMessageConnection, MessageClient, MessageConnection
+from dstm.exceptions import DeliveryLimitError, MissingPayloadError, TaskTimeoutError
+from dstm.message import ETA_HEADER, Message, eta_delay
+from dstm.tasks.claimcheck import KEY_HEADER, ClaimCheck, claim_instance
+from dstm.tasks.deadletter import dead_letter, dead_letter_queue
+from dstm.tasks.metrics import WorkerMetrics
+from dstm.tasks.profiling import TaskProfiler
+from dstm.tasks.timeouts import time_limit, wait_with_time_limit
+from dstm.tasks.types import (
+    ENQUEUED_AT_HEADER,
+    TASK_ID_HEADER,
+    TASK_NAME_HEADER,
+    RetryPolicy,
+    TaskInstance,
+    describe_task,
+)
 from dstm.tasks.wiring import TaskWiring
 
 logger = logging.getLogger(__name__)
 
+# Messages received less than this many seconds before their ETA are run anyway, rather
+# than delayed again
+ETA_TOLERANCE = 0.05
 
-def run_task(instance: TaskInstance, wiring: TaskWiring):
+
+def run_task(instance: TaskInstance, wiring: TaskWiring, timeout: float | None = None):
     impl = wiring.get_task_by_name(instance.task_name)
-    impl(*instance.args, **instance.kwargs)
+    with time_limit(timeout):
+        result = impl(*instance.args, **instance.kwargs)
+    if inspect.isawaitable(result):
+        # An async task run by a synchronous worker
+        asyncio.run(wait_with_time_limit(result, timeout))
+
+
+def is_async_task(impl) -> bool:
+    """Whether a task implementation is a coroutine function (or wraps one)."""
+    return inspect.iscoroutinefunction(impl) or inspect.iscoroutinefunction(
+        getattr(impl, "func", None)
+    )
 
 
 def run_worker(
     client: MessageClient,
-    queues: list[str],
+    queues: list[str] | Mapping[str, int],
     wiring: TaskWiring,
     time_limit: int | None = None,
     task_limit: int | None = None,
     raise_errors: bool = False,
+    concurrency: int = 1,
+    shutdown: threading.Event | None = None,
+    claim_check: ClaimCheck | None = None,
+    metrics: WorkerMetrics | None = None,
+    profiler: TaskProfiler | None = None,
+    retry: RetryPolicy | None = None,
+    max_attempts: int | Mapping[str, int] | None = None,
+    timeout: float | None = None,
 ):
+    """Execute tasks from the given queues, which may be a mapping of queue names to
+    weights or priorities (see dstm.client.scheduling). With concurrency > 1, up to that
+    many tasks are run at once on a thread pool; acks and requeues are still always sent
+    from this thread, since connections (in particular pika's) aren't thread-safe.
+    Messages are kept from being redelivered while their tasks run using the
+    connection's heartbeat(). Tasks that fail are retried after a delay, according to
+    their own retry policy or else `retry` (by default, backing off exponentially from
+    1 second to 10 minutes, and never giving up). Once a task's policy gives up, or
+    its message has been delivered `max_attempts` times (if given, either for all
+    queues or by queue name), the message is moved to its queue's dead-letter queue:
+    see dstm.tasks.deadletter. Tasks that run for longer than their own timeout or else
+    `timeout` seconds (if given) are interrupted and fail: see dstm.tasks.timeouts.
+
+    If `shutdown` is given, the worker stops taking new tasks once it is set, and
+    returns after settling the tasks it has already started. If `metrics` is given,
+    the tasks handled are recorded in it, and if `profiler` is given, a sample of them
+    is profiled."""
+    handler = _TaskHandler(
+        wiring,
+        raise_errors,
+        claim_check,
+        metrics,
+        profiler,
+        retry or RetryPolicy(),
+        max_attempts,
+        timeout,
+    )
+    if concurrency > 1:
+        client = _with_prefetch(client, concurrency)
     with client.connect() as conn:
         logger.info(f"Worker started using {client!r}, watching queues {queues}")
-        for index, message in enumerate(conn.listen(queues, time_limit=time_limit)):
-            instance = TaskInstance(**message.body)
-            logger.info(f"{instance} received")
-            try:
+        if concurrency > 1:
+            _run_concurrently(
+                conn, queues, handler, time_limit, task_limit, concurrency, shutdown
+            )
+            return
+        # Closed explicitly rather than when garbage collected (which a reference to
+        # this frame from a logged traceback can put off), so receiving stops promptly
+        with closing(
+            conn.listen(
+                queues,
+                time_limit=time_limit,
+                on_idle=shutdown.is_set if shutdown is not None else None,
+            )
+        ) as messages:
+            handled = 0
+            for message in messages:
+                if (later := handler.postponed(message)) is not None:
+                    conn.publish(later)
+                    conn.ack(message)
+                    continue
+                label = handler.received(message)
                 t0 = time.perf_counter()
-                run_task(instance, wiring)
-                dt = time.perf_counter() - t0
-            except Exception:
-                if raise_errors:
-                    raise
-                logger.exception(f"{instance} failed, requeuing.")
-                conn.requeue(message)
-            else:
-                logger.info(f"{instance} succeeded in {dt:.1e} seconds.")
+                try:
+                    with conn.heartbeat(message):
+                        handler.run(message)
+                except Exception as e:
+                    handler.settle(conn, message, label, e, time.perf_counter() - t0)
+                else:
+                    handler.settle(conn, message, label, None, time.perf_counter() - t0)
+                handled += 1
+                if task_limit is not None and handled >= task_limit:
+                    logger.info(f"Worker hit task limit of {task_limit}, terminating.")
+                    break
+                if shutdown is not None and shutdown.is_set():
+                    logger.info("Worker shutting down.")
+                    break
+
+
+def _run_concurrently(
+    conn: MessageConnection,
+    queues: list[str] | Mapping[str, int],
+    handler: "_TaskHandler",
+    time_limit: int | None,
+    task_limit: int | None,
+    concurrency: int,
+    shutdown: threading.Event | None,
+):
+    # Pool threads report (message, label, error, duration) here when they finish
+    finished: queue.Queue = queue.Queue()
+    in_flight = 0
+
+    def execute(message: Message, label: str):
+        # Message bodies are decoded here, on the pool threads
+        t0 = time.perf_counter()
+        try:
+            with conn.heartbeat(message):
+                handler.run(message)
+            finished.put((message, label, None, time.perf_counter() - t0))
+        except Exception as e:
+            finished.put((message, label, e, time.perf_counter() - t0))
+
+    def settle_finished(block: bool = False) -> bool:
+        nonlocal in_flight
+        while in_flight:
+            try:
+                result = finished.get(block=block)
+            except queue.Empty:
+                break
+            in_flight -= 1
+            block = False
+            handler.settle(conn, *result)
+        return shutdown is not None and shutdown.is_set()
+
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="dstm-worker") as pool:
+        messages = conn.listen(queues, time_limit=time_limit, on_idle=settle_finished)
+        started = 0
+        for message in messages:
+            if (later := handler.postponed(message)) is not None:
+                conn.publish(later)
                 conn.ack(message)
-            if task_limit is not None and index + 1 >= task_limit:
+                continue
+            label = handler.received(message)
+            in_flight += 1
+            pool.submit(execute, message, label)
+            # Don't take on more messages than we have threads to run them
+            while in_flight >= concurrency:
+                settle_finished(block=True)
+            settle_finished()
+            started += 1
+            if task_limit is not None and started >= task_limit:
+                logger.info(f"Worker hit task limit of {task_limit}, terminating.")
+                break
+            if shutdown is not None and shutdown.is_set():
+                logger.info("Worker shutting down, waiting for running tasks.")
+                break
+        messages.close()
+        while in_flight:
+            settle_finished(block=True)
+
+
+async def run_worker_async(
+    client: MessageClient,
+    queues: list[str] | Mapping[str, int],
+    wiring: TaskWiring,
+    time_limit: int | None = None,
+    task_limit: int | None = None,
+    raise_errors: bool = False,
+    concurrency: int = 100,
+    shutdown: threading.Event | None = None,
+    claim_check: ClaimCheck | None = None,
+    metrics: WorkerMetrics | None = None,
+    profiler: TaskProfiler | None = None,
+    retry: RetryPolicy | None = None,
+    max_attempts: int | Mapping[str, int] | None = None,
+    timeout: float | None = None,
+):
+    """Execute tasks from the given queues on the running event loop, with up to
+    `concurrency` tasks in progress at once. Coroutine tasks run on the loop itself;
+    plain functions are run in the default executor so they don't block it. Only plain
+    function tasks are profiled by `profiler`."""
+    handler = _TaskHandler(
+        wiring,
+        raise_errors,
+        claim_check,
+        metrics,
+        profiler,
+        retry or RetryPolicy(),
+        max_attempts,
+        timeout,
+    )
+    client = _with_prefetch(client, concurrency)
+    async with connect_async(client, max_unsettled=concurrency) as conn:
+        logger.info(f"Async worker started using {client!r}, watching queues {queues}")
+        slots = asyncio.Semaphore(concurrency)
+        running: set[asyncio.Task] = set()
+        errors: list[BaseException] = []
+
+        def finished(task: asyncio.Task):
+            running.discard(task)
+            slots.release()
+            if not task.cancelled() and (error := task.exception()) is not None:
+                errors.append(error)
+
+        messages = conn.listen(queues, time_limit=time_limit)
+        index = 0
+        while (message := await _next_message(messages, shutdown)) is not None:
+            if (later := handler.postponed(message)) is not None:
+                await conn.publish(later)
+                await conn.ack(message)
+                continue
+            label = handler.received(message)
+            await slots.acquire()
+            task = asyncio.create_task(_run_async(conn, message, label, handler))
+            running.add(task)
+            task.add_done_callback(finished)
+            index += 1
+            if task_limit is not None and index >= task_limit:
                 logger.info(f"Worker hit task limit of {task_limit}, terminating.")
                 break
+            if errors:
+                break
+        await messages.aclose()
+        if running:
+            await asyncio.wait(running)
+        if errors:
+            raise errors[0]
+
+
+async def _next_message(messages, shutdown: threading.Event | None) -> Message | None:
+    """Get the next message, or None if listening has finished or we've been asked to
+    shut down."""
+    if shutdown is None:
+        return await anext(messages, None)
+    pending = asyncio.ensure_future(anext(messages, None))
+    while True:
+        done, _ = await asyncio.wait({pending}, timeout=0.1)
+        if done:
+            return pending.result()
+        if shutdown.is_set():
+            logger.info("Worker shutting down, waiting for running tasks.")
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
+            return None
+
+
+async def _run_async(
+    conn: AsyncMessageConnection,
+    message: Message,
+    label: str,
+    handler: "_TaskHandler",
+):
+    t0 = time.perf_counter()
+    try:
+        handler.check_attempts(message)
+        if KEY_HEADER in message.headers:
+            # Fetching offloaded arguments may mean reading a big file
+            instance = await asyncio.to_thread(
+                claim_instance, message, handler.claim_check
+            )
+        else:
+            instance = claim_instance(message, handler.claim_check)
+        impl = handler.wiring.get_task_by_name(instance.task_name)
+        async with conn.heartbeat(message):
+            if is_async_task(impl):
+                await wait_with_time_limit(
+                    impl(*instance.args, **instance.kwargs),
+                    handler.task_setting(instance.task_name, "timeout"),
+                )
+            else:
+                await asyncio.to_thread(handler.execute, instance)
+    except Exception as e:
+        outcome = handler.finished(message, label, e, time.perf_counter() - t0)
+        if isinstance(outcome, Message):
+            await conn.publish(outcome)
+            await conn.ack(message)
+        elif outcome is None:
+            await conn.ack(message)
+            handler.release(message)
+        else:
+            await conn.requeue(message, outcome)
+    else:
+        handler.finished(message, label, None, time.perf_counter() - t0)
+        await conn.ack(message)
+        handler.release(message)
+
+
+def _with_prefetch(client: MessageClient, concurrency: int) -> MessageClient:
+    """`client`, or if it limits how many unacked messages the broker sends it (as
+    AMQPClient.prefetch_count does) to fewer than `concurrency` tasks plus its buffered
+    acks need, a copy of it that allows enough."""
+    prefetch = getattr(client, "prefetch_count", None)
+    if prefetch is None or not dataclasses.is_dataclass(client):
+        return client
+    needed = concurrency + getattr(client, "ack_batch_size", 1) - 1
+    if prefetch >= needed:
+        return client
+    logger.info(
+        f"Raising prefetch_count from {prefetch} to {needed}, so it doesn't limit "
+        f"concurrency to fewer than {concurrency} tasks"
+    )
+    return dataclasses.replace(client, prefetch_count=needed)
+
+
+def describe_message(message: Message) -> str:
+    """How to refer to a task's message in logs, without decoding its body if
+    possible."""
+    task_name = message.headers.get(TASK_NAME_HEADER)
+    task_id = message.headers.get(TASK_ID_HEADER)
+    if task_name is not None and task_id is not None:
+        return describe_task(task_name, task_id)
+    # Submitted by an older version of dstm
+    try:
+        return str(TaskInstance.from_body(message.body))
+    except Exception:
+        return f"Undecodable message {message._id}"
+
+
+def _task_name(message: Message) -> str:
+    if (task_name := message.headers.get(TASK_NAME_HEADER)) is not None:
+        return task_name
+    try:
+        return message.body["task_name"]
+    except Exception:
+        return "unknown"
+
+
+@dataclass
+class _TaskHandler:
+    """How a worker runs the tasks it receives, and reports on and settles them
+    afterwards. Shared by the synchronous and asynchronous workers."""
+
+    wiring: TaskWiring
+    raise_errors: bool
+    claim_check: ClaimCheck | None
+    metrics: WorkerMetrics | None
+    profiler: TaskProfiler | None
+    # For tasks that don't have their own
+    retry: RetryPolicy
+    # Deliveries allowed before dead-lettering, for all queues or by queue name
+    max_attempts: int | Mapping[str, int] | None
+    # Seconds tasks may run for, for tasks that don't have their own timeout
+    timeout: float | None
+
+    def postponed(self, message: Message) -> Message | None:
+        """If a message has arrived before its ETA (brokers can only delay messages
+        for so long), the copy of it to publish to wait out the rest of the delay."""
+        if (delay := eta_delay(message)) <= ETA_TOLERANCE:
+            return None
+        logger.debug(
+            f"{describe_message(message)} isn't due for {delay:.1f} seconds, "
+            "delaying it again"
+        )
+        return message.copy(message.queue, dict(message.headers))
+
+    def received(self, message: Message) -> str:
+        """Note that a message has been received, returning its label for logs."""
+        label = describe_message(message)
+        logger.info(f"{label} received")
+        if self.metrics is not None:
+            task_name = _task_name(message)
+            self.metrics.count("received", task_name, message.queue)
+            if (enqueued_at := message.headers.get(ENQUEUED_AT_HEADER)) is not None:
+                # Delayed tasks only start waiting once they're due
+                if (eta := message.headers.get(ETA_HEADER)) is not None:
+                    enqueued_at = max(float(enqueued_at), float(eta))
+                wait = max(0.0, time.time() - float(enqueued_at))
+                self.metrics.observe("queue_wait", task_name, message.queue, wait)
+        return label
+
+    def run(self, message: Message) -> None:
+        """Run a message's task."""
+        self.check_attempts(message)
+        self.execute(claim_instance(message, self.claim_check))
+
+    def check_attempts(self, message: Message):
+        """Raise DeliveryLimitError if a message has already been delivered as many
+        times as its queue allows (so workers presumably crashed running it)."""
+        limit = self._max_attempts(message.queue)
+        if limit is not None and (message.delivery_count or 1) > limit:
+            raise DeliveryLimitError(
+                f"Delivered {message.delivery_count} times, more than the {limit} "
+                f"allowed on {message.queue}"
+            )
+
+    def _max_attempts(self, queue: str) -> int | None:
+        if isinstance(self.max_attempts, Mapping):
+            return self.max_attempts.get(queue)
+        return self.max_attempts
+
+    def execute(self, instance: TaskInstance):
+        timeout = self.task_setting(instance.task_name, "timeout")
+        if self.profiler is None:
+            run_task(instance, self.wiring, timeout)
+        else:
+            with self.profiler.profile(instance.task_name):
+                run_task(instance, self.wiring, timeout)
+
+    def finished(
+        self,
+        message: Message,
+        label: str,
+        error: Exception | None,
+        dt: float,
+    ) -> Message | float | None:
+        """Log and record the outcome of a task, which took `dt` seconds, returning
+        None if its message should be acked, how many seconds to wait before retrying
+        it, or a message to put on the dead-letter queue in its place. If errors are
+        being raised, raises `error`."""
+        if isinstance(error, MissingPayloadError):
+            logger.warning(f"{label} dropped: {error}; assuming it already ran.")
+            return None
+        task_name = _task_name(message)
+        if self.metrics is not None:
+            self.metrics.observe("duration", task_name, message.queue, dt)
+        if error is not None:
+            if self.metrics is not None:
+                self.metrics.count("failed", task_name, message.queue)
+                if isinstance(error, TaskTimeoutError):
+                    self.metrics.count("timed_out", task_name, message.queue)
+            if self.raise_errors:
+                raise error
+            attempt = message.delivery_count or 1
+            delay = self.task_setting(task_name, "retry").delay(attempt)
+            limit = self._max_attempts(message.queue)
+            if delay is None or (limit is not None and attempt >= limit):
+                logger.error(
+                    f"{label} failed on attempt {attempt}, moving it to "
+                    f"{dead_letter_queue(message.queue)}.",
+                    exc_info=error,
+                )
+                if self.metrics is not None:
+                    self.metrics.count("dead_lettered", task_name, message.queue)
+                return dead_letter(message, error)
+            logger.error(
+                f"{label} failed on attempt {attempt}, retrying in {delay:.1f} "
+                "seconds.",
+                exc_info=error,
+            )
+            if self.metrics is not None:
+                self.metrics.count("requeued", task_name, message.queue)
+            return delay
+        logger.info(f"{label} succeeded in {dt:.1e} seconds.")
+        if self.metrics is not None:
+            self.metrics.count("succeeded", task_name, message.queue)
+        return None
+
+    def task_setting(self, task_name: str, name: str):
+        """A setting (such as "retry" or "timeout") for a task: the task's own, as set
+        with @task, or else the worker's."""
+        default = getattr(self, name)
+        try:
+            impl = self.wiring.get_task_by_name(task_name)
+        except Exception:
+            return default
+        if (value := getattr(impl, name, None)) is None:
+            return default
+        return value
+
+    def settle(
+        self,
+        conn: MessageConnection,
+        message: Message,
+        label: str,
+        error: Exception | None,
+        dt: float,
+    ):
+        """Ack, requeue or dead-letter a message once its task has finished."""
+        outcome = self.finished(message, label, error, dt)
+        if isinstance(outcome, Message):
+            # Its offloaded arguments are kept, in case it's redriven
+            conn.publish(outcome)
+            conn.ack(message)
+        elif outcome is None:
+            conn.ack(message)
+            self.release(message)
+        else:
+            conn.requeue(message, outcome)
+
+    def release(self, message: Message):
+        if self.claim_check is not None:
+            self.claim_check.release(message)
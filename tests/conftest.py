@@ -9,6 +9,7 @@ from pika import ConnectionParameters, PlainCredentials
 
 from dstm.client.amqp import AMQPClient
 from dstm.client.base import MessageClient
+from dstm.client.memory import MemoryClient
 from dstm.client.sqs import SQSClient
 
 # pika does a LOT of info-level logging we don't care about.
@@ -25,7 +26,6 @@ def make_sqs():
             aws_secret_access_key="test",
         ),
         visibility_timeout=0,
-        short_poll_sleep_seconds=0.01,
     )
 
 
@@ -37,9 +37,15 @@ def make_amqp():
     )
 
 
-@pytest.fixture(params=["sqs", "amqp"])
+def make_memory():
+    return MemoryClient()
+
+
+@pytest.fixture(params=["sqs", "amqp", "memory"])
 def client(request):
-    return {"sqs": make_sqs(), "amqp": make_amqp()}[request.param]
+    return {"sqs": make_sqs(), "amqp": make_amqp(), "memory": make_memory()}[
+        request.param
+    ]
 
 
 @pytest.fixture()
@@ -0,0 +1,9 @@
+from dstm.tasks.task import task
+from dstm.tasks.types import RetryPolicy
+
+
+@task(queue="warren", retry=RetryPolicy(max_attempts=2, initial_delay=0.1))
+def count_rabbits():
+    """Try to count the rabbits."""
+    print("They keep moving", flush=True)
+    raise RuntimeError("Lost count")
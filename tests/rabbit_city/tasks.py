@@ -1,3 +1,5 @@
+import asyncio
+
 from dstm.tasks.wiring import HardWiring
 
 
@@ -10,11 +12,17 @@ def where_that_rabbit_live(name: str):
     return "hole"
 
 
+async def where_that_rabbit_go(name: str):
+    await asyncio.sleep(0.2)
+    print(f"{name} goes down the hole.")
+
+
 wiring = HardWiring(
     {
         "rabbits": {
             "what_do": what_that_rabbit_do,
             "where_live": where_that_rabbit_live,
+            "where_go": where_that_rabbit_go,
         }
     }
 )
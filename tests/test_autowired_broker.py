@@ -7,8 +7,11 @@ from string import ascii_lowercase
 import pytest
 
 from dstm.client.base import MessageClient
+from dstm.client.sqs import SQSClient
 from dstm.exceptions import WiringError
 from dstm.tasks.broker import TaskBroker
+from dstm.tasks.types import TaskIdentity
+from dstm.tasks.wiring import AutoWiring
 
 
 def test_direct_call_of_decorated_task(capfd):
@@ -68,3 +71,48 @@ def test_autowired_worker_with_default_queue(client: MessageClient, capfd):
     assert out == "peter digs holes.\n"
 
     broker.destroy_queues(["messages"])
+
+
+def test_preload():
+    wiring = AutoWiring()
+    tasks = wiring.preload(["tests.rabbit_city.names"])
+    assert tasks == {
+        "tests.rabbit_city.names:name_rabbits": TaskIdentity(
+            "tests.rabbit_city.names:name_rabbits", "warren"
+        )
+    }
+
+    # Lookups are served from the cache without importing anything
+    sys.modules.pop("tests.rabbit_city.names", None)
+    func = wiring.get_task_by_name("tests.rabbit_city.names:name_rabbits")
+    assert func.__name__ == "name_rabbits"
+    assert "tests.rabbit_city.names" not in sys.modules
+
+    with pytest.raises(WiringError):
+        wiring.get_task_by_name("tests.rabbit_city.names:name_hares")
+
+
+def test_task_retry_policy(client: MessageClient, capfd):
+    prefix = "".join(choices(ascii_lowercase, k=10)) + "-"
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+    broker = TaskBroker(client=client, queue_prefix=prefix)
+    broker.create_queues(["warren"])
+
+    from tests.rabbit_city.counting import count_rabbits
+
+    count_rabbits.submit_to(broker)
+    broker.run_worker("warren", time_limit=5, task_limit=2)
+
+    # Given up on after the two attempts its policy allows, and dead-lettered
+    out, err = capfd.readouterr()
+    assert out == "They keep moving\n" * 2
+    with client.connect() as conn:
+        assert next(conn.listen(prefix + "warren", time_limit=2), None) is None
+
+    # Once redriven, it's retried again
+    assert broker.redrive("warren", idle_timeout=2) == 1
+    broker.run_worker("warren", time_limit=5, task_limit=1)
+    out, err = capfd.readouterr()
+    assert out == "They keep moving\n"
+    broker.destroy_queues(["warren"])
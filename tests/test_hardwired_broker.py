@@ -1,9 +1,16 @@
 """Tests for hardwired plain-function tasks with TaskBroker"""
 
+import asyncio
+import time
+from datetime import datetime
 from random import choices
 from string import ascii_lowercase
 
+import pytest
+
 from dstm.client.base import MessageClient
+from dstm.client.sqs import SQSClient
+from dstm.message import PRIORITY_HEADER
 from dstm.tasks.broker import TaskBroker
 
 
@@ -31,3 +38,113 @@ def test_hardwired_worker(client: MessageClient, capfd):
     assert out == "peter digs holes.\n"
 
     broker.destroy_queues(["rabbits"])
+
+
+def test_async_worker(client: MessageClient, capfd):
+    from tests.rabbit_city.tasks import where_that_rabbit_go, wiring
+
+    if isinstance(client, SQSClient):
+        # Stop messages being redelivered while their tasks are still running
+        client.visibility_timeout = 30
+    prefix = "".join(choices(ascii_lowercase, k=10))
+    broker = TaskBroker(client, wiring, queue_prefix=prefix)
+    broker.create_queues(["rabbits"])
+
+    names = ["peter", "benjamin", "flopsy", "mopsy"]
+    for name in names:
+        broker.submit(where_that_rabbit_go, name)
+
+    asyncio.run(
+        broker.run_async_worker(
+            "rabbits", time_limit=5, task_limit=4, raise_errors=True
+        )
+    )
+
+    out, err = capfd.readouterr()
+    assert sorted(out.splitlines()) == sorted(f"{n} goes down the hole." for n in names)
+
+    broker.destroy_queues(["rabbits"])
+
+
+def test_async_task_in_sync_worker(client: MessageClient, capfd):
+    from tests.rabbit_city.tasks import where_that_rabbit_go, wiring
+
+    prefix = "".join(choices(ascii_lowercase, k=10))
+    broker = TaskBroker(client, wiring, queue_prefix=prefix)
+    broker.create_queues(["rabbits"])
+
+    broker.submit(where_that_rabbit_go, "peter")
+    broker.run_worker("rabbits", time_limit=0, raise_errors=True)
+
+    out, err = capfd.readouterr()
+    assert out == "peter goes down the hole.\n"
+
+    broker.destroy_queues(["rabbits"])
+
+
+def test_submit_with_options(client: MessageClient):
+    from tests.rabbit_city.tasks import what_that_rabbit_do, wiring
+
+    prefix = "".join(choices(ascii_lowercase, k=10))
+    broker = TaskBroker(client, wiring, queue_prefix=prefix)
+    broker.create_queues(["rabbits"])
+
+    broker.with_options(priority=7).submit(what_that_rabbit_do, "peter")
+    broker.submit(what_that_rabbit_do, "benjamin")
+
+    with client.connect() as conn:
+        received = {}
+        for msg in conn.listen(prefix + "rabbits", time_limit=5):
+            received[msg.body["args"][0]] = msg.headers.get(PRIORITY_HEADER)
+            conn.ack(msg)
+            if len(received) == 2:
+                break
+    assert received == {"peter": "7", "benjamin": None}
+
+    broker.destroy_queues(["rabbits"])
+
+
+def test_submit_many(client: MessageClient, capfd):
+    from tests.rabbit_city.tasks import what_that_rabbit_do, wiring
+
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+    prefix = "".join(choices(ascii_lowercase, k=10))
+    broker = TaskBroker(client, wiring, queue_prefix=prefix)
+    broker.create_queues(["rabbits"])
+
+    # A bare string would be splatted into one argument per character
+    with pytest.raises(TypeError):
+        broker.submit_many(what_that_rabbit_do, ["peter"])
+    assert (
+        broker.submit_many(what_that_rabbit_do, [("peter",), {"name": "flopsy"}]) == 2
+    )
+    broker.run_worker("rabbits", time_limit=10, task_limit=2, raise_errors=True)
+    out, err = capfd.readouterr()
+    assert sorted(out.splitlines()) == ["flopsy digs holes.", "peter digs holes."]
+
+    broker.destroy_queues(["rabbits"])
+
+
+def test_submit_with_delay(client: MessageClient, capfd):
+    from tests.rabbit_city.tasks import what_that_rabbit_do, wiring
+
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+    prefix = "".join(choices(ascii_lowercase, k=10))
+    broker = TaskBroker(client, wiring, queue_prefix=prefix)
+    broker.create_queues(["rabbits"])
+
+    with pytest.raises(ValueError):
+        broker.with_options(delay=2, eta=datetime.now())
+    t0 = time.monotonic()
+    broker.with_options(delay=2).submit(what_that_rabbit_do, "peter")
+    broker.submit(what_that_rabbit_do, "benjamin")
+    broker.run_worker("rabbits", time_limit=10, task_limit=2, raise_errors=True)
+
+    # The delayed task waited (RabbitMQ delivers it early, and it's delayed again)
+    assert time.monotonic() - t0 >= 1.9
+    out, err = capfd.readouterr()
+    assert out == "benjamin digs holes.\npeter digs holes.\n"
+
+    broker.destroy_queues(["rabbits"])
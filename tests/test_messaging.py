@@ -1,10 +1,18 @@
 import time
+from random import choices
+from string import ascii_lowercase
 
 import pytest
 
+from dstm.client.amqp import AMQPClient
 from dstm.client.base import MessageClient
-from dstm.message import Message
-from tests.conftest import QueueFactory
+from dstm.client.memory import MemoryClient
+from dstm.client.scheduling import QueuePriorities, QueueScheduler
+from dstm.client.sqs import SQSClient
+from dstm.client.uri import client_from_uri
+from dstm.message import ETA_HEADER, PRIORITY_HEADER, Message
+from dstm.serialization import Codec
+from tests.conftest import QueueFactory, make_sqs
 
 
 def test_send_receive(queue: str, client: MessageClient):
@@ -83,3 +91,345 @@ def test_multiple_queues(queue_factory: QueueFactory, client: MessageClient):
         assert {msg.body["msg"] for msg in msgs} == {"hello world", "hello underworld"}
         for msg in msgs:
             conn.ack(msg)
+
+
+def test_publish_batch(queue_factory: QueueFactory, client: MessageClient):
+    gaia = queue_factory()
+    hades = queue_factory()
+
+    with client.connect() as conn:
+        conn.publish_batch(
+            Message(gaia if i % 2 else hades, {"i": i}) for i in range(25)
+        )
+
+    received = set()
+    with client.connect() as conn:
+        for msg in conn.listen([gaia, hades], time_limit=5):
+            received.add((msg.queue, msg.body["i"]))
+            conn.ack(msg)
+            if len(received) == 25:
+                break
+    assert received == {(gaia if i % 2 else hades, i) for i in range(25)}
+
+
+def test_sqs_queue_url_cache():
+    client = make_sqs()
+    name = "".join(choices(ascii_lowercase, k=10))
+    with client.connect() as conn:
+        conn.create_queue(name)
+        assert name in client._queue_urls
+
+        # Delete the queue behind the cache's back; publishing should notice the
+        # stale URL, re-resolve it (recreating the queue) and succeed.
+        client.client.delete_queue(QueueUrl=client._queue_urls[name])
+        conn.publish(Message(name, {"hello": "again"}))
+        msg = next(conn.listen(name, time_limit=0))
+        assert msg.body == {"hello": "again"}
+        conn.ack(msg)
+
+        conn.destroy_queue(name)
+        assert name not in client._queue_urls
+
+
+def test_sqs_publish_batch_splits_large_messages():
+    client = make_sqs()
+    client.visibility_timeout = 30
+    name = "".join(choices(ascii_lowercase, k=10))
+    sends = 0
+    send_message_batch = client.client.send_message_batch
+
+    def counting_send_message_batch(**kwargs):
+        nonlocal sends
+        sends += 1
+        return send_message_batch(**kwargs)
+
+    client.client.send_message_batch = counting_send_message_batch  # type: ignore
+    with client.connect() as conn:
+        conn.create_queue(name)
+        # Ten of these are too big for one request, but three fit in each
+        big = "x" * 80_000
+        conn.publish_batch(Message(name, {"i": i, "big": big}) for i in range(10))
+        received = set()
+        for msg in conn.listen(name, time_limit=5):
+            received.add(msg.body["i"])
+            conn.ack(msg)
+            if len(received) == 10:
+                break
+        conn.destroy_queue(name)
+    assert received == set(range(10))
+    assert sends == 4
+
+
+def test_sqs_prefetch_disabled():
+    client = make_sqs()
+    client.visibility_timeout = 30
+    client.prefetch_batches = 0
+    name = "".join(choices(ascii_lowercase, k=10))
+    receives = 0
+    receive_message = client.client.receive_message
+
+    def counting_receive_message(**kwargs):
+        nonlocal receives
+        receives += 1
+        return receive_message(**kwargs)
+
+    client.client.receive_message = counting_receive_message  # type: ignore
+    with client.connect() as conn:
+        conn.create_queue(name)
+        conn.publish_batch(Message(name, {"i": i}) for i in range(3))
+        messages = conn.listen(name, time_limit=5)
+        conn.ack(next(messages))
+        time.sleep(0.3)
+        # Nothing more is received until we're done with the first message
+        assert receives == 1
+        conn.ack(next(messages))
+        messages.close()
+        conn.destroy_queue(name)
+
+
+def test_sqs_short_poll_sleep_seconds_deprecated():
+    with pytest.warns(DeprecationWarning, match="short_poll_sleep_seconds"):
+        SQSClient(make_sqs().client, short_poll_sleep_seconds=1)
+
+
+def test_sqs_adaptive_receive_batching():
+    client = make_sqs()
+    client.visibility_timeout = 30
+    name = "".join(choices(ascii_lowercase, k=10))
+    receives = 0
+    receive_message = client.client.receive_message
+
+    def counting_receive_message(**kwargs):
+        nonlocal receives
+        receives += 1
+        return receive_message(**kwargs)
+
+    client.client.receive_message = counting_receive_message  # type: ignore
+    with client.connect() as conn:
+        conn.create_queue(name)
+        conn.publish_batch(Message(name, {"i": i}) for i in range(50))
+        received = set()
+        for msg in conn.listen(name, time_limit=5):
+            received.add(msg.body["i"])
+            conn.ack(msg)
+            if len(received) == 50:
+                break
+        conn.destroy_queue(name)
+    assert received == set(range(50))
+    # Batches grow 1, 2, 4, 8, then 10 at a time
+    assert receives < 15
+
+
+def test_batched_acks(queue: str, client: MessageClient):
+    client.ack_batch_size = 3  # type: ignore
+
+    with client.connect() as conn:
+        conn.publish_batch(Message(queue, {"i": i}) for i in range(5))
+
+    received = set()
+    with client.connect() as conn:
+        for msg in conn.listen(queue, time_limit=5):
+            received.add(msg.body["i"])
+            conn.ack(msg)
+            if len(received) == 5:
+                break
+    assert received == set(range(5))
+
+    # Any acks still buffered should have been flushed on disconnect
+    with client.connect() as conn:
+        with pytest.raises(StopIteration):
+            next(conn.listen(queue, time_limit=0))
+
+
+def test_unyielded_messages_handed_back(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    with client.connect() as conn:
+        conn.publish_batch(Message(queue, {"i": i}) for i in range(5))
+        messages = conn.listen(queue, time_limit=5)
+        first = next(messages)
+        conn.ack(first)
+        # Give the client time to prefetch more than it yields
+        time.sleep(0.5)
+        messages.close()
+
+        # The rest come back, without having been counted as delivered
+        received = {}
+        for message in conn.listen(queue, time_limit=5):
+            received[message.body["i"]] = message.delivery_count
+            conn.ack(message)
+            if len(received) == 4:
+                break
+    assert received == {i: 1 for i in range(5) if i != first.body["i"]}
+
+
+def test_memory_visibility_timeout():
+    client = MemoryClient(visibility_timeout=0.2)
+    with client.connect() as conn:
+        conn.publish(Message("burrow", {"hello": "world"}))
+        msg = next(conn.listen("burrow", time_limit=0))
+
+        # Invisible until the timeout expires, then redelivered
+        with pytest.raises(StopIteration):
+            next(conn.listen("burrow", time_limit=0))
+        msg = next(conn.listen("burrow", time_limit=1))
+        assert msg.body == {"hello": "world"}
+        conn.ack(msg)
+
+
+def test_memory_time_limit_with_backlog():
+    client = MemoryClient()
+    with client.connect() as conn:
+        conn.publish_batch(Message("burrow", {"i": i}) for i in range(300))
+        t0 = time.monotonic()
+        received = 0
+        for msg in conn.listen("burrow", time_limit=0.5):
+            conn.ack(msg)
+            received += 1
+            time.sleep(0.01)
+        # Stopped at the time limit, though messages were still waiting
+        assert time.monotonic() - t0 < 1
+        assert 0 < received < 300
+
+
+def test_heartbeat(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 1
+        client.heartbeat_interval = 0.3
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    elif isinstance(client, MemoryClient):
+        client.visibility_timeout = 1
+
+    with client.connect() as conn:
+        conn.publish(Message(queue, {"hello": "world"}))
+        msg = next(conn.listen(queue, time_limit=1))
+        with conn.heartbeat(msg):
+            time.sleep(2.5)
+            # Still ours, well past the visibility timeout
+            with client.connect() as other:
+                with pytest.raises(StopIteration):
+                    next(other.listen(queue, time_limit=0))
+        conn.ack(msg)
+
+
+def test_lazy_body(queue: str, client: MessageClient):
+    with client.connect() as conn:
+        conn.publish(Message(queue, {"hello": "world"}, headers={"to": "warren"}))
+        msg = next(conn.listen(queue, time_limit=5))
+        assert "<undecoded>" in repr(msg)
+        assert msg.headers == {"to": "warren"}
+        assert msg.body == {"hello": "world"}
+
+        # Republishing sends the received payload without encoding it again
+        conn.publish(Message.from_payload(queue, msg.payload, Codec().decode))
+        conn.ack(msg)
+        msg = next(conn.listen(queue, time_limit=5))
+        assert msg.body == {"hello": "world"}
+        conn.ack(msg)
+
+
+def test_memory_uri_shares_broker():
+    with client_from_uri("memory://warren").connect() as conn:
+        conn.publish(Message("burrow", {"hello": "world"}))
+    with client_from_uri("memory://warren").connect() as conn:
+        msg = next(conn.listen("burrow", time_limit=0))
+        assert msg.body == {"hello": "world"}
+        conn.ack(msg)
+
+
+def test_queue_scheduler():
+    scheduler = QueueScheduler({"high": 3, "low": 1})
+    picks = [scheduler.choose(["high", "low"]) for _ in range(8)]
+    assert picks.count("high") == 6
+    # Turns are spread out rather than bunched together
+    assert picks[:4].count("low") == 1
+    assert scheduler.choose(["low"]) == "low"
+    assert scheduler.choose([]) is None
+
+    strict = QueueScheduler(QueuePriorities({"high": 2, "mid": 1, "low": 1}))
+    assert [strict.choose(["high", "mid", "low"]) for _ in range(3)] == ["high"] * 3
+    assert [strict.choose(["mid", "low"]) for _ in range(4)] == ["mid", "low"] * 2
+    # Queues tied at a priority of zero or less take turns too
+    tied = QueueScheduler(QueuePriorities({"a": 0, "b": 0, "c": -1}))
+    assert [tied.choose(["a", "b", "c"]) for _ in range(4)] == ["a", "b"] * 2
+    assert [tied.choose(["c"]) for _ in range(2)] == ["c"] * 2
+
+
+def test_weighted_queues(queue_factory: QueueFactory, client: MessageClient):
+    if isinstance(client, SQSClient):
+        # Stop prefetched messages being redelivered before they're handled
+        client.visibility_timeout = 30
+    high, bulk = queue_factory(), queue_factory()
+    with client.connect() as conn:
+        conn.publish_batch(Message(bulk, {"n": i}) for i in range(6))
+        conn.publish_batch(Message(high, {"n": i}) for i in range(6))
+        received = []
+        for msg in conn.listen({high: 2, bulk: 1}, time_limit=5):
+            received.append(msg.queue)
+            conn.ack(msg)
+            if len(received) == 12:
+                break
+    assert sorted(received) == sorted([high] * 6 + [bulk] * 6)
+    if isinstance(client, MemoryClient):
+        # Messages are waiting on both queues from the start
+        assert received[:6].count(high) == 4
+
+
+def test_memory_strict_priority():
+    client = MemoryClient()
+    with client.connect() as conn:
+        conn.publish_batch(Message("bulk", {"n": i}) for i in range(3))
+        conn.publish_batch(Message("high", {"n": i}) for i in range(3))
+        received = []
+        for msg in conn.listen(QueuePriorities(high=1, bulk=0), time_limit=0):
+            received.append(msg.queue)
+            conn.ack(msg)
+            if msg.queue == "bulk":
+                conn.publish(Message("high", {}))
+        assert received == ["high"] * 3 + ["bulk", "high"] * 3
+
+
+def test_delayed_publish(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    with client.connect() as conn:
+        t0 = time.time()
+        conn.publish_batch(
+            [
+                Message(queue, {"n": 1}, {ETA_HEADER: str(t0 + 2)}),
+                Message(queue, {"n": 2}),
+            ]
+        )
+        received = []
+        for msg in conn.listen(queue, time_limit=5):
+            received.append((msg.body["n"], time.time() - t0))
+            conn.ack(msg)
+            if len(received) == 2:
+                break
+    assert [n for n, _ in received] == [2, 1]
+    # RabbitMQ rounds the delay down to 1024ms, so the worker can delay it again
+    assert received[1][1] >= 1.0
+
+
+def test_amqp_message_priority(queue_factory: QueueFactory, client: MessageClient):
+    if not isinstance(client, AMQPClient):
+        pytest.skip("Only AMQP supports message priorities")
+    client.max_priority = 9
+    queue = queue_factory()
+    with client.connect() as conn:
+        for priority in (1, 9, 5):
+            conn.publish(
+                Message(queue, {"n": priority}, {PRIORITY_HEADER: str(priority)})
+            )
+        received = []
+        for msg in conn.listen(queue, time_limit=1):
+            received.append(msg.body["n"])
+            conn.ack(msg)
+            if len(received) == 3:
+                break
+    assert received == [9, 5, 1]
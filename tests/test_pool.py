@@ -0,0 +1,43 @@
+"""Tests for pooled connections used when submitting tasks"""
+
+from dstm.client.base import MessageClient
+from dstm.client.pool import PooledClient
+from dstm.message import Message
+
+
+def test_pool_reuses_connections(queue: str, client: MessageClient):
+    pool = PooledClient(client, max_size=1)
+    with pool.connect() as conn:
+        first = conn.conn
+        conn.publish(Message(queue, {"n": 1}))
+    with pool.connect() as conn:
+        assert conn.conn is first
+        conn.publish(Message(queue, {"n": 2}))
+
+    received = set()
+    with client.connect() as conn:
+        for msg in conn.listen(queue, time_limit=5):
+            received.add(msg.body["n"])
+            conn.ack(msg)
+            if len(received) == 2:
+                break
+    assert received == {1, 2}
+    pool.close()
+
+
+def test_pool_discards_expired_connections(client: MessageClient):
+    pool = PooledClient(client, idle_timeout=0)
+    with pool.connect() as conn:
+        first = conn.conn
+    with pool.connect() as conn:
+        assert conn.conn is not first
+    pool.close()
+
+
+def test_pool_limits_idle_connections(client: MessageClient):
+    pool = PooledClient(client, max_size=1)
+    with pool.connect() as a, pool.connect() as b:
+        assert a.conn is not b.conn
+    assert len(pool._idle) == 1
+    pool.close()
+    assert not pool._idle
@@ -0,0 +1,68 @@
+"""Tests for the prefork supervisor"""
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+import pytest
+
+from dstm.tasks.prefork import run_prefork
+
+pytestmark = pytest.mark.skipif(
+    "fork" not in multiprocessing.get_all_start_methods(),
+    reason="The test worker is only picklable when forked",
+)
+
+
+def crash_once_worker(log: Path, index: int, shutdown: threading.Event):
+    with log.open("a") as f:
+        f.write(f"start {index} {os.getpid()}\n")
+    crashed = log.with_suffix(f".crashed{index}")
+    if not crashed.exists():
+        crashed.touch()
+        os._exit(1)
+    shutdown.wait()
+    with log.open("a") as f:
+        f.write(f"stop {index}\n")
+
+
+def read_log(log: Path) -> list[str]:
+    return log.read_text().splitlines() if log.exists() else []
+
+
+def wait_for(condition, timeout: float = 10.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_prefork_restarts_and_stops_workers(tmp_path: Path):
+    log = tmp_path / "workers.log"
+    supervisor = multiprocessing.get_context("fork").Process(
+        target=run_prefork,
+        args=(partial(crash_once_worker, log), 2),
+        kwargs=dict(restart_delay=0.1, shutdown_timeout=10),
+    )
+    supervisor.start()
+    try:
+        # Each slot's first worker crashes straight away and is replaced
+        assert wait_for(lambda: len(read_log(log)) == 4)
+        starts = [line.split() for line in read_log(log)]
+        assert sorted(index for _, index, _ in starts) == ["0", "0", "1", "1"]
+        assert len({pid for _, _, pid in starts}) == 4
+        # SIGTERM is passed on to the workers, which shut down cleanly
+        assert supervisor.pid is not None
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join(10)
+        assert supervisor.exitcode == 0
+        assert sorted(read_log(log)[4:]) == ["stop 0", "stop 1"]
+    finally:
+        if supervisor.is_alive():
+            supervisor.kill()
@@ -0,0 +1,105 @@
+"""Tests for message body serialization and content-type negotiation"""
+
+import pytest
+
+from dstm.client.base import MessageClient
+from dstm.message import Message
+from dstm.serialization import (
+    BinarySerializer,
+    Codec,
+    JSONSerializer,
+    MsgpackSerializer,
+    OrjsonSerializer,
+    ZlibCompressor,
+    ZstdCompressor,
+)
+
+SERIALIZERS = {
+    "json": (JSONSerializer, None),
+    "orjson": (OrjsonSerializer, "orjson"),
+    "msgpack": (MsgpackSerializer, "msgpack"),
+    "binary": (BinarySerializer, None),
+}
+COMPRESSORS = {
+    "zlib": (ZlibCompressor, None),
+    "zstd": (ZstdCompressor, "zstandard"),
+}
+
+
+def make_codec(name: str) -> Codec:
+    serializer, _, compressor = name.partition("+")
+    cls, module = SERIALIZERS[serializer]
+    if module:
+        pytest.importorskip(module)
+    codec = Codec(cls(), compress_threshold=0)
+    if compressor:
+        cls, module = COMPRESSORS[compressor]
+        if module:
+            pytest.importorskip(module)
+        codec.compressor = cls()
+    return codec
+
+
+@pytest.mark.parametrize(
+    "codec", ["json", "orjson", "msgpack", "binary", "json+zlib", "msgpack+zstd"]
+)
+def test_mixed_codecs(queue: str, client: MessageClient, codec: str):
+    # Publish with one codec and consume with the default, as during a rollout
+    body = {"args": ["rabbit"], "kwargs": {"count": 3, "carrots": [1.5] * 100}}
+    client.codec = make_codec(codec)  # type: ignore
+    with client.connect() as conn:
+        conn.publish(Message(queue, body, headers={"origin": "warren"}))
+
+    client.codec = Codec()  # type: ignore
+    with client.connect() as conn:
+        msg = next(conn.listen(queue, time_limit=5))
+        assert msg.body == body
+        assert msg.headers == {"origin": "warren"}
+        conn.ack(msg)
+
+
+def test_compress_threshold():
+    codec = Codec(compressor=ZlibCompressor(), compress_threshold=100)
+    small = codec.encode({"a": 1})
+    assert small.content_encoding is None
+    large = codec.encode({"a": "x" * 1000})
+    assert large.content_encoding == "zlib"
+    assert len(large.data) < 1000
+    assert codec.decode(*large) == {"a": "x" * 1000}
+
+
+def test_unsupported_content_type():
+    with pytest.raises(ValueError):
+        Codec().decode(b"<rabbit/>", "application/xml")
+
+
+def test_binary_buffers(queue: str, client: MessageClient):
+    numpy = pytest.importorskip("numpy")
+    tile = numpy.arange(24, dtype=numpy.float32).reshape(2, 3, 4)
+    body = {
+        "args": [b"\x00\xff" * 10, bytearray(b"carrot")],
+        "kwargs": {"view": memoryview(b"warren"), "tile": tile, "n": 3},
+    }
+    client.codec = Codec(BinarySerializer(), ZlibCompressor())  # type: ignore
+    with client.connect() as conn:
+        conn.publish(Message(queue, body))
+        msg = next(conn.listen(queue, time_limit=5))
+        conn.ack(msg)
+
+    args, kwargs = msg.body["args"], msg.body["kwargs"]
+    assert args == [b"\x00\xff" * 10, bytearray(b"carrot")]
+    assert isinstance(args[1], bytearray)
+    assert kwargs["view"] == b"warren"
+    assert kwargs["n"] == 3
+    assert kwargs["tile"].dtype == numpy.float32
+    numpy.testing.assert_array_equal(kwargs["tile"], tile)
+    # A view onto the received message, not a copy
+    assert not kwargs["tile"].flags.owndata
+
+
+def test_binary_non_contiguous_array():
+    numpy = pytest.importorskip("numpy")
+    grid = numpy.arange(16).reshape(4, 4)
+    codec = Codec(BinarySerializer(MsgpackSerializer()))
+    decoded = codec.decode(*codec.encode({"column": grid[:, 1]}))
+    numpy.testing.assert_array_equal(decoded["column"], [1, 5, 9, 13])
@@ -1,9 +1,34 @@
 """Tests for low-level task functions (without using the TaskBroker)"""
 
+import asyncio
+import pstats
+import threading
+import time
+import urllib.request
+from pathlib import Path
+from random import choices
+from string import ascii_lowercase
+
+import pytest
+
+from dstm.client.amqp import AMQPClient
 from dstm.client.base import MessageClient
-from dstm.tasks.broker import submit_task
+from dstm.client.sqs import CONTENT_TYPE_ATTRIBUTE, SQSClient
+from dstm.message import Message
+from dstm.tasks.broker import publish_task, submit_task, submit_tasks
+from dstm.tasks.claimcheck import ClaimCheck, FilesystemBlobStore
+from dstm.tasks.deadletter import (
+    ERROR_HEADER,
+    TRACEBACK_HEADER,
+    dead_letter_queue,
+    redrive_dead_letters,
+)
+from dstm.tasks.metrics import WorkerMetrics, serve_metrics
+from dstm.tasks.profiling import TaskProfiler
+from dstm.tasks.types import RetryPolicy, TaskInstance
 from dstm.tasks.wiring import HardWiring
-from dstm.tasks.worker import run_worker
+from dstm.tasks.worker import run_worker, run_worker_async
+from tests.conftest import make_sqs
 
 outputs = []
 
@@ -13,7 +38,16 @@ def simple_task(name: str, count: int):
         outputs.append(f"hi {name}")
 
 
-wiring = HardWiring({"default": {"simple_task": simple_task}})
+attempts: list[tuple[int, float]] = []
+
+
+def flaky_task(failures: int):
+    attempts.append((len(attempts) + 1, time.monotonic()))
+    if len(attempts) <= failures:
+        raise RuntimeError("Carrot supply interrupted")
+
+
+wiring = HardWiring({"default": {"simple_task": simple_task, "flaky_task": flaky_task}})
 
 
 def test_simple_task(queue: str, client: MessageClient):
@@ -22,3 +56,365 @@ def test_simple_task(queue: str, client: MessageClient):
     outputs.clear()
     run_worker(client, [queue], wiring, time_limit=0, raise_errors=True)
     assert outputs == ["hi steve"] * 3
+
+
+def test_submit_many(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        # Stop prefetched messages being redelivered before they're handled
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    calls = [((f"rabbit {i}",), {"count": 1}) for i in range(15)]
+    assert submit_tasks(queue, "simple_task", client, calls, batch_size=4) == 15
+
+    outputs.clear()
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=15, raise_errors=True)
+    assert sorted(outputs) == sorted(f"hi rabbit {i}" for i in range(15))
+
+
+def slow_task(name: str):
+    time.sleep(0.2)
+    outputs.append(f"hi {name}")
+
+
+def test_concurrent_worker(queue: str, client: MessageClient):
+    wiring = HardWiring({"default": {"slow_task": slow_task}})
+    if isinstance(client, SQSClient):
+        # Stop messages being redelivered while their tasks are still running
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    if isinstance(client, AMQPClient):
+        # Raised by the worker, so it doesn't limit how many tasks run at once
+        client.prefetch_count = 2
+    calls = [((f"rabbit {i}",), {}) for i in range(8)]
+    submit_tasks(queue, "slow_task", client, calls)
+
+    outputs.clear()
+    t0 = time.monotonic()
+    run_worker(
+        client,
+        [queue],
+        wiring,
+        time_limit=10,
+        task_limit=8,
+        raise_errors=True,
+        concurrency=8,
+    )
+    assert sorted(outputs) == sorted(f"hi rabbit {i}" for i in range(8))
+    # Run serially these would take at least 1.6s
+    assert time.monotonic() - t0 < 1.5
+
+
+def test_claim_check(queue: str, client: MessageClient, tmp_path: Path):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    claim_check = ClaimCheck(FilesystemBlobStore(tmp_path), threshold=1024)
+    big_name = "rabbit " * 1000
+    publish_task(
+        queue, TaskInstance("simple_task", [big_name, 1], {}), client, claim_check
+    )
+    publish_task(
+        queue, TaskInstance("simple_task", ["bunny", 1], {}), client, claim_check
+    )
+    assert len(list(tmp_path.iterdir())) == 1
+
+    outputs.clear()
+    run_worker(
+        client,
+        [queue],
+        wiring,
+        time_limit=5,
+        task_limit=2,
+        raise_errors=True,
+        claim_check=claim_check,
+    )
+    assert sorted(outputs) == sorted([f"hi {big_name}", "hi bunny"])
+    # The offloaded arguments are deleted once the task has succeeded
+    assert not list(tmp_path.iterdir())
+
+
+def test_worker_metrics(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    metrics = WorkerMetrics()
+    submit_task(queue, "simple_task", client, "steve", 1)
+    submit_task(queue, "simple_task", client, "bob", 1)
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=2, metrics=metrics)
+    submit_task(queue, "missing_task", client)
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=1, metrics=metrics)
+
+    server = serve_metrics(metrics, 0)
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/metrics"
+        with urllib.request.urlopen(url) as response:
+            text = response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+    labels = f'task="simple_task",queue="{queue}"'
+    missing = f'task="missing_task",queue="{queue}"'
+    assert f"dstm_tasks_received_total{{{labels}}} 2" in text
+    assert f"dstm_tasks_succeeded_total{{{labels}}} 2" in text
+    assert f"dstm_tasks_failed_total{{{missing}}} 1" in text
+    assert f"dstm_tasks_requeued_total{{{missing}}} 1" in text
+    assert f'dstm_task_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+    # Failed tasks' durations are recorded too
+    assert f"dstm_task_duration_seconds_count{{{missing}}} 1" in text
+    assert f"dstm_task_queue_wait_seconds_count{{{labels}}} 2" in text
+
+
+def test_profiler(queue: str, client: MessageClient, tmp_path: Path):
+    profiler = TaskProfiler(1.0, tmp_path)
+    submit_task(queue, "simple_task", client, "steve", 2)
+    submit_task(queue, "simple_task", client, "bob", 1)
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=2, profiler=profiler)
+    profiler.dump()
+    [path] = tmp_path.iterdir()
+    assert path.name.startswith("simple_task.")
+    stats = pstats.Stats(str(path))
+    calls = {func[2]: counts[1] for func, counts in stats.stats.items()}  # type: ignore
+    assert calls["simple_task"] == 2
+
+
+def test_profiler_dumps_between_samples(tmp_path: Path):
+    profiler = TaskProfiler(1.0, tmp_path, dump_interval=3600)
+    with profiler.profile("simple_task"):
+        simple_task("steve", 1)
+    assert not list(tmp_path.iterdir())
+    # Due to be written out, though the next task isn't sampled
+    profiler.sample_rate = 0.0
+    profiler.dump_interval = 0.0
+    with profiler.profile("simple_task"):
+        simple_task("bob", 1)
+    [path] = tmp_path.iterdir()
+    assert path.name.startswith("simple_task.")
+
+
+def test_retry_backoff(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    submit_task(queue, "flaky_task", client, 2)
+    attempts.clear()
+    retry = RetryPolicy(initial_delay=0.2, jitter=False)
+    run_worker(client, [queue], wiring, time_limit=10, task_limit=3, retry=retry)
+    assert [n for n, _ in attempts] == [1, 2, 3]
+    # Retries wait 0.2s, then 0.4s (SQS rounds delays up to whole seconds)
+    (_, t1), (_, t2), (_, t3) = attempts
+    assert t2 - t1 >= 0.2
+    assert t3 - t2 >= 0.4
+
+
+def test_dead_letter_poison_message(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+    dlq = dead_letter_queue(queue)
+    with client.connect() as conn:
+        conn.create_queue(queue)
+        conn.create_queue(dlq)
+        conn.publish(Message(queue, {"not": "a task"}, {"color": "brown"}))
+    retry = RetryPolicy(initial_delay=0.1)
+    metrics = WorkerMetrics()
+    run_worker(
+        client,
+        [queue],
+        wiring,
+        time_limit=5,
+        task_limit=2,
+        retry=retry,
+        max_attempts=2,
+        metrics=metrics,
+    )
+    assert f'dstm_tasks_dead_lettered_total{{task="unknown",queue="{queue}"}} 1' in (
+        metrics.render()
+    )
+
+    with client.connect() as conn:
+        dead = next(conn.listen(dlq, time_limit=2))
+        assert dead.body == {"not": "a task"}
+        assert dead.headers["color"] == "brown"
+        assert dead.headers[ERROR_HEADER] == "KeyError: 'task_name'"
+        assert "Traceback" in dead.headers[TRACEBACK_HEADER]
+        conn.requeue(dead)
+        assert redrive_dead_letters(conn, queue, idle_timeout=3) == 1
+        redriven = next(conn.listen(queue, time_limit=2))
+        assert redriven.body == {"not": "a task"}
+        assert ERROR_HEADER not in redriven.headers
+        conn.ack(redriven)
+        conn.destroy_queue(dlq)
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+def test_stopping_worker_uses_no_attempts(
+    queue: str, client: MessageClient, use_asyncio: bool
+):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    for i in range(6):
+        submit_task(queue, "simple_task", client, f"bunny {i}", 1)
+
+    outputs.clear()
+    # Each worker stops after one task, leaving messages it had prefetched, which
+    # mustn't count towards their attempts
+    options = dict(time_limit=5, task_limit=1, max_attempts=2)
+    for _ in range(6):
+        if use_asyncio:
+            asyncio.run(run_worker_async(client, [queue], wiring, **options))
+        else:
+            run_worker(client, [queue], wiring, **options)
+    assert sorted(outputs) == sorted(f"hi bunny {i}" for i in range(6))
+
+
+stop_requested = threading.Event()
+
+
+def stopping_task(name: str):
+    outputs.append(f"hi {name}")
+    stop_requested.set()
+
+
+def test_worker_shutdown(queue: str, client: MessageClient):
+    wiring = HardWiring({"default": {"stopping_task": stopping_task}})
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+        with client.connect() as conn:
+            conn.create_queue(queue)
+    for i in range(3):
+        submit_task(queue, "stopping_task", client, f"bunny {i}")
+
+    outputs.clear()
+    stop_requested.clear()
+    t0 = time.monotonic()
+    run_worker(client, [queue], wiring, time_limit=10, shutdown=stop_requested)
+    # The worker settles the task that asked it to stop, then returns without taking
+    # any more
+    assert len(outputs) == 1
+    assert time.monotonic() - t0 < 5
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=2)
+    assert sorted(outputs) == [f"hi bunny {i}" for i in range(3)]
+
+
+def test_dead_letter_undecodable_sqs_message():
+    client = make_sqs()
+    client.visibility_timeout = 30
+    queue = "".join(choices(ascii_lowercase, k=10))
+    dlq = dead_letter_queue(queue)
+    with client.connect() as conn:
+        conn.create_queue(queue)
+        conn.create_queue(dlq)
+        client.client.send_message(
+            QueueUrl=client._queue_urls[queue],
+            MessageBody="not base64!",
+            MessageAttributes={
+                CONTENT_TYPE_ATTRIBUTE: {
+                    "StringValue": "application/msgpack",
+                    "DataType": "String",
+                },
+            },
+        )
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=1, max_attempts=1)
+
+    with client.connect() as conn:
+        # Moved as it was, rather than being left on the queue to come back forever
+        assert next(conn.listen(queue, time_limit=0), None) is None
+        dead = next(conn.listen(dlq, time_limit=2))
+        assert dead.headers[ERROR_HEADER].startswith("ValueError: Undecodable")
+        assert dead.payload is not None and dead.payload.data == b"not base64!"
+        conn.ack(dead)
+        conn.destroy_queue(dlq)
+        conn.destroy_queue(queue)
+
+
+def test_dead_letter_after_crashes(queue: str, client: MessageClient):
+    if isinstance(client, SQSClient):
+        # So messages left unsettled come back quickly
+        client.visibility_timeout = 1
+    dlq = dead_letter_queue(queue)
+    with client.connect() as conn:
+        conn.create_queue(queue)
+        conn.create_queue(dlq)
+    submit_task(queue, "simple_task", client, "steve", 1)
+    for _ in range(2):
+        # A worker receives the message and dies without settling it
+        with client.connect() as conn:
+            assert next(conn.listen(queue, time_limit=5)).queue == queue
+
+    outputs.clear()
+    run_worker(client, [queue], wiring, time_limit=5, task_limit=1, max_attempts=2)
+    assert outputs == []
+    with client.connect() as conn:
+        dead = next(conn.listen(dlq, time_limit=5))
+        assert dead.headers[ERROR_HEADER].startswith("DeliveryLimitError")
+        conn.ack(dead)
+        conn.destroy_queue(dlq)
+
+
+def hanging_task():
+    # Sleeps in short steps, since a worker's pool threads can only be interrupted
+    # between them
+    for _ in range(500):
+        time.sleep(0.01)
+    outputs.append("woke up")
+
+
+async def hanging_coroutine():
+    await asyncio.sleep(5)
+    outputs.append("woke up")
+
+
+hanging_wiring = HardWiring(
+    {
+        "default": {
+            "hanging_task": hanging_task,
+            "hanging_coroutine": hanging_coroutine,
+        }
+    }
+)
+
+
+@pytest.mark.parametrize("use_asyncio", [False, True])
+@pytest.mark.parametrize("concurrency", [1, 2])
+def test_task_timeout(
+    queue: str, client: MessageClient, concurrency: int, use_asyncio: bool
+):
+    if isinstance(client, SQSClient):
+        client.visibility_timeout = 30
+    with client.connect() as conn:
+        conn.create_queue(queue)
+        conn.create_queue(dead_letter_queue(queue))
+    submit_task(queue, "hanging_task", client)
+    submit_task(queue, "hanging_coroutine", client)
+
+    outputs.clear()
+    metrics = WorkerMetrics()
+    t0 = time.monotonic()
+    options = dict(
+        time_limit=5,
+        task_limit=2,
+        concurrency=concurrency,
+        metrics=metrics,
+        retry=RetryPolicy(max_attempts=1),
+        timeout=0.5,
+    )
+    if use_asyncio:
+        asyncio.run(run_worker_async(client, [queue], hanging_wiring, **options))
+    else:
+        run_worker(client, [queue], hanging_wiring, **options)
+    assert time.monotonic() - t0 < 3
+    assert outputs == []
+    text = metrics.render()
+    for task_name in ("hanging_task", "hanging_coroutine"):
+        labels = f'task="{task_name}",queue="{queue}"'
+        assert f"dstm_tasks_timed_out_total{{{labels}}} 1" in text
+        assert f"dstm_tasks_dead_lettered_total{{{labels}}} 1" in text
+
+    with client.connect() as conn:
+        conn.destroy_queue(dead_letter_queue(queue))